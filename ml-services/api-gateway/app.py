@@ -1,15 +1,24 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import requests
 import os
 import json
 import time
 import logging
+import queue
+import sys
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.frame_stream import FRAME_STREAM_TYPE, raw_frame_stream, read_frame_stream
+
 app = Flask(__name__)
 CORS(app)
 
+# Request bodies larger than this are rejected with 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_BYTES", 16 * 1024 * 1024))
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -26,6 +35,18 @@ FACE_RECOGNITION_SERVICE = os.getenv("FACE_RECOGNITION_SERVICE", "http://localho
 OBJECT_DETECTION_SERVICE = os.getenv("OBJECT_DETECTION_SERVICE", "http://localhost:5002")
 SENTIMENT_ANALYSIS_SERVICE = os.getenv("SENTIMENT_ANALYSIS_SERVICE", "http://localhost:5003")
 
+# Streaming endpoints of each service for live session monitoring
+STREAM_SERVICES = {
+    "face_recognition": f"{FACE_RECOGNITION_SERVICE}/api/face/stream",
+    "object_detection": f"{OBJECT_DETECTION_SERVICE}/api/object-detection/stream",
+    "sentiment_analysis": f"{SENTIMENT_ANALYSIS_SERVICE}/api/sentiment/stream",
+}
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", 15))
+
+# Pooled connections, so a session's frames reuse keep-alive connections to the services
+stream_session = requests.Session()
+stream_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+
 # Rate limiting configuration
 REQUEST_LIMITS = {
     "face_recognition": 10,  # requests per minute
@@ -69,6 +90,15 @@ def check_rate_limit(service_name):
     request_counter[service_name]["count"] += 1
     return None
 
+# Forward the client's body unchanged, so raw image and multipart uploads
+# reach the services without being parsed and re-serialized here
+def forward_body():
+    return {
+        "data": request.get_data(),
+        "params": request.args,
+        "headers": {"Content-Type": request.content_type or "application/json"}
+    }
+
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -120,8 +150,7 @@ def register_face():
     try:
         response = requests.post(
             f"{FACE_RECOGNITION_SERVICE}/api/face/register",
-            json=request.json,
-            headers={"Content-Type": "application/json"}
+            **forward_body()
         )
         return jsonify(response.json()), response.status_code
     except Exception as e:
@@ -147,8 +176,7 @@ def verify_face():
     try:
         response = requests.post(
             f"{FACE_RECOGNITION_SERVICE}/api/face/verify",
-            json=request.json,
-            headers={"Content-Type": "application/json"}
+            **forward_body()
         )
         return jsonify(response.json()), response.status_code
     except Exception as e:
@@ -158,6 +186,58 @@ def verify_face():
             "message": "Face verification service unavailable"
         }), 503
 
+@app.route('/api/face/verify-batch', methods=['POST'])
+def verify_face_batch():
+    # Check auth
+    auth_error = require_auth()
+    if auth_error:
+        return auth_error
+    
+    # Check rate limit
+    rate_limit_error = check_rate_limit("face_recognition")
+    if rate_limit_error:
+        return rate_limit_error
+    
+    # Forward the request
+    try:
+        response = requests.post(
+            f"{FACE_RECOGNITION_SERVICE}/api/face/verify-batch",
+            **forward_body()
+        )
+        return jsonify(response.json()), response.status_code
+    except Exception as e:
+        logger.error(f"Error calling face batch verification service: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": "Face verification service unavailable"
+        }), 503
+
+@app.route('/api/face/track', methods=['POST'])
+def track_faces():
+    # Check auth
+    auth_error = require_auth()
+    if auth_error:
+        return auth_error
+    
+    # Check rate limit
+    rate_limit_error = check_rate_limit("face_recognition")
+    if rate_limit_error:
+        return rate_limit_error
+    
+    # Forward the request
+    try:
+        response = requests.post(
+            f"{FACE_RECOGNITION_SERVICE}/api/face/track",
+            **forward_body()
+        )
+        return jsonify(response.json()), response.status_code
+    except Exception as e:
+        logger.error(f"Error calling face tracking service: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": "Face tracking service unavailable"
+        }), 503
+
 @app.route('/api/face/analyze', methods=['POST'])
 def analyze_face():
     # Check auth
@@ -174,8 +254,7 @@ def analyze_face():
     try:
         response = requests.post(
             f"{FACE_RECOGNITION_SERVICE}/api/face/analyze",
-            json=request.json,
-            headers={"Content-Type": "application/json"}
+            **forward_body()
         )
         return jsonify(response.json()), response.status_code
     except Exception as e:
@@ -202,8 +281,7 @@ def detect_id_card():
     try:
         response = requests.post(
             f"{OBJECT_DETECTION_SERVICE}/api/object-detection/idcard",
-            json=request.json,
-            headers={"Content-Type": "application/json"}
+            **forward_body()
         )
         return jsonify(response.json()), response.status_code
     except Exception as e:
@@ -229,8 +307,7 @@ def detect_phone():
     try:
         response = requests.post(
             f"{OBJECT_DETECTION_SERVICE}/api/object-detection/phone",
-            json=request.json,
-            headers={"Content-Type": "application/json"}
+            **forward_body()
         )
         return jsonify(response.json()), response.status_code
     except Exception as e:
@@ -257,8 +334,7 @@ def analyze_sentiment():
     try:
         response = requests.post(
             f"{SENTIMENT_ANALYSIS_SERVICE}/api/sentiment/analyze",
-            json=request.json,
-            headers={"Content-Type": "application/json"}
+            **forward_body()
         )
         return jsonify(response.json()), response.status_code
     except Exception as e:
@@ -293,9 +369,11 @@ def analyze_all():
     # Prepare payload for each service
     face_payload = {
         'image': image_data,
-        'studentId': student_id,
         'sessionId': session_id
     }
+    if student_id != 'unknown':
+        # Lets the face service verify 1:1 against the claimed student only
+        face_payload['studentId'] = student_id
     
     object_payload = {
         'image': image_data,
@@ -391,6 +469,140 @@ def analyze_all():
     
     return jsonify(analysis_result), 200
 
+# Live session streams: frames fan out to every service, results come back
+# as one merged server-sent event stream
+@app.route('/api/stream/<session_id>/frames', methods=['POST'])
+def stream_frames(session_id):
+    # Check auth; frames are rate limited per session by the services themselves
+    auth_error = require_auth()
+    if auth_error:
+        return auth_error
+    
+    def send(url, body):
+        try:
+            response = stream_session.post(f"{url}/{session_id}/frames", timeout=10, **body)
+            return response.json()
+        except Exception as e:
+            logger.error(f"Error streaming frames to {url}: {str(e)}")
+            return {"success": False, "message": "Service unavailable"}
+    
+    with ThreadPoolExecutor(max_workers=len(STREAM_SERVICES)) as executor:
+        if request.mimetype != FRAME_STREAM_TYPE:
+            body = forward_body()
+            futures = {name: executor.submit(send, url, body) for name, url in STREAM_SERVICES.items()}
+            results = {name: future.result() for name, future in futures.items()}
+        else:
+            # Continuous stream: forward each frame to the services as soon as it
+            # arrives instead of buffering the whole (possibly endless) body
+            results = {name: {"success": False, "accepted": 0} for name in STREAM_SERVICES}
+            try:
+                for frame in read_frame_stream(raw_frame_stream(request), app.config['MAX_CONTENT_LENGTH']):
+                    body = {"data": frame, "headers": {"Content-Type": "application/octet-stream"}}
+                    futures = {name: executor.submit(send, url, body) for name, url in STREAM_SERVICES.items()}
+                    for name, future in futures.items():
+                        result = future.result()
+                        results[name]["message"] = result.get("message")
+                        if result.get("success"):
+                            results[name]["success"] = True
+                            results[name]["accepted"] += 1
+            except ValueError as e:
+                return jsonify({"success": False, "message": str(e), "services": results}), 413
+    
+    accepted = any(result.get("success") for result in results.values())
+    return jsonify({
+        "success": accepted,
+        "message": "Frames accepted" if accepted else "No service accepted the frames",
+        "services": results
+    }), 202 if accepted else 503
+
+@app.route('/api/stream/<session_id>/events', methods=['GET'])
+def stream_events(session_id):
+    # Check auth
+    auth_error = require_auth()
+    if auth_error:
+        return auth_error
+    
+    # Opening a stream counts as one request against every service
+    for service in STREAM_SERVICES:
+        rate_limit_error = check_rate_limit(service)
+        if rate_limit_error:
+            return rate_limit_error
+    
+    events = queue.Queue(maxsize=64)
+    upstreams = []
+    finished = []
+    
+    def offer(event):
+        # A slow client loses its oldest events rather than stalling the relays
+        while True:
+            try:
+                events.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+    
+    def relay(name, url):
+        """Copy one service's events into the merged stream, tagged with the service"""
+        try:
+            response = stream_session.get(f"{url}/{session_id}/events", stream=True, timeout=(2, None))
+            upstreams.append(response)
+            if response.status_code != 200:
+                raise RuntimeError(f"Status code: {response.status_code}")
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith("data:"):
+                    event = json.loads(line[len("data:"):])
+                    event["service"] = name
+                    offer(event)
+        except Exception as e:
+            logger.error(f"Stream from {name} ended: {str(e)}")
+            offer({"service": name, "success": False, "message": "Service stream unavailable"})
+        finally:
+            finished.append(name)
+            offer(None)  # wake the merged stream
+    
+    for name, url in STREAM_SERVICES.items():
+        threading.Thread(target=relay, args=(name, url), daemon=True).start()
+    
+    def merged():
+        try:
+            yield ": keep-alive\n\n"
+            # Ends once every service has closed its stream
+            while len(finished) < len(STREAM_SERVICES) or not events.empty():
+                try:
+                    event = events.get(timeout=STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is not None:
+                    yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            # Client went away: drop the upstream connections so the relays stop
+            for response in upstreams:
+                response.close()
+    
+    return Response(merged(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/stream/<session_id>', methods=['DELETE'])
+def close_stream(session_id):
+    # Check auth
+    auth_error = require_auth()
+    if auth_error:
+        return auth_error
+    
+    results = {}
+    for name, url in STREAM_SERVICES.items():
+        try:
+            results[name] = stream_session.delete(f"{url}/{session_id}", timeout=5).json()
+        except Exception as e:
+            logger.error(f"Error closing stream on {name}: {str(e)}")
+            results[name] = {"success": False, "message": "Service unavailable"}
+    
+    return jsonify({"success": True, "message": "Stream closed", "services": results}), 200
+
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
@@ -406,6 +618,13 @@ def method_not_allowed(error):
         'message': 'Method not allowed'
     }), 405
 
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({
+        'success': False,
+        'message': 'Request body too large'
+    }), 413
+
 @app.errorhandler(500)
 def internal_server_error(error):
     return jsonify({
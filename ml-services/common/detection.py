@@ -0,0 +1,44 @@
+import cv2
+
+
+def downscale_for_detection(image, target_width):
+    """Shrink a frame to at most target_width pixels wide for detection
+
+    Returns the (possibly unchanged) frame and the factor that maps its
+    coordinates back to the original frame.
+    """
+    height, width = image.shape[:2]
+    if not target_width or width <= target_width:
+        return image, 1.0
+
+    scale = width / float(target_width)
+    small = cv2.resize(image, (int(target_width), max(1, int(round(height / scale)))),
+                       interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+def detect_scaled(cascade, gray, target_width, min_size=24, max_size=0, scale_factor=1.1, min_neighbors=4):
+    """Run a cascade at a bounded working resolution and map boxes back
+
+    min_size and max_size are in working-resolution pixels (0 = no limit),
+    so detection cost depends on target_width rather than the camera's
+    native resolution. Returns (x, y, w, h) boxes as ints in the
+    coordinates of the full-resolution gray frame.
+    """
+    small, scale = downscale_for_detection(gray, target_width)
+    limits = {}
+    if min_size:
+        limits['minSize'] = (min_size, min_size)
+    if max_size:
+        limits['maxSize'] = (max_size, max_size)
+    boxes = cascade.detectMultiScale(small, scaleFactor=scale_factor, minNeighbors=min_neighbors, **limits)
+
+    height, width = gray.shape[:2]
+    mapped = []
+    for (x, y, w, h) in boxes:
+        left = max(0, int(round(x * scale)))
+        top = max(0, int(round(y * scale)))
+        right = min(width, int(round((x + w) * scale)))
+        bottom = min(height, int(round((y + h) * scale)))
+        mapped.append((left, top, right - left, bottom - top))
+    return mapped
@@ -0,0 +1,32 @@
+import struct
+
+# Request body of length-prefixed frames: a 4-byte big-endian length, then
+# that many bytes of encoded image, repeated for as long as the client streams
+FRAME_STREAM_TYPE = 'application/x-frame-stream'
+
+
+def read_frame_stream(stream, max_frame_bytes):
+    """Yield encoded frames from a length-prefixed body as they arrive"""
+    while True:
+        header = stream.read(4)
+        if len(header) < 4:
+            return
+        (length,) = struct.unpack('>I', header)
+        if length > max_frame_bytes:
+            raise ValueError(f"Frame of {length} bytes exceeds the {max_frame_bytes} byte limit")
+        frame = stream.read(length)
+        if len(frame) < length:
+            return
+        yield frame
+
+
+def raw_frame_stream(request):
+    """Input to read an application/x-frame-stream request body from
+
+    A chunked (continuous) stream is read from the raw input so it is not
+    bound by MAX_CONTENT_LENGTH; each frame is capped by read_frame_stream()
+    instead.
+    """
+    if request.content_length is None and request.environ.get('wsgi.input_terminated'):
+        return request.environ['wsgi.input']
+    return request.stream
@@ -0,0 +1,96 @@
+import binascii
+
+import cv2
+import numpy as np
+
+# Request bodies sent as raw encoded images rather than base64 JSON
+RAW_IMAGE_TYPES = ('image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'image/bmp',
+                   'application/octet-stream')
+
+
+def decode_image_bytes(buffer):
+    """Decode an encoded image held in any bytes-like object without copying it"""
+    np_array = np.frombuffer(buffer, np.uint8)
+    if np_array.size == 0:
+        return None
+    return cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+
+
+def decode_image(image_data):
+    """Decode a base64 string (optionally a data: URL) or raw encoded bytes to cv2 format"""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return decode_image_bytes(image_data)
+
+    # One ASCII copy (as b64decode would make); the data URL header is then
+    # skipped through a memoryview so the payload is not copied again
+    data = image_data.encode('ascii')
+    start = 0
+    if b'data:image/' in data:
+        start = data.index(b',') + 1
+    return decode_image_bytes(binascii.a2b_base64(memoryview(data)[start:]))
+
+
+def _file_buffer(file_storage):
+    """Bytes of an uploaded multipart file, zero-copy when it is held in memory"""
+    stream = file_storage.stream
+    if hasattr(stream, 'getbuffer'):
+        return stream.getbuffer()
+    return stream.read()
+
+
+def read_image_request(request, image_field='image'):
+    """Extract (fields, image_data) from a JSON, raw-image or multipart request
+
+    - application/json: fields is the JSON object and image_data the base64
+      string in image_field
+    - image/* or application/octet-stream: image_data is the raw body and
+      fields come from the query string
+    - multipart/form-data: image_data is the uploaded file (or a base64 form
+      value) named image_field and fields come from the form and query string
+
+    image_data is None when the request carries no image. Oversized bodies
+    are rejected by Flask's MAX_CONTENT_LENGTH before they are read.
+    """
+    mimetype = request.mimetype or ''
+
+    if mimetype in RAW_IMAGE_TYPES:
+        body = request.get_data(cache=False)
+        return request.args.to_dict(), (body if body else None)
+
+    if mimetype == 'multipart/form-data':
+        fields = request.args.to_dict()
+        fields.update(request.form.to_dict())
+        if image_field in request.files:
+            return fields, _file_buffer(request.files[image_field])
+        return fields, fields.get(image_field)
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return {}, None
+    return payload, payload.get(image_field)
+
+
+def read_image_list_request(request, image_field='images'):
+    """Extract (fields, images) for batch endpoints
+
+    images is a list of base64 strings / {"image": ...} objects from JSON,
+    or the raw buffers of every multipart file named image_field. None when
+    the request carries no image list.
+    """
+    if (request.mimetype or '') == 'multipart/form-data':
+        fields = request.args.to_dict()
+        fields.update(request.form.to_dict())
+        files = request.files.getlist(image_field)
+        return fields, ([_file_buffer(file_storage) for file_storage in files] if files else None)
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get(image_field), list):
+        return payload if isinstance(payload, dict) else {}, None
+    return payload, payload[image_field]
+
+
+def is_true(value):
+    """Interpret a JSON boolean or a form/query string flag"""
+    if isinstance(value, str):
+        return value.lower() in ['true', '1', 't', 'yes']
+    return bool(value)
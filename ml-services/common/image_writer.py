@@ -0,0 +1,132 @@
+import atexit
+import collections
+import os
+import threading
+import time
+
+import cv2
+
+
+class ImageWriter:
+    """Bounded write-behind queue for audit images
+
+    Request handlers hand a frame to submit() and return immediately; JPEG
+    encoding and disk I/O happen on background worker threads. submit()
+    takes ownership of the array, so callers must not modify it afterwards
+    (pass a copy if the frame is still needed).
+
+    When the queue is full the policy decides what happens:
+    - 'drop_oldest': evict the oldest pending image to make room (default)
+    - 'drop_newest': discard the image being submitted
+    - 'block': wait up to block_timeout seconds for room, then discard
+    """
+
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, max_queue=64, workers=1, policy='drop_oldest', block_timeout=0.5):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown drop policy '{policy}', expected one of {self.POLICIES}")
+
+        self.max_queue = max_queue
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._stats = {
+            'submitted': 0,
+            'written': 0,
+            'dropped': 0,
+            'errors': 0,
+            'maxDepth': 0,
+            'writeTimeMs': 0.0
+        }
+
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'image-writer-{i}', daemon=True).start()
+        atexit.register(self.flush, 5.0)
+
+    def submit(self, path, image, params=None):
+        """Queue an image to be encoded and written to path; False if it was dropped"""
+        with self._condition:
+            self._stats['submitted'] += 1
+
+            if len(self._queue) >= self.max_queue:
+                if self.policy == 'drop_newest':
+                    self._stats['dropped'] += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self._stats['dropped'] += 1
+                else:
+                    deadline = time.monotonic() + self.block_timeout
+                    while len(self._queue) >= self.max_queue:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats['dropped'] += 1
+                            return False
+                        self._condition.wait(remaining)
+
+            self._queue.append((path, image, params or []))
+            self._stats['maxDepth'] = max(self._stats['maxDepth'], len(self._queue))
+            self._condition.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                path, image, params = self._queue.popleft()
+                self._in_flight += 1
+                # Wake producers blocked on a full queue
+                self._condition.notify_all()
+
+            start = time.perf_counter()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if not cv2.imwrite(path, image, params):
+                    raise IOError(f"cv2.imwrite returned False for {path}")
+                succeeded = True
+            except Exception as e:
+                print(f"Error writing image {path}: {e}")
+                succeeded = False
+            elapsed = time.perf_counter() - start
+
+            with self._condition:
+                self._in_flight -= 1
+                if succeeded:
+                    self._stats['written'] += 1
+                    self._stats['writeTimeMs'] += elapsed * 1000
+                else:
+                    self._stats['errors'] += 1
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every queued image has been written; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._queue or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        """Queue depth and write counters"""
+        with self._condition:
+            written = self._stats['written']
+            return {
+                'queueDepth': len(self._queue),
+                'inFlight': self._in_flight,
+                'capacity': self.max_queue,
+                'policy': self.policy,
+                'submitted': self._stats['submitted'],
+                'written': written,
+                'dropped': self._stats['dropped'],
+                'errors': self._stats['errors'],
+                'maxDepth': self._stats['maxDepth'],
+                'avgWriteMs': round(self._stats['writeTimeMs'] / written, 2) if written else 0.0
+            }
@@ -0,0 +1,100 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ModelRegistry:
+    """Process-wide registry of detectors that are loaded once at startup
+
+    Each model is registered with a factory and its arguments. The first
+    instance is built eagerly by register() so missing files fail at startup
+    rather than on the first request. OpenCV detectors are not safe to share
+    between concurrent callers, so request threads borrow an instance with
+    checkout() and hand it back when done. Idle instances are reused by
+    whichever thread asks next; a new one is built only when all are busy,
+    up to max_instances per model, after which callers wait for one to be
+    returned.
+    """
+
+    def __init__(self, max_instances=4):
+        self.max_instances = max_instances
+        self._lock = threading.Condition()
+        self._entries = {}
+
+    def register(self, name, factory, *args, max_instances=None):
+        """Load a model and make it available under name"""
+        start = time.perf_counter()
+        instance = factory(*args)
+        load_time = time.perf_counter() - start
+
+        if hasattr(instance, 'empty') and instance.empty():
+            raise RuntimeError(f"Model '{name}' failed to load")
+
+        with self._lock:
+            self._entries[name] = {
+                'factory': factory,
+                'args': args,
+                'maxInstances': max(1, max_instances or self.max_instances),
+                'idle': [instance],
+                'loadTimeMs': round(load_time * 1000, 2),
+                'instances': 1,
+                'hits': 0,
+                'waits': 0
+            }
+        print(f"Loaded model '{name}' in {load_time * 1000:.1f} ms")
+        return instance
+
+    def _acquire(self, name):
+        entry = self._entries[name]
+        with self._lock:
+            entry['hits'] += 1
+            waited = False
+            while not entry['idle']:
+                if entry['instances'] < entry['maxInstances']:
+                    # Reserve the slot, then build outside the lock
+                    entry['instances'] += 1
+                    break
+                if not waited:
+                    entry['waits'] += 1
+                    waited = True
+                self._lock.wait()
+            else:
+                return entry['idle'].pop()
+
+        try:
+            return entry['factory'](*entry['args'])
+        except Exception:
+            with self._lock:
+                entry['instances'] -= 1
+                self._lock.notify_all()
+            raise
+
+    def _release(self, name, instance):
+        entry = self._entries[name]
+        with self._lock:
+            entry['idle'].append(instance)
+            self._lock.notify_all()
+
+    @contextmanager
+    def checkout(self, name):
+        """Borrow an instance of a registered model for the duration of a with block"""
+        instance = self._acquire(name)
+        try:
+            yield instance
+        finally:
+            self._release(name, instance)
+
+    def stats(self):
+        """Load time, pool size, checkouts and waits for every model"""
+        with self._lock:
+            return {
+                name: {
+                    'loadTimeMs': entry['loadTimeMs'],
+                    'instances': entry['instances'],
+                    'maxInstances': entry['maxInstances'],
+                    'idle': len(entry['idle']),
+                    'hits': entry['hits'],
+                    'waits': entry['waits']
+                }
+                for name, entry in self._entries.items()
+            }
@@ -0,0 +1,129 @@
+import collections
+import copy
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+def dhash(image, hash_size=16):
+    """Difference hash of an image: one bit per horizontally adjacent pixel pair
+
+    The frame is reduced to a (hash_size + 1) x hash_size gray thumbnail, so
+    sensor noise and recompression barely change the hash while a moved
+    person or object flips many bits.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class ResultCache:
+    """Results of recent frames, keyed by perceptual hash and session
+
+    Monitoring clients often send nearly identical frames (a static
+    classroom, a student sitting still), so a frame whose hash is within
+    max_distance bits of one seen in the same session within ttl seconds
+    reuses that frame's result instead of running inference again.
+    Entries are evicted least recently used beyond max_entries.
+
+    Only the most recent hashes of each session are compared for near
+    matches; exact hashes are looked up directly. Requests without a
+    sessionId (or with 'unknown') are not cached.
+    """
+
+    def __init__(self, ttl=10.0, max_entries=1024, max_distance=4, recent_per_session=8):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.recent_per_session = recent_per_session
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # (namespace, session_id, hash) -> (expires, result)
+        self._recent = {}  # (namespace, session_id) -> deque of recent hashes
+        self._stats = {'hits': 0, 'nearHits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def get(self, namespace, session_id, frame_hash):
+        """Cached result for a near-identical frame of the session, or None"""
+        if not self._cacheable(session_id):
+            return None
+        now = time.monotonic()
+        with self._lock:
+            key = (namespace, session_id, frame_hash)
+            entry = self._live(key, now)
+            if entry is None and self.max_distance:
+                for recent in reversed(self._recent.get((namespace, session_id), ())):
+                    if recent != frame_hash and hamming(recent, frame_hash) <= self.max_distance:
+                        key = (namespace, session_id, recent)
+                        entry = self._live(key, now)
+                        if entry is not None:
+                            self._stats['nearHits'] += 1
+                            break
+
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            self._entries.move_to_end(key)
+            return copy.deepcopy(entry[1])
+
+    def put(self, namespace, session_id, frame_hash, result):
+        if not self._cacheable(session_id):
+            return
+        with self._lock:
+            key = (namespace, session_id, frame_hash)
+            self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(result))
+            self._entries.move_to_end(key)
+
+            recent = self._recent.setdefault((namespace, session_id),
+                                             collections.deque(maxlen=self.recent_per_session))
+            if frame_hash in recent:
+                recent.remove(frame_hash)
+            recent.append(frame_hash)
+
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def _cacheable(self, session_id):
+        # Frames without a real session are never shared between clients
+        return self.max_entries > 0 and session_id not in (None, '', 'unknown')
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < now:
+            self._drop(key)
+            self._stats['expired'] += 1
+            return None
+        return entry
+
+    def _drop(self, key):
+        del self._entries[key]
+        namespace, session_id, frame_hash = key
+        recent = self._recent.get((namespace, session_id))
+        if recent is not None:
+            if frame_hash in recent:
+                recent.remove(frame_hash)
+            if not recent:
+                del self._recent[(namespace, session_id)]
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                'entries': len(self._entries),
+                'capacity': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self._stats['hits'],
+                'nearHits': self._stats['nearHits'],
+                'misses': self._stats['misses'],
+                'evictions': self._stats['evictions'],
+                'expired': self._stats['expired'],
+                'hitRate': round(self._stats['hits'] / lookups, 3) if lookups else 0.0
+            }
+
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import time
+import uuid
+
+
+class SessionLeases:
+    """Which worker process holds each live session, shared through a directory
+
+    Live sessions (frame streams, face trackers) keep their state in the
+    memory of one worker process. Under a multi-process server the first
+    worker to see a session claims it with a lease file, renewed while the
+    session is in use; other workers refuse the session (the endpoints
+    answer 409) until the holder releases it or lets the lease lapse for
+    lease_seconds, e.g. because the worker died. Taking over a lapsed
+    lease is best effort: two workers racing for it may both succeed.
+    """
+
+    def __init__(self, directory, lease_seconds):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self._nonce = uuid.uuid4().hex
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def token(self):
+        # The pid keeps workers forked from one preloaded app apart
+        return f"{os.getpid()}-{self._nonce}"
+
+    def _path(self, session_id):
+        # Session ids are chosen by clients, so they never become file names directly
+        digest = hashlib.sha1(str(session_id).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{digest}.lease')
+
+    def _holder(self, path):
+        """(token, age in seconds) of a lease file, (None, None) if there is none"""
+        try:
+            with open(path, 'r') as f:
+                token = f.read()
+            return token, time.time() - os.path.getmtime(path)
+        except OSError:
+            return None, None
+
+    def claim(self, session_id):
+        """True if this process holds the session's lease, taking or renewing it"""
+        path = self._path(session_id)
+        token, age = self._holder(path)
+        if token == self.token:
+            if age > self.lease_seconds / 4:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            return True
+        if token and age < self.lease_seconds:
+            return False
+
+        tmp_path = f'{path}.{self.token}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.token)
+        os.replace(tmp_path, path)
+        return self._holder(path)[0] == self.token
+
+    def release(self, session_id):
+        """Give up the session's lease if this process holds it"""
+        path = self._path(session_id)
+        if self._holder(path)[0] == self.token:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
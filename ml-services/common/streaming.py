@@ -0,0 +1,286 @@
+import json
+import queue
+import threading
+import time
+
+from flask import Response, jsonify, request
+
+from common.frame_stream import FRAME_STREAM_TYPE, raw_frame_stream, read_frame_stream
+from common.image_input import read_image_request
+
+
+def format_event(event):
+    """Server-sent event for a result dict; None becomes a keep-alive comment"""
+    if event is None:
+        return ': keep-alive\n\n'
+    return f"data: {json.dumps(event)}\n\n"
+
+
+class SessionStream:
+    """Latest-frame slot, worker and subscribers of one session"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.condition = threading.Condition()
+        self.pending = None  # (frame, received_at), replaced by every newer frame
+        self.subscribers = []
+        self.closed = False
+        self.last_active = time.monotonic()
+        self.sequence = 0
+        self.stats = {'received': 0, 'processed': 0, 'superseded': 0, 'stale': 0, 'errors': 0}
+
+
+class StreamHub:
+    """Continuous per-session frame ingestion with server-side rate limiting
+
+    Clients push frames with submit(); each session keeps only the newest
+    unprocessed frame, so a frame that arrives while another is waiting
+    replaces it (counted as superseded). A worker thread per session
+    processes at most max_fps frames per second, discards frames older than
+    max_frame_age seconds (stale under load), and pushes each result to
+    every subscriber. A slow subscriber loses its oldest results rather than
+    holding the worker back. Sessions close after idle_timeout seconds
+    without frames or subscribers.
+
+    process(session_id, frame) receives the encoded frame and returns a
+    JSON-serialisable dict.
+
+    Sessions live in this process only. With leases (a SessionLeases shared
+    by every worker of the service) a session belongs to the worker that
+    first saw it, and owns() is False in the others, so requests routed to
+    the wrong worker are refused instead of starting a second session.
+    """
+
+    def __init__(self, process, max_fps=5.0, max_frame_age=2.0, idle_timeout=60.0,
+                 max_sessions=64, subscriber_queue=16, heartbeat=15.0, leases=None):
+        self.process = process
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.max_frame_age = max_frame_age
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.subscriber_queue = subscriber_queue
+        self.heartbeat = heartbeat
+        self.leases = leases
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._closed_stats = {}  # counters of streams that have ended
+
+    def _stream(self, session_id):
+        """The session's stream, started on first use; None if at capacity"""
+        with self._lock:
+            stream = self._streams.get(session_id)
+            if stream is None:
+                if len(self._streams) >= self.max_sessions:
+                    return None
+                stream = SessionStream(session_id)
+                self._streams[session_id] = stream
+                threading.Thread(target=self._run, args=(stream,),
+                                 name=f'stream-{session_id}', daemon=True).start()
+            return stream
+
+    def owns(self, session_id):
+        """False if another worker process holds the session"""
+        return self.leases is None or self.leases.claim(session_id)
+
+    def submit(self, session_id, frame):
+        """Queue a frame as the session's newest; False if no stream slot is free"""
+        stream = self._stream(session_id)
+        if stream is None:
+            return False
+        with stream.condition:
+            if stream.pending is not None:
+                stream.stats['superseded'] += 1
+            stream.pending = (frame, time.monotonic())
+            stream.stats['received'] += 1
+            stream.last_active = time.monotonic()
+            stream.condition.notify_all()
+        return True
+
+    def subscribe(self, session_id):
+        """Generator of result dicts for a session (None = keep-alive); None if at capacity"""
+        stream = self._stream(session_id)
+        if stream is None:
+            return None
+        results = queue.Queue(maxsize=self.subscriber_queue)
+        with stream.condition:
+            stream.subscribers.append(results)
+            stream.last_active = time.monotonic()
+
+        def events():
+            try:
+                # Keep-alive first so the response headers reach the client right away
+                yield None
+                while True:
+                    try:
+                        event = results.get(timeout=self.heartbeat)
+                    except queue.Empty:
+                        event = None
+                    if event is StopIteration:
+                        return
+                    yield event
+            finally:
+                with stream.condition:
+                    if results in stream.subscribers:
+                        stream.subscribers.remove(results)
+                    stream.last_active = time.monotonic()
+        return events()
+
+    def close(self, session_id):
+        with self._lock:
+            stream = self._streams.pop(session_id, None)
+        if self.leases is not None:
+            self.leases.release(session_id)
+        if stream is None:
+            return False
+        with stream.condition:
+            stream.closed = True
+            stream.condition.notify_all()
+        return True
+
+    def _publish(self, stream, event):
+        with stream.condition:
+            subscribers = list(stream.subscribers)
+        for results in subscribers:
+            while True:
+                try:
+                    results.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        results.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _next_frame(self, stream, last_processed):
+        """Wait for a frame that is due; None once the stream closes"""
+        with stream.condition:
+            while True:
+                now = time.monotonic()
+                if stream.closed:
+                    return None
+                if stream.pending is None:
+                    if not stream.subscribers and now - stream.last_active > self.idle_timeout:
+                        return None
+                    if self.leases is not None:
+                        # Subscribers alone keep the session, and its lease, alive
+                        self.leases.claim(stream.session_id)
+                    stream.condition.wait(self.idle_timeout)
+                    continue
+
+                # Rate limit: newer frames keep replacing the pending one meanwhile
+                due = last_processed + self.min_interval
+                if now < due:
+                    stream.condition.wait(due - now)
+                    continue
+
+                frame, received_at = stream.pending
+                stream.pending = None
+                if now - received_at > self.max_frame_age:
+                    stream.stats['stale'] += 1
+                    continue
+                return frame, received_at
+
+    def _run(self, stream):
+        last_processed = 0.0
+        try:
+            while True:
+                item = self._next_frame(stream, last_processed)
+                if item is None:
+                    break
+                frame, received_at = item
+                last_processed = time.monotonic()
+                try:
+                    result = self.process(stream.session_id, frame)
+                    stream.stats['processed'] += 1
+                except Exception as e:
+                    print(f"Error processing stream frame for {stream.session_id}: {e}")
+                    result = {'success': False, 'message': f'Error processing image: {str(e)}'}
+                    stream.stats['errors'] += 1
+                stream.sequence += 1
+                result['sequence'] = stream.sequence
+                result['latencyMs'] = round((time.monotonic() - received_at) * 1000, 1)
+                self._publish(stream, result)
+        finally:
+            with self._lock:
+                if self._streams.get(stream.session_id) is stream:
+                    del self._streams[stream.session_id]
+                    if self.leases is not None:
+                        self.leases.release(stream.session_id)
+                for key, value in stream.stats.items():
+                    self._closed_stats[key] = self._closed_stats.get(key, 0) + value
+            self._publish(stream, StopIteration)
+
+    def stats(self):
+        with self._lock:
+            streams = list(self._streams.values())
+            totals = dict(self._closed_stats)
+        totals.update({'sessions': len(streams), 'capacity': self.max_sessions})
+        for stream in streams:
+            for key, value in stream.stats.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+def add_stream_routes(app, url_prefix, hub, max_frame_bytes):
+    """Register the streaming endpoints of a service under url_prefix
+
+    - POST <prefix>/<sessionId>/frames: one frame (JSON, raw image or
+      multipart, like the other endpoints), or a continuous
+      application/x-frame-stream body of length-prefixed frames
+    - GET <prefix>/<sessionId>/events: server-sent events with one result
+      per processed frame
+    - DELETE <prefix>/<sessionId>: stop the session's stream
+
+    All three answer 409 in a worker process that does not hold the session.
+    """
+
+    def unavailable():
+        return jsonify({'success': False, 'message': 'Too many active streams'}), 503
+
+    def elsewhere():
+        return jsonify({'success': False,
+                        'message': 'Session is held by another worker process; route it to one worker'}), 409
+
+    def post_frames(session_id):
+        if not hub.owns(session_id):
+            return elsewhere()
+        accepted = 0
+        try:
+            if request.mimetype == FRAME_STREAM_TYPE:
+                for frame in read_frame_stream(raw_frame_stream(request), max_frame_bytes):
+                    if not hub.submit(session_id, frame):
+                        return unavailable()
+                    accepted += 1
+            else:
+                _, image_data = read_image_request(request)
+                if image_data is None:
+                    return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+                # Multipart buffers are only valid during the request
+                frame = bytes(image_data) if isinstance(image_data, memoryview) else image_data
+                if not hub.submit(session_id, frame):
+                    return unavailable()
+                accepted = 1
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e), 'accepted': accepted}), 413
+        return jsonify({'success': True, 'message': 'Frames accepted', 'accepted': accepted}), 202
+
+    def get_events(session_id):
+        if not hub.owns(session_id):
+            return elsewhere()
+        events = hub.subscribe(session_id)
+        if events is None:
+            return unavailable()
+        return Response((format_event(event) for event in events), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    def close_stream(session_id):
+        if not hub.owns(session_id):
+            return elsewhere()
+        if not hub.close(session_id):
+            return jsonify({'success': False, 'message': 'Unknown stream'}), 404
+        return jsonify({'success': True, 'message': 'Stream closed'})
+
+    endpoint = url_prefix.strip('/').replace('/', '_').replace('-', '_')
+    app.add_url_rule(f'{url_prefix}/<session_id>/frames', f'{endpoint}_frames', post_frames, methods=['POST'])
+    app.add_url_rule(f'{url_prefix}/<session_id>/events', f'{endpoint}_events', get_events, methods=['GET'])
+    app.add_url_rule(f'{url_prefix}/<session_id>', f'{endpoint}_close', close_stream, methods=['DELETE'])
@@ -0,0 +1,158 @@
+import math
+import time
+
+import numpy as np
+
+
+def squared_distances(vectors, vector_norms, queries):
+    """Squared Euclidean distances between every query and every vector"""
+    queries = np.atleast_2d(queries)
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+    squared = query_norms[:, None] + vector_norms[None, :] - 2.0 * (queries @ vectors.T)
+    np.maximum(squared, 0.0, out=squared)
+    return squared
+
+
+class IVFIndex:
+    """Inverted-file (IVF) approximate nearest-neighbour index over gallery rows
+
+    Templates are clustered with k-means into n_lists coarse cells. A query
+    is compared to the cell centroids first and only the rows in the
+    n_probe closest cells are returned as candidates, which the gallery then
+    re-ranks with exact distances. Cost per query is roughly
+    n_lists + n_probe * N / n_lists distance computations instead of N.
+
+    Knobs:
+    - n_lists: number of cells (defaults to about sqrt(N) at training time)
+    - n_probe: cells searched per query; higher means better recall and
+      higher latency
+    - min_candidates: keep probing further cells until at least this many
+      rows are collected, so sparse cells do not starve the re-rank
+    - max_train_samples / max_train_bytes: cap on the k-means sample, in
+      rows and in float32 bytes, so wide templates do not blow up memory
+    """
+
+    def __init__(self, n_lists=None, n_probe=8, min_candidates=64, train_iterations=10,
+                 max_train_per_list=64, max_train_samples=16384, max_train_bytes=128 * 1024 * 1024,
+                 seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_candidates = min_candidates
+        self.train_iterations = train_iterations
+        self.max_train_per_list = max_train_per_list
+        self.max_train_samples = max_train_samples
+        self.max_train_bytes = max_train_bytes
+        self.seed = seed
+
+        self.centroids = None
+        self._centroid_norms = None
+        self._count = 0
+        self._assignments = np.empty(0, dtype=np.int32)
+        self.train_time = None
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        return self._count
+
+    def _assign(self, vectors, chunk_size=1024):
+        """Nearest centroid of every vector, computed in chunks to bound memory"""
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+            squared = squared_distances(self.centroids, self._centroid_norms, chunk)
+            assignments[start:start + chunk_size] = np.argmin(squared, axis=1)
+        return assignments
+
+    def train(self, templates):
+        """Cluster the gallery with k-means and assign every existing row to a cell
+
+        templates may be float or integer codes; only the training sample and
+        one assignment chunk at a time are converted to float32.
+        """
+        start_time = time.perf_counter()
+        count = len(templates)
+        if count == 0:
+            raise ValueError("Cannot train an index on an empty gallery")
+
+        n_lists = self.n_lists or max(1, int(math.sqrt(count)))
+        n_lists = min(n_lists, count)
+        rng = np.random.default_rng(self.seed)
+
+        # k-means on a bounded sample keeps training time and memory independent of
+        # gallery size; it always keeps at least one row per cell
+        row_bytes = 4 * int(np.prod(templates.shape[1:]))
+        sample_size = min(n_lists * self.max_train_per_list, self.max_train_samples,
+                          self.max_train_bytes // max(row_bytes, 1))
+        sample_size = min(count, max(n_lists, sample_size))
+        sample = np.asarray(templates[np.sort(rng.choice(count, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(self.train_iterations):
+            norms = np.einsum('ij,ij->i', centroids, centroids)
+            labels = np.argmin(squared_distances(centroids, norms, sample), axis=1)
+            # Per-cell sums as one matrix product instead of a scatter-add
+            membership = np.zeros((n_lists, sample_size), dtype=np.float32)
+            membership[labels, np.arange(sample_size)] = 1.0
+            sums = membership @ sample
+            sizes = np.bincount(labels, minlength=n_lists)
+            filled = sizes > 0
+            centroids[filled] = sums[filled] / sizes[filled, None]
+            # Re-seed empty cells from random sample points
+            if not filled.all():
+                centroids[~filled] = sample[rng.choice(sample_size, int((~filled).sum()))]
+
+        self.n_lists = n_lists
+        self.centroids = centroids
+        self._centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self._count = 0
+        self._assignments = np.empty(0, dtype=np.int32)
+        self.add_many(templates)
+        self.train_time = time.perf_counter() - start_time
+
+    def add_many(self, vectors):
+        """Append rows to the index (rows must be added in gallery order)"""
+        if not self.trained or len(vectors) == 0:
+            return
+        assignments = self._assign(vectors)
+        end = self._count + len(assignments)
+        if end > len(self._assignments):
+            grown = np.empty(max(end, len(self._assignments) * 2, 16), dtype=np.int32)
+            grown[:self._count] = self._assignments[:self._count]
+            self._assignments = grown
+        self._assignments[self._count:end] = assignments
+        self._count = end
+
+    def add(self, vector):
+        self.add_many(np.asarray(vector, dtype=np.float32)[None, :])
+
+    def candidates(self, query, n_probe=None):
+        """Gallery rows in the cells closest to the query"""
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        squared = squared_distances(self.centroids, self._centroid_norms,
+                                    np.asarray(query, dtype=np.float32))[0]
+        cell_order = np.argsort(squared)
+        assignments = self._assignments[:self._count]
+        sizes = np.bincount(assignments, minlength=self.n_lists)
+
+        # Probe at least n_probe cells, more if they hold too few rows
+        covered = np.cumsum(sizes[cell_order])
+        enough = int(np.searchsorted(covered, min(self.min_candidates, self._count))) + 1
+        probe = cell_order[:max(n_probe, enough)]
+        return np.flatnonzero(np.isin(assignments, probe))
+
+    def stats(self):
+        if not self.trained:
+            return {'trained': False, 'size': self._count}
+        sizes = np.bincount(self._assignments[:self._count], minlength=self.n_lists)
+        return {
+            'trained': True,
+            'size': self._count,
+            'lists': self.n_lists,
+            'probe': self.n_probe,
+            'minCandidates': self.min_candidates,
+            'largestList': int(sizes.max()),
+            'trainTimeMs': round(self.train_time * 1000, 2)
+        }
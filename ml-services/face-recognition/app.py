@@ -2,122 +2,348 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
 import numpy as np
-import cv2
 import json
-import base64
 import math
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from ann_index import IVFIndex
+from encoding_store import EncodingStore
+from engine import FACE_SIZE, FaceEngine, draw_matches, ensure_face_cascade, face_crop
+from enrollment import is_archive
+from gallery import FaceGallery
+from projection import FaceProjection
+from prefilter import SignaturePrefilter, prefix_signature, thumbnail_signature
+from prototypes import select_medoids
+from snapshots import GallerySnapshot, SnapshotRegistry, parse_encoding_items
+from quality import QualityGate, rejection_message
+from tracking import TrackerRegistry
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.detection import detect_scaled
+from common.image_input import decode_image, is_true, read_image_list_request, read_image_request
+from common.image_writer import ImageWriter
+from common.result_cache import ResultCache, dhash
+from common.session_leases import SessionLeases
+from common.streaming import StreamHub, add_stream_routes
+
 app = Flask(__name__)
 CORS(app)
 
+# Request bodies larger than this are rejected with 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+
 # Configuration
 MODEL_PATH = os.environ.get('MODEL_PATH', 'models')
 DATA_PATH = os.environ.get('DATA_PATH', 'data')
 
+# Approximate nearest-neighbour index, built once the gallery reaches ANN_MIN_GALLERY templates
+ANN_ENABLED = os.environ.get('ANN_ENABLED', 'true').lower() in ['true', '1', 't']
+ANN_MIN_GALLERY = int(os.environ.get('ANN_MIN_GALLERY', 5000))
+ANN_LISTS = int(os.environ.get('ANN_LISTS', 0)) or None  # 0 = about sqrt(gallery size)
+ANN_PROBE = int(os.environ.get('ANN_PROBE', 8))
+ANN_MIN_CANDIDATES = int(os.environ.get('ANN_MIN_CANDIDATES', 64))
+ANN_TRAIN_MB = int(os.environ.get('ANN_TRAIN_MB', 128))  # memory for the k-means training sample
+
+# Coarse-to-fine matching for galleries of PREFILTER_MIN_GALLERY templates or more
+# (below the ANN index threshold): a 20x20 thumbnail of each crop (or the first
+# PREFILTER_PREFIX_DIMS projected components) picks the PREFILTER_CANDIDATES
+# / PREFILTER_RATIO closest rows for full-resolution distances, and
+# PREFILTER_AUDIT_RATE of searches are checked against an exhaustive scan
+PREFILTER_ENABLED = os.environ.get('PREFILTER_ENABLED', 'true').lower() in ['true', '1', 't']
+PREFILTER_MIN_GALLERY = int(os.environ.get('PREFILTER_MIN_GALLERY', 1000))
+PREFILTER_SIGNATURE_SIDE = int(os.environ.get('PREFILTER_SIGNATURE_SIDE', 20))
+PREFILTER_PREFIX_DIMS = int(os.environ.get('PREFILTER_PREFIX_DIMS', 16))
+PREFILTER_CANDIDATES = int(os.environ.get('PREFILTER_CANDIDATES', 256))
+PREFILTER_RATIO = float(os.environ.get('PREFILTER_RATIO', 0.02))
+PREFILTER_AUDIT_RATE = float(os.environ.get('PREFILTER_AUDIT_RATE', 0.02))
+
+# Face detection runs at a bounded working width and boxes are mapped back to
+# full resolution; group photos get a wider working width so small faces survive
+DETECTION_WIDTH = int(os.environ.get('DETECTION_WIDTH', 640))
+GROUP_DETECTION_WIDTH = int(os.environ.get('GROUP_DETECTION_WIDTH', 1280))
+DETECTION_MIN_FACE = int(os.environ.get('DETECTION_MIN_FACE', 24))
+DETECTION_MAX_FACE = int(os.environ.get('DETECTION_MAX_FACE', 0))
+
+# Batch verification: maximum images per request and decode/detect worker threads
+MAX_VERIFY_BATCH = int(os.environ.get('MAX_VERIFY_BATCH', 64))
+VERIFY_WORKERS = int(os.environ.get('VERIFY_WORKERS', os.cpu_count() or 4))
+
+# When /api/face/verify is given a claimed studentId it checks only that
+# student's templates. The fallback policy decides when it also runs a full
+# 1:N search: 'none', 'unenrolled' (claimed student has no templates) or
+# 'mismatch' (unenrolled, or the face does not match the claimed student)
+VERIFY_FALLBACK = os.environ.get('VERIFY_FALLBACK', 'none')
+VERIFY_FALLBACK_POLICIES = ['none', 'unenrolled', 'mismatch']
+
+# Live session tracking (/api/face/track): full-frame detection every
+# TRACK_DETECT_INTERVAL frames, certain identities re-matched every
+# TRACK_REVERIFY_INTERVAL frames
+TRACK_DETECT_INTERVAL = int(os.environ.get('TRACK_DETECT_INTERVAL', 10))
+TRACK_REVERIFY_INTERVAL = int(os.environ.get('TRACK_REVERIFY_INTERVAL', 30))
+TRACK_IOU_THRESHOLD = float(os.environ.get('TRACK_IOU_THRESHOLD', 0.3))
+TRACK_MAX_MISSES = int(os.environ.get('TRACK_MAX_MISSES', 2))
+TRACK_MARGIN = float(os.environ.get('TRACK_MARGIN', 5.0))
+TRACK_SESSION_TTL = int(os.environ.get('TRACK_SESSION_TTL', 300))
+MAX_TRACKED_SESSIONS = int(os.environ.get('MAX_TRACKED_SESSIONS', 256))
+
+# Quality gate: faces narrower than QUALITY_MIN_FACE pixels, blurrier than
+# QUALITY_MIN_SHARPNESS (Laplacian variance of the crop), more asymmetric
+# than QUALITY_MAX_ASYMMETRY (turned away) or, for single-face verification,
+# further off-centre than QUALITY_MAX_OFFSET are rejected before matching
+QUALITY_GATE_ENABLED = os.environ.get('QUALITY_GATE_ENABLED', 'true').lower() in ['true', '1', 't']
+QUALITY_MIN_FACE = int(os.environ.get('QUALITY_MIN_FACE', 40))
+QUALITY_MIN_SHARPNESS = float(os.environ.get('QUALITY_MIN_SHARPNESS', 25))
+QUALITY_MAX_ASYMMETRY = float(os.environ.get('QUALITY_MAX_ASYMMETRY', 0.3))
+QUALITY_MAX_OFFSET = float(os.environ.get('QUALITY_MAX_OFFSET', 0.35))
+
+# Streaming ingestion: frames processed per session per second, age after
+# which a waiting frame is dropped, idle seconds before a stream closes
+STREAM_MAX_FPS = float(os.environ.get('STREAM_MAX_FPS', 5))
+STREAM_MAX_FRAME_AGE = float(os.environ.get('STREAM_MAX_FRAME_AGE', 2))
+STREAM_IDLE_TIMEOUT = float(os.environ.get('STREAM_IDLE_TIMEOUT', 60))
+MAX_STREAM_SESSIONS = int(os.environ.get('MAX_STREAM_SESSIONS', 64))
+
+# Results of near-identical frames of a session are reused for RESULT_CACHE_TTL
+# seconds; RESULT_CACHE_DISTANCE is the dHash bit tolerance, size 0 disables it
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 10))
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+RESULT_CACHE_DISTANCE = int(os.environ.get('RESULT_CACHE_DISTANCE', 4))
+
+# Gallery maintenance: students with more than GALLERY_MAX_PROTOTYPES templates
+# are reduced to that many medoids (originals kept in data/gallery/archive),
+# on demand or every GALLERY_CONSOLIDATE_INTERVAL seconds (0 = never)
+GALLERY_MAX_PROTOTYPES = int(os.environ.get('GALLERY_MAX_PROTOTYPES', 5))
+GALLERY_CONSOLIDATE_INTERVAL = int(os.environ.get('GALLERY_CONSOLIDATE_INTERVAL', 0))
+
+# Bulk enrollment: worker processes per import (0 = one per CPU) and the
+# largest archive accepted as a raw request body
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 0)) or None
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+ARCHIVE_TYPES = ('application/zip', 'application/x-zip-compressed', 'application/x-tar',
+                 'application/gzip', 'application/x-gzip')
+
+# Optional eigenface projection fitted offline with projection.py
+FACE_PROJECTION_PATH = os.environ.get('FACE_PROJECTION_PATH', os.path.join(MODEL_PATH, 'face_projection.npz'))
+
 # Ensure directories exist
 os.makedirs(MODEL_PATH, exist_ok=True)
 os.makedirs(DATA_PATH, exist_ok=True)
 os.makedirs(os.path.join(DATA_PATH, 'faces'), exist_ok=True)
 os.makedirs(os.path.join(DATA_PATH, 'groups'), exist_ok=True)
 
-# In-memory database for faces (in production, use a real database)
-face_encodings = {}
-try:
-    if os.path.exists(os.path.join(DATA_PATH, 'face_encodings.json')):
-        with open(os.path.join(DATA_PATH, 'face_encodings.json'), 'r') as f:
-            face_encodings = json.load(f)
-except Exception as e:
-    print(f"Error loading face encodings: {e}")
-    face_encodings = {}
-
-def save_encodings():
-    """Save face encodings to file"""
+# Audit images are encoded and written by a background writer, off the request thread
+image_writer = ImageWriter(
+    max_queue=int(os.environ.get('AUDIT_QUEUE_SIZE', 64)),
+    policy=os.environ.get('AUDIT_DROP_POLICY', 'drop_oldest')
+)
+
+# Binary template store (replaces face_encodings.json, which is migrated on first start)
+encoding_store = EncodingStore(os.path.join(DATA_PATH, 'gallery'), dim=FACE_SIZE[0] * FACE_SIZE[1])
+legacy_encodings_path = os.path.join(DATA_PATH, 'face_encodings.json')
+if os.path.exists(legacy_encodings_path) and encoding_store.total_rows == 0:
     try:
-        with open(os.path.join(DATA_PATH, 'face_encodings.json'), 'w') as f:
-            json.dump(face_encodings, f)
+        imported = encoding_store.import_json(legacy_encodings_path)
+        print(f"Migrated {imported} face encodings from {legacy_encodings_path}")
     except Exception as e:
-        print(f"Error saving face encodings: {e}")
-
-def process_image(image_data):
-    """Process base64 image data to cv2 format"""
-    if 'data:image/' in image_data:
-        # Split the base64 string in data and type
-        image_data = image_data.split(',')[1]
-
-    # Decode base64 image
-    image_bytes = base64.b64decode(image_data)
-    np_array = np.frombuffer(image_bytes, np.uint8)
-    image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-
-    return image
-
-# Function to replace face_recognition functionality with OpenCV
-def detect_faces(image):
-    """Detect faces in an image using OpenCV instead of face_recognition"""
-    # Convert to grayscale for face detection
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    # Load the face detection model
-    face_cascade_path = os.path.join(MODEL_PATH, 'haarcascade_frontalface_default.xml')
-
-    # If the model doesn't exist, download it from opencv's github
-    if not os.path.exists(face_cascade_path):
-        print("Downloading face cascade model...")
-        os.makedirs(os.path.dirname(face_cascade_path), exist_ok=True)
-        import urllib.request
-        urllib.request.urlretrieve(
-            "https://raw.githubusercontent.com/opencv/opencv/master/data/haarcascades/haarcascade_frontalface_default.xml",
-            face_cascade_path
-        )
-
-    # Load cascade classifier
-    face_cascade = cv2.CascadeClassifier(face_cascade_path)
+        print(f"Error migrating face encodings: {e}")
+encoding_store.maybe_compact()
 
-    # Detect faces
-    faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+# Cold storage for the original templates replaced by prototypes; never matched against
+template_archive = EncodingStore(os.path.join(DATA_PATH, 'gallery', 'archive'), dim=encoding_store.dim,
+                                 dtype=encoding_store.dtype, scale=encoding_store.scale)
 
-    # Convert to face_recognition format (top, right, bottom, left)
-    face_locations = []
-    for (x, y, w, h) in faces:
-        face_locations.append((y, x+w, y+h, x))
-
-    return face_locations
-
-def encode_face(image, face_location):
-    """Create a simplified face encoding using OpenCV"""
-    # Extract face from the image
-    top, right, bottom, left = face_location
-    face_image = image[top:bottom, left:right]
-
-    # Resize to a standard size
-    face_image = cv2.resize(face_image, (100, 100))
-
-    # Convert to grayscale
-    gray_face = cv2.cvtColor(face_image, cv2.COLOR_BGR2GRAY)
-
-    # Flatten the image as a simple "encoding"
-    # Note: This is a very simplified approach and not as robust as face_recognition's encodings
-    encoding = gray_face.flatten() / 255.0  # Normalize
-
-    return encoding
-
-def compare_faces(known_encoding, face_encoding, tolerance=0.6):
-    """Compare faces using a simple Euclidean distance"""
-    # Calculate Euclidean distance
-    distance = np.linalg.norm(np.array(known_encoding) - np.array(face_encoding))
+def load_projection():
+    """Load the fitted projection, or None to match raw encodings"""
+    if not os.path.exists(FACE_PROJECTION_PATH):
+        return None
+    try:
+        loaded = FaceProjection.load(FACE_PROJECTION_PATH)
+        print(f"Loaded face projection {loaded.version}")
+        return loaded
+    except Exception as e:
+        print(f"Error loading face projection, matching raw encodings: {e}")
+        return None
+
+projection = load_projection()
+
+def load_gallery(active_projection):
+    """Build the matching gallery from the template store
+
+    Returns the gallery and the number of store rows it covers.
+    """
+    row_students = encoding_store.row_students()
+    if active_projection is None:
+        # Stored uint8 rows are already the gallery's codes (pixel values), so
+        # the gallery maps the template file instead of copying it and every
+        # worker process shares one copy through the page cache
+        loaded = FaceGallery(dim=encoding_store.dim, dtype=encoding_store.dtype, scale=encoding_store.scale)
+        loaded.map_codes(encoding_store.templates(), row_students)
+    else:
+        # Raw crops stay in the store; the gallery holds their projection as int8 codes
+        projected = active_projection.project_store(encoding_store, os.path.join(DATA_PATH, 'gallery', 'projected'))
+        loaded = FaceGallery(dim=active_projection.dim, space=active_projection.version,
+                             dtype='int8', scale=active_projection.code_scale)
+        rows = [row for row, student_id in enumerate(row_students) if student_id is not None]
+        loaded.add_many([row_students[row] for row in rows], projected[rows])
+    return loaded, len(row_students)
+
+def to_gallery_space(encoding):
+    """Map a raw encode_face() encoding into the gallery's encoding space"""
+    if projection is None:
+        return encoding
+    return projection.project(encoding)
+
+def match_space():
+    return 'raw' if projection is None else projection.version
+
+# OpenCV releases the GIL while decoding and detecting, so threads scale across cores
+verify_pool = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix='verify')
+
+# Named, versioned galleries uploaded by clients for /api/face/identify-multiple
+snapshots = SnapshotRegistry(os.path.join(DATA_PATH, 'snapshots'))
+
+# Face tracks of live sessions, kept per worker process; workers of a
+# multi-process server share ownership of sessions through lease files
+trackers = TrackerRegistry(
+    ttl=TRACK_SESSION_TTL,
+    max_sessions=MAX_TRACKED_SESSIONS,
+    leases=SessionLeases(os.path.join(DATA_PATH, 'sessions', 'face-track'), TRACK_SESSION_TTL),
+    detect_interval=TRACK_DETECT_INTERVAL,
+    iou_threshold=TRACK_IOU_THRESHOLD,
+    max_misses=TRACK_MAX_MISSES,
+    reverify_interval=TRACK_REVERIFY_INTERVAL,
+    margin=TRACK_MARGIN
+)
+
+# Rejects faces that cannot match before they are encoded and searched
+quality_gate = QualityGate(min_face=QUALITY_MIN_FACE, min_sharpness=QUALITY_MIN_SHARPNESS,
+                           max_asymmetry=QUALITY_MAX_ASYMMETRY, max_offset=QUALITY_MAX_OFFSET,
+                           enabled=QUALITY_GATE_ENABLED)
+
+# Detection and encoding pipeline; the face cascade is loaded once at startup
+# and request threads borrow pooled instances
+face_cascade_path = ensure_face_cascade(MODEL_PATH)
+engine = FaceEngine(face_cascade_path, detection_width=DETECTION_WIDTH, min_face=DETECTION_MIN_FACE,
+                    max_face=DETECTION_MAX_FACE, quality_gate=quality_gate)
+
+# Face analyses of recent frames, keyed by perceptual hash and session
+result_cache = ResultCache(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_SIZE,
+                           max_distance=RESULT_CACHE_DISTANCE)
+
+def build_ann_index(target):
+    """Attach a freshly trained approximate index to a gallery"""
+    target.build_index(IVFIndex(n_lists=ANN_LISTS, n_probe=ANN_PROBE,
+                                min_candidates=ANN_MIN_CANDIDATES,
+                                max_train_bytes=ANN_TRAIN_MB * 1024 * 1024))
+    print(f"Built ANN index: {target.index.stats()}")
+
+# Contiguous matrix of every registered template used for matching. Under a
+# multi-process server each worker follows registrations made by any worker
+# through the store's commit counter (see sync_gallery)
+gallery_lock = threading.Lock()
+gallery = None
+gallery_rows = 0  # store rows of the current generation covered by the gallery
+
+def build_prefilter(target, active_projection):
+    """Attach signatures for coarse-to-fine matching to a gallery"""
+    if active_projection is None:
+        signature = thumbnail_signature(FACE_SIZE[0], PREFILTER_SIGNATURE_SIDE)
+    else:
+        signature = prefix_signature(PREFILTER_PREFIX_DIMS)
+    target.build_prefilter(SignaturePrefilter(signature, min_candidates=PREFILTER_CANDIDATES,
+                                              ratio=PREFILTER_RATIO, audit_rate=PREFILTER_AUDIT_RATE))
+
+def wants_prefilter(target):
+    return PREFILTER_ENABLED and target.prefilter is None and len(target) >= PREFILTER_MIN_GALLERY
+
+def install_gallery(active_projection):
+    """Build a gallery (and ANN index) and swap it in for matching (caller holds gallery_lock)"""
+    global projection, gallery, gallery_rows
+    loaded, rows = load_gallery(active_projection)
+    if ANN_ENABLED and len(loaded) >= ANN_MIN_GALLERY:
+        build_ann_index(loaded)
+    if wants_prefilter(loaded):
+        build_prefilter(loaded, active_projection)
+    projection, gallery, gallery_rows = active_projection, loaded, rows
+
+def extend_gallery(records):
+    """Add the rows of consecutive 'add' records to the gallery (caller holds gallery_lock)"""
+    global gallery_rows
+    if not records:
+        return
+    student_ids = [record['studentId'] for record in records]
+    rows = [record['row'] for record in records]
+    templates = encoding_store.templates()
+    if projection is None:
+        gallery.map_codes(templates, student_ids)
+    else:
+        gallery.add_many(student_ids, projection.project(encoding_store.decode(templates[rows])))
+    gallery_rows = rows[-1] + 1
+
+def sync_gallery():
+    """Apply registrations committed by any worker process since the last sync
+
+    Costs one memory read when nothing changed. After another worker
+    compacts the store or reloads the projection the gallery is rebuilt
+    and swapped in.
+    """
+    if not encoding_store.has_changes():
+        return
+    with gallery_lock:
+        records = encoding_store.refresh()
+        if records is None:
+            install_gallery(projection)
+            return
+        spaces = [record['version'] for record in records if record['op'] == 'projection']
+        if spaces and spaces[-1] != match_space():
+            install_gallery(load_projection())
+            return
+        records = [record for record in records if record['op'] != 'projection']
+
+        added = []
+        for record in records:
+            if record['op'] == 'add':
+                # Rows loaded with the gallery are already in it
+                if record['row'] >= gallery_rows:
+                    added.append(record)
+            else:
+                extend_gallery(added)
+                added = []
+                gallery.drop_student(record['studentId'])
+        extend_gallery(added)
 
-    # Lower distance = more similar
-    # Convert to a similar scale as face_recognition (where lower tolerance = stricter)
-    # A typical tolerance might be 0.6
-    match = distance < (1 - tolerance) * 100
+        if ANN_ENABLED and gallery.index is None and len(gallery) >= ANN_MIN_GALLERY:
+            build_ann_index(gallery)
+        if wants_prefilter(gallery):
+            build_prefilter(gallery, projection)
 
-    return [match]
+with gallery_lock:
+    encoding_store.refresh()
+    install_gallery(projection)
 
-def detect_face_liveness(image):
-    """Basic liveness detection to prevent photo spoofing"""
+def process_image(image_data):
+    """Process base64 image data or raw encoded image bytes to cv2 format"""
+    return decode_image(image_data)
+
+def quality_rejection(quality):
+    """Response body for a face that failed the quality gate"""
+    return {
+        'success': False,
+        'message': rejection_message(quality['reasons']),
+        'reasons': quality['reasons'],
+        'quality': quality['metrics']
+    }
+
+def detect_face_liveness(frame):
+    """Basic liveness detection to prevent photo spoofing (frame is a FrameAnalysis)"""
     # In this simplified version, we'll just check if there's a face
-    face_locations = detect_faces(image)
+    face_locations = frame.face_locations
 
     if len(face_locations) == 0:
         return False, "No face detected"
@@ -129,18 +355,19 @@ def detect_face_liveness(image):
 @app.route('/api/face/register', methods=['POST'])
 def register_face():
     """Register a face for a student"""
-    if not request.json or 'studentId' not in request.json or 'image' not in request.json:
+    fields, image_data = read_image_request(request)
+    if image_data is None or 'studentId' not in fields:
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
 
-    student_id = request.json['studentId']
-    image_data = request.json['image']
+    student_id = fields['studentId']
 
     try:
         # Process the image
         image = process_image(image_data)
 
         # Check if there's exactly one face in the image
-        face_locations = detect_faces(image)
+        frame = engine.analyze(image)
+        face_locations = frame.face_locations
 
         if len(face_locations) == 0:
             return jsonify({'success': False, 'message': 'No face detected'}), 400
@@ -148,56 +375,73 @@ def register_face():
             return jsonify({'success': False, 'message': 'Multiple faces detected'}), 400
 
         # Get face encoding
-        face_encoding = encode_face(image, face_locations[0])
-
-        # Convert numpy array to list for JSON serialization
-        face_encoding_list = face_encoding.tolist()
+        face_encoding = frame.encoding(0)
 
-        # Store the encoding
-        if student_id not in face_encodings:
-            face_encodings[student_id] = []
-
-        face_encodings[student_id].append(face_encoding_list)
-
-        # Save the encodings to file
-        save_encodings()
+        # Persist the encoding (an O(1) append) and make it available for matching;
+        # the gallery inserts it into the ANN index incrementally when one is built
+        encoding_store.append(student_id, face_encoding)
+        sync_gallery()
 
         # Save the face image for reference
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         image_filename = f"{student_id}_{timestamp}.jpg"
-        cv2.imwrite(os.path.join(DATA_PATH, 'faces', image_filename), image)
+        image_writer.submit(os.path.join(DATA_PATH, 'faces', image_filename), image)
 
         return jsonify({
             'success': True,
             'message': 'Face registered successfully',
-            'faceCount': len(face_encodings[student_id])
+            'faceCount': encoding_store.count(student_id)
         })
 
     except Exception as e:
         print(f"Error registering face: {e}")
         return jsonify({'success': False, 'message': f'Error processing image: {str(e)}'}), 500
 
+def parse_top_k(fields):
+    """topK field of a verification request, None unless it is a whole number of at least 1"""
+    try:
+        top_k = int(fields.get('topK', 5))
+    except (TypeError, ValueError):
+        return None
+    return top_k if top_k >= 1 else None
+
 @app.route('/api/face/verify', methods=['POST'])
 def verify_face():
-    """Verify a face against registered faces"""
-    if not request.json or 'image' not in request.json:
+    """Verify a face against registered faces
+
+    With 'studentId' the face is checked 1:1 against that student's
+    templates; 'fallback' (default VERIFY_FALLBACK) chooses when a full 1:N
+    search runs instead. Without it the face is identified 1:N.
+    """
+    fields, image_data = read_image_request(request)
+    if image_data is None:
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
 
-    image_data = request.json['image']
+    claimed_id = fields.get('studentId')
+    fallback = fields.get('fallback', VERIFY_FALLBACK)
+    if fallback not in VERIFY_FALLBACK_POLICIES:
+        return jsonify({
+            'success': False,
+            'message': f"Unknown fallback policy '{fallback}', expected one of {VERIFY_FALLBACK_POLICIES}"
+        }), 400
+
+    top_k = parse_top_k(fields)
+    if top_k is None:
+        return jsonify({'success': False, 'message': 'topK must be a whole number of at least 1'}), 400
 
     try:
         # Process the image
         image = process_image(image_data)
 
-        # Perform liveness detection to prevent spoofing
-        is_live, liveness_message = detect_face_liveness(image)
+        # Perform liveness detection to prevent spoofing; the detection it
+        # runs is reused below
+        frame = engine.analyze(image)
+        is_live, liveness_message = detect_face_liveness(frame)
         if not is_live:
             return jsonify({'success': False, 'message': liveness_message}), 400
 
         # Get face locations and encodings
-        face_locations = detect_faces(image)
-
-        face_count = len(face_locations)
+        face_count = frame.face_count
 
         if face_count == 0:
             return jsonify({'success': False, 'message': 'No face detected'}), 400
@@ -209,54 +453,309 @@ def verify_face():
                 'faceQuality': 'unknown'
             }), 400
 
-        face_encoding = encode_face(image, face_locations[0])
+        # Tiny, blurry, turned or off-centre faces are rejected before the
+        # gallery search, which could only fail on them
+        quality = frame.quality(check_centering=True)[0]
+        if not quality['passed']:
+            return jsonify(quality_rejection(quality)), 400
+
+        face_encoding = to_gallery_space(frame.encoding(0))
+        sync_gallery()
+
+        if claimed_id:
+            # 1:1 against the claimed student's templates only
+            claimed = gallery.verify(claimed_id, face_encoding, tolerance=0.6, space=match_space())
+            if claimed and claimed['best']:
+                best = claimed['best']
+                return jsonify({
+                    'success': True,
+                    'message': 'Face verification successful',
+                    'mode': '1:1',
+                    'verified': True,
+                    'studentId': best['studentId'],
+                    'confidence': 'high' if claimed['matchCount'] > 1 else 'medium',
+                    'score': best['score'],
+                    'distance': best['distance'],
+                    'candidates': claimed['candidates']
+                })
 
-        # Check against all registered faces
-        matches = []
+            if not (fallback == 'mismatch' or (fallback == 'unenrolled' and claimed is None)):
+                return jsonify({
+                    'success': False,
+                    'message': 'No registered face for the claimed student' if claimed is None
+                               else 'Face does not match the claimed student',
+                    'mode': '1:1',
+                    'verified': False,
+                    'studentId': claimed_id,
+                    'candidates': claimed['candidates'] if claimed else []
+                }), 404
+
+        # Check against all registered faces in one batched distance computation
+        result = gallery.match(face_encoding, tolerance=0.6, top_k=top_k,
+                               exact=is_true(fields.get('exact', False)), space=match_space())
+
+        if result and result['best']:
+            best = result['best']
+            response = {
+                'success': True,
+                'message': 'Face verification successful',
+                'mode': '1:N',
+                'verified': not claimed_id or best['studentId'] == claimed_id,
+                'studentId': best['studentId'],
+                'confidence': 'high' if result['matchCount'] > 1 else 'medium',
+                'score': best['score'],
+                'distance': best['distance'],
+                'candidates': result['candidates']
+            }
+            if claimed_id:
+                response['claimedStudentId'] = claimed_id
+            return jsonify(response)
+        else:
+            return jsonify({'success': False, 'message': 'No matching face found', 'mode': '1:N'}), 404
 
-        for student_id, registered_encodings in face_encodings.items():
-            for registered_encoding in registered_encodings:
-                # Convert back from list to numpy array
-                registered_encoding_np = np.array(registered_encoding)
+    except Exception as e:
+        print(f"Error verifying face: {e}")
+        return jsonify({'success': False, 'message': f'Error processing image: {str(e)}'}), 500
 
-                # Compare faces with a tolerance (lower is stricter)
-                match = compare_faces(registered_encoding_np, face_encoding, tolerance=0.6)
+def encode_verification_image(image_data):
+    """Decode one image and encode its single face
 
-                if match[0]:
-                    matches.append(student_id)
-                    break
+    Returns (encoding, error); exactly one of them is None. error is the
+    failed result for the item ('message', plus 'reasons' and 'quality'
+    when the face failed the quality gate).
+    """
+    try:
+        image = process_image(image_data)
+        if image is None:
+            return None, {'message': 'Invalid image data'}
 
-        if matches:
-            # In case of multiple matches, return the one with highest frequency
-            # In a real system, you might want to implement more sophisticated logic
-            student_id = max(set(matches), key=matches.count)
-            return jsonify({
-                'success': True,
-                'message': 'Face verification successful',
-                'studentId': student_id,
-                'confidence': 'high' if matches.count(student_id) > 1 else 'medium'
-            })
+        frame = engine.analyze(image)
+        if frame.face_count == 0:
+            return None, {'message': 'No face detected'}
+        elif frame.face_count > 1:
+            return None, {'message': 'Multiple faces detected'}
+
+        quality = frame.quality(check_centering=True)[0]
+        if not quality['passed']:
+            return None, quality_rejection(quality)
+
+        return frame.encoding(0), None
+    except Exception as e:
+        return None, {'message': f'Error processing image: {str(e)}'}
+
+@app.route('/api/face/verify-batch', methods=['POST'])
+def verify_batch():
+    """Verify many buffered check-in images in one call
+
+    Images are decoded and detected in parallel, then every resulting
+    encoding is matched against the gallery in one distance-matrix pass.
+    Results come back in request order with per-item errors.
+    """
+    fields, images = read_image_list_request(request)
+    if images is None:
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+    if len(images) > MAX_VERIFY_BATCH:
+        return jsonify({
+            'success': False,
+            'message': f'Too many images in batch (maximum {MAX_VERIFY_BATCH})'
+        }), 413
+
+    top_k = parse_top_k(fields)
+    if top_k is None:
+        return jsonify({'success': False, 'message': 'topK must be a whole number of at least 1'}), 400
+    exact = is_true(fields.get('exact', False))
+
+    try:
+        # Items may be bare image strings or {"image": ..., "id": ...} objects
+        # (multipart uploads arrive as raw bytes)
+        items = [item if isinstance(item, dict) else {'image': item} for item in images]
+        encoded = list(verify_pool.map(lambda item: encode_verification_image(item.get('image') or b''), items))
+
+        results = [None] * len(items)
+        encodings, positions = [], []
+        for i, (encoding, error) in enumerate(encoded):
+            if error:
+                results[i] = {**error, 'success': False}
+            else:
+                encodings.append(to_gallery_space(encoding))
+                positions.append(i)
+
+        sync_gallery()
+        matched = gallery.match_many(encodings, tolerance=0.6, top_k=top_k, exact=exact, space=match_space())
+        for i, result in zip(positions, matched):
+            if result and result['best']:
+                best = result['best']
+                results[i] = {
+                    'success': True,
+                    'studentId': best['studentId'],
+                    'confidence': 'high' if result['matchCount'] > 1 else 'medium',
+                    'score': best['score'],
+                    'distance': best['distance'],
+                    'candidates': result['candidates']
+                }
+            else:
+                results[i] = {'success': False, 'message': 'No matching face found'}
+
+        for i, item in enumerate(items):
+            results[i]['index'] = i
+            if 'id' in item:
+                results[i]['id'] = item['id']
+
+        return jsonify({
+            'success': True,
+            'message': 'Batch verification completed',
+            'count': len(results),
+            'verified': sum(1 for result in results if result['success']),
+            'results': results
+        })
+
+    except Exception as e:
+        print(f"Error verifying batch: {e}")
+        return jsonify({'success': False, 'message': f'Error processing batch: {str(e)}'}), 500
+
+def redetect_in_window(frame, box):
+    """Look for a tracked face only in a window around its last box
+
+    Returns the re-detected (top, right, bottom, left) box closest to the
+    old one, or None if the face is gone.
+    """
+    top, right, bottom, left = box
+    width, height = right - left, bottom - top
+    image_height, image_width = frame.gray.shape[:2]
+    y0, y1 = max(0, top - height // 2), min(image_height, bottom + height // 2)
+    x0, x1 = max(0, left - width // 2), min(image_width, right + width // 2)
+    window = frame.gray[y0:y1, x0:x1]
+    if window.size == 0:
+        return None
+
+    # The window is small, so it is searched at full resolution for faces of about the same size
+    with engine.cascade() as cascade:
+        faces = detect_scaled(cascade, window, window.shape[1],
+                              min_size=max(DETECTION_MIN_FACE, int(width * 0.6)),
+                              max_size=int(width * 1.6) + 1)
+    if len(faces) == 0:
+        return None
+    boxes = [(y0 + y, x0 + x + w, y0 + y + h, x0 + x) for (x, y, w, h) in faces]
+    centre_x, centre_y = (left + right) / 2, (top + bottom) / 2
+    return min(boxes, key=lambda b: abs((b[3] + b[1]) / 2 - centre_x) + abs((b[0] + b[2]) / 2 - centre_y))
+
+def track_frame(session_id, image):
+    """Advance a session's face tracks by one frame and return the visible faces
+
+    Faces are followed across frames by IoU, so most frames skip full
+    detection, encoding and gallery matching for faces whose identity is
+    already known. Frames of one session are processed in order. Returns
+    None if another worker process holds the session.
+    """
+    tracker = trackers.get(session_id)
+    if tracker is None:
+        return None
+    frame = engine.analyze(image)
+    with tracker.lock:
+        full_detection = tracker.begin_frame()
+        if full_detection:
+            tracker.associate(frame.face_locations)
         else:
-            return jsonify({'success': False, 'message': 'No matching face found'}), 404
+            for track in list(tracker.tracks):
+                tracker.update(track, redetect_in_window(frame, track.box))
+            tracker.finish_frame()
+
+        visible = tracker.visible()
+        to_match = [track for track in visible if tracker.needs_match(track)]
+        crops = [face_crop(image, track.box) for track in to_match]
+        if to_match:
+            # Poor crops are deferred to a later frame instead of matched
+            qualities = quality_gate.assess(crops, [track.box for track in to_match], image.shape)
+            for track, quality in zip(to_match, qualities):
+                track.quality_issues = quality['reasons']
+            passed = [i for i, quality in enumerate(qualities) if quality['passed']]
+            to_match = [to_match[i] for i in passed]
+            crops = [crops[i] for i in passed]
+        if to_match:
+            sync_gallery()
+            # Same encoding as encode_face(), from the crops already taken
+            encodings = [to_gallery_space(crop.flatten() / 255.0) for crop in crops]
+            results = gallery.match_many(encodings, tolerance=0.6, top_k=2, space=match_space())
+            for track, result in zip(to_match, results):
+                tracker.record_match(track, result)
+
+        return {
+            'success': True,
+            'message': f'Tracked {len(visible)} faces',
+            'frame': tracker.frame_index,
+            'detection': 'full' if full_detection else 'tracked',
+            'matched': len(to_match),
+            'deferred': sum(1 for track in visible if track.quality_issues),
+            'faces': [track.to_dict() for track in visible]
+        }
+
+SESSION_ELSEWHERE_MESSAGE = 'Session is held by another worker process; route it to one worker'
+
+@app.route('/api/face/track', methods=['POST'])
+def track_faces():
+    """Identify the faces in one frame of a live session's stream"""
+    fields, image_data = read_image_request(request)
+    if image_data is None or not fields.get('sessionId'):
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+
+    try:
+        image = process_image(image_data)
+        if image is None:
+            return jsonify({'success': False, 'message': 'Invalid image data'}), 400
+        result = track_frame(fields['sessionId'], image)
+        if result is None:
+            return jsonify({'success': False, 'message': SESSION_ELSEWHERE_MESSAGE}), 409
+        return jsonify(result)
 
     except Exception as e:
-        print(f"Error verifying face: {e}")
+        print(f"Error tracking faces: {e}")
         return jsonify({'success': False, 'message': f'Error processing image: {str(e)}'}), 500
 
+@app.route('/api/face/track/<session_id>', methods=['DELETE'])
+def end_tracking(session_id):
+    """Forget a session's tracks when it ends"""
+    if not trackers.owns(session_id):
+        return jsonify({'success': False, 'message': SESSION_ELSEWHERE_MESSAGE}), 409
+    if not trackers.delete(session_id):
+        return jsonify({'success': False, 'message': 'Unknown session'}), 404
+    return jsonify({'success': True, 'message': 'Tracking stopped'})
+
+def process_stream_frame(session_id, frame):
+    """Streamed frames go through the same per-session tracker as /api/face/track"""
+    image = process_image(frame)
+    if image is None:
+        return {'success': False, 'message': 'Invalid image data'}
+    return track_frame(session_id, image) or {'success': False, 'message': SESSION_ELSEWHERE_MESSAGE}
+
+# Continuous frame ingestion for live monitoring (see common/streaming.py).
+# Worker processes of a multi-process server share stream ownership through
+# lease files, so a session's requests must all reach the same worker
+stream_hub = StreamHub(process_stream_frame, max_fps=STREAM_MAX_FPS, max_frame_age=STREAM_MAX_FRAME_AGE,
+                       idle_timeout=STREAM_IDLE_TIMEOUT, max_sessions=MAX_STREAM_SESSIONS,
+                       leases=SessionLeases(os.path.join(DATA_PATH, 'sessions', 'face-stream'),
+                                            2 * STREAM_IDLE_TIMEOUT))
+add_stream_routes(app, '/api/face/stream', stream_hub, app.config['MAX_CONTENT_LENGTH'])
+
 @app.route('/api/face/analyze', methods=['POST'])
 def analyze_face():
     """Analyze a face image for quality and count"""
-    if not request.json or 'image' not in request.json:
+    fields, image_data = read_image_request(request)
+    if image_data is None:
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
 
-    image_data = request.json['image']
-
     try:
         # Process the image
         image = process_image(image_data)
 
+        # A near-identical frame of the same session reuses the last analysis
+        session_id = fields.get('sessionId')
+        frame_hash = dhash(image)
+        cached = result_cache.get('analyze', session_id, frame_hash)
+        if cached is not None:
+            return jsonify(cached[0]), cached[1]
+
         # Get face locations
-        face_locations = detect_faces(image)
+        face_locations = engine.analyze(image).face_locations
         face_count = len(face_locations)
 
         # Analyze face quality
@@ -295,12 +794,14 @@ def analyze_face():
                 face_quality = 'poor'
 
         if face_count == 0:
-            return jsonify({
+            result = {
                 'success': False,
                 'message': 'No face detected',
                 'faceCount': 0,
                 'faceQuality': 'unknown'
-            }), 400
+            }
+            result_cache.put('analyze', session_id, frame_hash, (result, 400))
+            return jsonify(result), 400
 
         # Simple engagement analysis (in a real system, use a trained model)
         # For this example, we'll return random values
@@ -318,125 +819,357 @@ def analyze_face():
 
             engagement_metrics.append(metrics)
 
-        return jsonify({
+        result = {
             'success': True,
             'message': 'Face analysis completed',
             'faceCount': len(face_locations),
             'faceQuality': face_quality,
             'metrics': engagement_metrics
-        })
+        }
+        result_cache.put('analyze', session_id, frame_hash, (result, 200))
+        return jsonify(result)
 
     except Exception as e:
         print(f"Error analyzing face: {e}")
         return jsonify({'success': False, 'message': f'Error processing image: {str(e)}'}), 500
 
+def resolve_identify_gallery(payload):
+    """Gallery to identify against: a stored snapshot or encodings sent inline
+
+    Returns (gallery, snapshot, error_response).
+    """
+    snapshot_id = payload.get('snapshotId')
+    if snapshot_id:
+        version = payload.get('snapshotVersion')
+        snapshot = snapshots.get(snapshot_id, version)
+        if snapshot is None:
+            current = snapshots.get(snapshot_id)
+            return None, None, (jsonify({
+                'success': False,
+                'message': 'Unknown gallery snapshot version' if current else 'Unknown gallery snapshot',
+                'snapshotId': snapshot_id,
+                'currentVersion': current.version if current else None
+            }), 409 if current else 404)
+        return snapshot.gallery, snapshot, None
+
+    encodings = payload.get('encodings')
+    if isinstance(encodings, str):
+        # Multipart uploads carry the inline encodings as a JSON form field
+        try:
+            encodings = json.loads(encodings)
+        except ValueError:
+            return None, None, (jsonify({'success': False, 'message': 'Invalid encodings'}), 400)
+    encodings_data = parse_encoding_items(encodings)
+    try:
+        return GallerySnapshot.from_encodings('inline', encodings_data).gallery, None, None
+    except ValueError as e:
+        return None, None, (jsonify({'success': False, 'message': f'Invalid encodings: {str(e)}'}), 400)
+
 @app.route('/api/face/identify-multiple', methods=['POST'])
 def identify_multiple():
-    """Identify multiple faces in an image"""
-    if not request.json or 'image' not in request.json or 'encodings' not in request.json:
-        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+    """Identify multiple faces in an image
 
-    image_data = request.json['image']
-    encodings_data = {}
-
-    # Process encodings from request
-    for item in request.json['encodings']:
-        student_id = item.get('studentId')
-        encoding = item.get('encoding')
-
-        if student_id and encoding:
-            if student_id not in encodings_data:
-                encodings_data[student_id] = []
-
-            # Handle both array and string formats
-            if isinstance(encoding, str):
-                try:
-                    encoding = json.loads(encoding)
-                except:
-                    pass
+    Known faces come either from a stored snapshot ('snapshotId' and
+    optionally 'snapshotVersion') or from inline 'encodings'.
+    """
+    fields, image_data = read_image_request(request)
+    if image_data is None or ('encodings' not in fields and 'snapshotId' not in fields):
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
 
-            encodings_data[student_id].append(encoding)
+    known_faces, snapshot, error_response = resolve_identify_gallery(fields)
+    if error_response:
+        return error_response
 
     try:
         # Process the image
         image = process_image(image_data)
 
         # Get face locations
-        face_locations = detect_faces(image)
+        frame = engine.analyze(image, GROUP_DETECTION_WIDTH)
+        face_locations = frame.face_locations
 
         if len(face_locations) == 0:
             return jsonify({'success': False, 'message': 'No faces detected in the image'}), 400
 
-        # Process each face
-        matches = []
-
-        for i, face_location in enumerate(face_locations):
-            # Get face encoding
-            face_encoding = encode_face(image, face_location)
-
-            # Check against all registered faces
-            best_match = None
-            best_distance = float('inf')
-
-            for student_id, student_encodings in encodings_data.items():
-                for encoding in student_encodings:
-                    # Convert to numpy array
-                    known_encoding = np.array(encoding)
-
-                    # Compare faces
-                    match = compare_faces(known_encoding, face_encoding, tolerance=0.6)
-
-                    if match[0]:
-                        # Calculate distance
-                        distance = np.linalg.norm(known_encoding - face_encoding)
-
-                        if distance < best_distance:
-                            best_match = student_id
-                            best_distance = distance
-
-            if best_match:
-                # Calculate confidence (inverse of distance, normalized to 0-1)
-                confidence = max(0, min(1, 1 - (best_distance / 100)))
-
-                # Add to matches
-                matches.append({
-                    'studentId': best_match,
-                    'confidence': confidence,
-                    'faceIndex': i,
-                    'location': face_location
-                })
+        # Quality-gated faces are reported as rejected, the rest assigned one-to-one
+        matches, rejected = engine.identify(frame, known_faces, tolerance=0.6)
 
         # Save the image with face boxes for reference
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        image_with_boxes = image.copy()
-
-        for match in matches:
-            top, right, bottom, left = match['location']
-            # Draw rectangle around face
-            cv2.rectangle(image_with_boxes, (left, top), (right, bottom), (0, 255, 0), 2)
-            # Add student ID
-            cv2.putText(image_with_boxes, match['studentId'], (left, top - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        image_with_boxes = draw_matches(image, matches)
 
         # Save the image
         image_filename = f"group_{timestamp}.jpg"
-        cv2.imwrite(os.path.join(DATA_PATH, 'groups', image_filename), image_with_boxes)
+        image_writer.submit(os.path.join(DATA_PATH, 'groups', image_filename), image_with_boxes)
 
-        return jsonify({
+        response = {
             'success': True,
             'message': f'Identified {len(matches)} faces',
             'matches': matches,
-            'totalFaces': len(face_locations)
-        })
+            'totalFaces': len(face_locations),
+            'rejected': rejected
+        }
+        if snapshot:
+            response['snapshotId'] = snapshot.name
+            response['snapshotVersion'] = snapshot.version
+        return jsonify(response)
 
     except Exception as e:
         print(f"Error identifying faces: {e}")
         return jsonify({'success': False, 'message': f'Error processing image: {str(e)}'}), 500
 
+@app.route('/api/face/snapshots/<snapshot_id>', methods=['PUT'])
+def put_snapshot(snapshot_id):
+    """Upload the full roster of encodings for a snapshot (e.g. one class section)"""
+    if not snapshots.valid_name(snapshot_id):
+        return jsonify({'success': False, 'message': 'Invalid snapshot id'}), 400
+    if not request.json or 'encodings' not in request.json:
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+
+    try:
+        snapshot = snapshots.put(snapshot_id, parse_encoding_items(request.json['encodings']))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid encodings: {str(e)}'}), 400
+
+    return jsonify({'success': True, 'message': 'Snapshot stored', **snapshot.summary()})
+
+@app.route('/api/face/snapshots/<snapshot_id>', methods=['PATCH'])
+def patch_snapshot(snapshot_id):
+    """Apply a roster delta: 'add' replaces/adds students' encodings, 'remove' drops students"""
+    if not request.json or 'baseVersion' not in request.json:
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+    if not isinstance(request.json['baseVersion'], str) or not request.json['baseVersion']:
+        return jsonify({'success': False, 'message': 'baseVersion must be the version the delta was made against'}), 400
+
+    try:
+        snapshot = snapshots.apply_delta(
+            snapshot_id,
+            request.json['baseVersion'],
+            parse_encoding_items(request.json.get('add')),
+            request.json.get('remove', [])
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid encodings: {str(e)}'}), 400
+
+    if snapshot is None:
+        current = snapshots.get(snapshot_id)
+        return jsonify({
+            'success': False,
+            'message': 'Base version is out of date' if current else 'Unknown gallery snapshot',
+            'currentVersion': current.version if current else None
+        }), 409 if current else 404
+
+    return jsonify({'success': True, 'message': 'Snapshot updated', **snapshot.summary()})
+
+@app.route('/api/face/snapshots/<snapshot_id>', methods=['GET'])
+def get_snapshot(snapshot_id):
+    """Current version of a snapshot, so clients can tell whether to re-sync"""
+    snapshot = snapshots.get(snapshot_id)
+    if snapshot is None:
+        return jsonify({'success': False, 'message': 'Unknown gallery snapshot'}), 404
+    return jsonify({'success': True, **snapshot.summary()})
+
+@app.route('/api/face/snapshots/<snapshot_id>', methods=['DELETE'])
+def delete_snapshot(snapshot_id):
+    """Forget a snapshot"""
+    if not snapshots.delete(snapshot_id):
+        return jsonify({'success': False, 'message': 'Unknown gallery snapshot'}), 404
+    return jsonify({'success': True, 'message': 'Snapshot deleted'})
+
+@app.route('/api/face/projection/reload', methods=['POST'])
+def reload_projection():
+    """Load a newly fitted projection and re-project the gallery with it"""
+    try:
+        new_projection = load_projection()
+        with gallery_lock:
+            encoding_store.refresh()
+            install_gallery(new_projection)
+            # Other workers reload it on their next sync
+            encoding_store.note_projection(match_space())
+
+        return jsonify({
+            'success': True,
+            'message': 'Projection reloaded',
+            'space': gallery.space,
+            'dimensions': gallery.dim,
+            'templates': len(gallery)
+        })
+    except Exception as e:
+        print(f"Error reloading projection: {e}")
+        return jsonify({'success': False, 'message': f'Error reloading projection: {str(e)}'}), 500
+
+def consolidate_gallery(max_prototypes=None, student_ids=None):
+    """Reduce students' templates to prototypes and swap in the rebuilt gallery"""
+    summary = encoding_store.consolidate(select_medoids, max_prototypes or GALLERY_MAX_PROTOTYPES,
+                                         template_archive, student_ids)
+    # The new store generation makes every worker rebuild its gallery and
+    # ANN index on its next sync; do it here right away
+    sync_gallery()
+    summary['archived'] = template_archive.total_rows
+    return summary
+
+def run_consolidation_job():
+    while True:
+        time.sleep(GALLERY_CONSOLIDATE_INTERVAL)
+        try:
+            summary = consolidate_gallery()
+            if summary['students']:
+                print(f"Consolidated gallery: {summary}")
+        except Exception as e:
+            print(f"Error consolidating gallery: {e}")
+
+if GALLERY_CONSOLIDATE_INTERVAL > 0:
+    threading.Thread(target=run_consolidation_job, name='gallery-consolidation', daemon=True).start()
+
+@app.route('/api/face/gallery/consolidate', methods=['POST'])
+def consolidate_templates():
+    """Cluster each student's templates into at most maxPrototypes medoids"""
+    payload = request.get_json(silent=True) or {}
+    student_ids = payload.get('studentIds')
+    if student_ids is not None and not isinstance(student_ids, list):
+        return jsonify({'success': False, 'message': 'studentIds must be a list'}), 400
+
+    try:
+        max_prototypes = int(payload.get('maxPrototypes', GALLERY_MAX_PROTOTYPES))
+        if max_prototypes < 1:
+            return jsonify({'success': False, 'message': 'maxPrototypes must be at least 1'}), 400
+
+        summary = consolidate_gallery(max_prototypes, student_ids)
+        return jsonify({'success': True, 'message': f"Consolidated {summary['students']} students", **summary})
+    except Exception as e:
+        print(f"Error consolidating gallery: {e}")
+        return jsonify({'success': False, 'message': f'Error consolidating gallery: {str(e)}'}), 500
+
+def run_enrollment_import(archive_path, dry_run):
+    """Run the enrollment.py importer on an archive in a separate process
+
+    The importer's worker processes are spawned from that process rather
+    than from this one, so they never re-run the service's startup (under
+    spawn a worker re-imports the parent's __main__). It commits to the
+    same store; callers sync_gallery() afterwards. Returns its summary.
+    """
+    summary_file = tempfile.NamedTemporaryFile(prefix='face-import-', suffix='.json', delete=False)
+    summary_file.close()
+    env = dict(os.environ, DATA_PATH=DATA_PATH, MODEL_PATH=MODEL_PATH,
+               DETECTION_WIDTH=str(DETECTION_WIDTH), DETECTION_MIN_FACE=str(DETECTION_MIN_FACE),
+               DETECTION_MAX_FACE=str(DETECTION_MAX_FACE))
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'enrollment.py'),
+               archive_path, '--summary', summary_file.name,
+               '--max-image-bytes', str(app.config['MAX_CONTENT_LENGTH'])]
+    if IMPORT_WORKERS:
+        command += ['--workers', str(IMPORT_WORKERS)]
+    if dry_run:
+        command.append('--dry-run')
+    try:
+        completed = subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            lines = completed.stderr.strip().splitlines()
+            raise RuntimeError(lines[-1] if lines else f'importer exited with code {completed.returncode}')
+        with open(summary_file.name, 'r') as f:
+            return json.load(f)
+    finally:
+        os.remove(summary_file.name)
+
+@app.route('/api/face/gallery/import', methods=['POST'])
+def import_gallery():
+    """Bulk-register a zip or tar archive of <studentId>_*.jpg images
+
+    The archive is the raw body (up to IMPORT_MAX_BYTES, streamed to a
+    temporary file) or a multipart file named 'archive'. Every accepted
+    face is committed in one transaction; dryRun=true only reports.
+    """
+    dry_run = is_true(request.args.get('dryRun', False))
+    archive = tempfile.NamedTemporaryFile(prefix='face-import-', delete=False)
+    try:
+        with archive:
+            if request.mimetype in ARCHIVE_TYPES:
+                length = request.content_length
+                if length is None and not request.environ.get('wsgi.input_terminated'):
+                    return jsonify({'success': False, 'message': 'Content-Length required'}), 411
+                if length is not None and length > IMPORT_MAX_BYTES:
+                    return jsonify({'success': False,
+                                    'message': f'Archive exceeds {IMPORT_MAX_BYTES} bytes'}), 413
+                # Read the raw input so the archive is not bound by MAX_CONTENT_LENGTH
+                source = request.environ['wsgi.input']
+                remaining = length if length is not None else IMPORT_MAX_BYTES + 1
+                while remaining > 0:
+                    chunk = source.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    archive.write(chunk)
+                    remaining -= len(chunk)
+                if archive.tell() > IMPORT_MAX_BYTES:
+                    return jsonify({'success': False,
+                                    'message': f'Archive exceeds {IMPORT_MAX_BYTES} bytes'}), 413
+            elif request.mimetype == 'multipart/form-data' and 'archive' in request.files:
+                dry_run = dry_run or is_true(request.form.get('dryRun', False))
+                request.files['archive'].save(archive)
+            else:
+                return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+        if not is_archive(archive.name):
+            return jsonify({'success': False, 'message': 'Upload is not a zip or tar archive'}), 400
+
+        try:
+            summary = run_enrollment_import(archive.name, dry_run)
+            sync_gallery()
+        except Exception as e:
+            print(f"Error importing gallery: {e}")
+            return jsonify({'success': False, 'message': f'Error importing gallery: {str(e)}'}), 500
+
+        return jsonify({
+            'success': True,
+            'message': f"{'Checked' if dry_run else 'Registered'} {summary['enrolled']} faces "
+                       f"of {summary['students']} students",
+            **summary
+        })
+    finally:
+        os.remove(archive.name)
+
+@app.route('/api/face/index/rebuild', methods=['POST'])
+def rebuild_index():
+    """Retrain the approximate nearest-neighbour index on the current gallery"""
+    if len(gallery) == 0:
+        return jsonify({'success': False, 'message': 'Gallery is empty'}), 400
+
+    try:
+        with gallery_lock:
+            build_ann_index(gallery)
+        return jsonify({'success': True, 'message': 'Index rebuilt', 'index': gallery.index.stats()})
+    except Exception as e:
+        print(f"Error rebuilding index: {e}")
+        return jsonify({'success': False, 'message': f'Error rebuilding index: {str(e)}'}), 500
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({
+        'success': False,
+        'message': f"Request body exceeds {app.config['MAX_CONTENT_LENGTH']} bytes"
+    }), 413
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'ok'}), 200
+    sync_gallery()
+    return jsonify({
+        'status': 'ok',
+        'models': engine.models.stats(),
+        'imageWriter': image_writer.stats(),
+        'tracking': trackers.stats(),
+        'streams': stream_hub.stats(),
+        'resultCache': result_cache.stats(),
+        'qualityGate': quality_gate.stats(),
+        'gallery': {
+            'templates': len(gallery),
+            'space': gallery.space,
+            'memoryBytes': gallery.memory_bytes(),
+            'mapped': gallery.mapped,
+            'generation': encoding_store.meta['generation'],
+            'students': len(encoding_store.students()),
+            'archived': template_archive.total_rows,
+            'index': gallery.index.stats() if gallery.index is not None else None,
+            'prefilter': gallery.prefilter.stats() if gallery.prefilter is not None else None
+        }
+    }), 200
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=False)
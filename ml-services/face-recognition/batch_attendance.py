@@ -0,0 +1,167 @@
+import argparse
+import csv
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import cv2
+
+from encoding_store import EncodingStore
+from engine import FACE_SIZE, FaceEngine, draw_matches, ensure_face_cascade
+from gallery import FaceGallery
+from quality import QualityGate
+from snapshots import SnapshotRegistry
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+CSV_FIELDS = ['folder', 'photo', 'studentId', 'confidence', 'faceIndex', 'top', 'right', 'bottom', 'left']
+
+
+def find_photos(directories):
+    """(root, relative path) of every photo under the directories, in name order"""
+    photos = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for filename in sorted(files):
+                if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                    photos.append((directory, os.path.relpath(os.path.join(root, filename), directory)))
+    return photos
+
+
+def load_roster(data_path, snapshot_id=None):
+    """Gallery to identify against: a stored snapshot, or every registered student"""
+    if snapshot_id:
+        snapshot = SnapshotRegistry(os.path.join(data_path, 'snapshots')).get(snapshot_id)
+        if snapshot is None:
+            raise ValueError(f"Unknown gallery snapshot '{snapshot_id}'")
+        return snapshot.gallery
+
+    # The template file is mapped read-only, so every worker shares one copy
+    store = EncodingStore(os.path.join(data_path, 'gallery'), dim=FACE_SIZE[0] * FACE_SIZE[1])
+    roster = FaceGallery(dim=store.dim, dtype=store.dtype, scale=store.scale)
+    roster.map_codes(store.templates(), store.row_students())
+    return roster
+
+
+# Engine, roster and options of each worker process, set by init_worker
+_worker = {}
+
+
+def init_worker(config):
+    # One OpenCV thread per process; the pool already uses every core
+    cv2.setNumThreads(1)
+    quality_gate = QualityGate(**config['quality']) if config['quality'] else QualityGate(enabled=False)
+    _worker['engine'] = FaceEngine(config['cascadePath'], detection_width=config['detectionWidth'],
+                                   min_face=config['minFace'], max_face=config['maxFace'],
+                                   quality_gate=quality_gate)
+    _worker['roster'] = load_roster(config['dataPath'], config['snapshotId'])
+    _worker['config'] = config
+
+
+def process_photo(photo):
+    """Identify the faces of one photo (runs in a worker process)"""
+    directory, relative = photo
+    config = _worker['config']
+    result = {'folder': os.path.dirname(relative), 'photo': relative}
+    try:
+        image = cv2.imread(os.path.join(directory, relative), cv2.IMREAD_COLOR)
+        if image is None:
+            return {**result, 'success': False, 'message': 'Image could not be decoded'}
+
+        frame = _worker['engine'].analyze(image)
+        matches, rejected = _worker['engine'].identify(frame, _worker['roster'], tolerance=config['tolerance'])
+
+        if config['annotateDir']:
+            path = os.path.join(config['annotateDir'], relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cv2.imwrite(path, draw_matches(image, matches))
+
+        return {**result, 'success': True, 'totalFaces': frame.face_count, 'matches': matches,
+                'rejected': rejected}
+    except Exception as e:
+        return {**result, 'success': False, 'message': f'Error processing image: {str(e)}'}
+
+
+def write_result(writer, output_format, result):
+    if output_format == 'jsonl':
+        writer.write(json.dumps(result) + '\n')
+        return
+    for match in result.get('matches', []):
+        top, right, bottom, left = match['location']
+        writer.writerow({'folder': result['folder'], 'photo': result['photo'], 'studentId': match['studentId'],
+                         'confidence': round(match['confidence'], 4), 'faceIndex': match['faceIndex'],
+                         'top': top, 'right': right, 'bottom': bottom, 'left': left})
+
+
+if __name__ == '__main__':
+    DATA_PATH = os.environ.get('DATA_PATH', 'data')
+    MODEL_PATH = os.environ.get('MODEL_PATH', 'models')
+
+    parser = argparse.ArgumentParser(description='Take attendance from folders of class photos')
+    parser.add_argument('directories', nargs='+', help='Folders of photos (searched recursively)')
+    parser.add_argument('--output', required=True, help='Results file (.csv or .jsonl)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='Output format (default: from the output file extension)')
+    parser.add_argument('--snapshot', help='Identify against this gallery snapshot instead of every student')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: one per CPU)')
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--annotate', help='Also save every photo with boxes around matched faces here')
+    args = parser.parse_args()
+
+    output_format = args.format or ('jsonl' if args.output.endswith(('.jsonl', '.json')) else 'csv')
+    quality_enabled = os.environ.get('QUALITY_GATE_ENABLED', 'true').lower() in ['true', '1', 't']
+    config = {
+        'cascadePath': ensure_face_cascade(MODEL_PATH),
+        'dataPath': DATA_PATH,
+        'snapshotId': args.snapshot,
+        # Same detection and quality settings as the service's group endpoint
+        'detectionWidth': int(os.environ.get('GROUP_DETECTION_WIDTH', 1280)),
+        'minFace': int(os.environ.get('DETECTION_MIN_FACE', 24)),
+        'maxFace': int(os.environ.get('DETECTION_MAX_FACE', 0)),
+        'quality': {
+            'min_face': int(os.environ.get('QUALITY_MIN_FACE', 40)),
+            'min_sharpness': float(os.environ.get('QUALITY_MIN_SHARPNESS', 25)),
+            'max_asymmetry': float(os.environ.get('QUALITY_MAX_ASYMMETRY', 0.3)),
+            'max_offset': float(os.environ.get('QUALITY_MAX_OFFSET', 0.35))
+        } if quality_enabled else None,
+        'tolerance': args.tolerance,
+        'annotateDir': args.annotate
+    }
+    # Fail on a bad snapshot id before starting the pool
+    try:
+        roster_size = len(load_roster(DATA_PATH, args.snapshot))
+    except ValueError as e:
+        parser.error(str(e))
+
+    photos = find_photos(args.directories)
+    print(f"Identifying {len(photos)} photos against {roster_size} templates")
+    start_time = time.perf_counter()
+    totals = {'photos': 0, 'failed': 0, 'faces': 0, 'matched': 0}
+    present = set()
+
+    with open(args.output, 'w', newline='') as f:
+        writer = f
+        if output_format == 'csv':
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+
+        with Pool(processes=args.workers, initializer=init_worker, initargs=(config,)) as pool:
+            # Results come back in photo order; chunks keep the workers busy between them
+            for result in pool.imap(process_photo, photos, chunksize=4):
+                totals['photos'] += 1
+                if not result['success']:
+                    totals['failed'] += 1
+                    print(f"Skipped {result['photo']}: {result['message']}")
+                else:
+                    totals['faces'] += result['totalFaces']
+                    totals['matched'] += len(result['matches'])
+                    present.update((result['folder'], match['studentId']) for match in result['matches'])
+                write_result(writer, output_format, result)
+
+    seconds = time.perf_counter() - start_time
+    print(f"Processed {totals['photos']} photos ({totals['failed']} failed) in {seconds:.1f}s "
+          f"({totals['photos'] / seconds if seconds else 0:.1f} photos/s): {totals['faces']} faces, "
+          f"{totals['matched']} matched, {len(present)} folder/student attendances")
+    print(f"Saved results to {args.output}")
@@ -0,0 +1,282 @@
+import argparse
+import base64
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from engine import encode_face
+from gallery import FaceGallery
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Templates registered per synthetic student, like a student enrolled from a few photos
+TEMPLATES_PER_STUDENT = 5
+
+
+def draw_face(canvas, cx, cy, size, rng):
+    """Draw a cartoon frontal face the Haar cascade detects, with random features"""
+    skin = int(rng.integers(150, 210))
+    eye_spacing = rng.uniform(0.16, 0.2)
+    eye_height = rng.uniform(0.1, 0.14)
+    mouth_width = rng.uniform(0.12, 0.18)
+    cv2.ellipse(canvas, (cx, cy), (int(size * 0.42), int(size * 0.55)), 0, 0, 360,
+                (skin - 20, skin, skin + 20), -1)
+    for side in (-1, 1):
+        ex, ey = cx + int(side * size * eye_spacing), cy - int(size * eye_height)
+        cv2.ellipse(canvas, (ex, ey - int(size * 0.1)), (int(size * 0.12), int(size * 0.03)), 0, 0, 360,
+                    (40, 40, 40), -1)
+        cv2.ellipse(canvas, (ex, ey), (int(size * 0.09), int(size * 0.05)), 0, 0, 360, (255, 255, 255), -1)
+        cv2.circle(canvas, (ex, ey), int(size * 0.04), (30, 30, 30), -1)
+    cv2.line(canvas, (cx, cy - int(size * 0.05)), (cx - int(size * 0.04), cy + int(size * 0.12)),
+             (skin - 60,) * 3, 2)
+    cv2.ellipse(canvas, (cx, cy + int(size * 0.27)), (int(size * mouth_width), int(size * 0.05)), 0, 0, 360,
+                (60, 60, 150), -1)
+
+
+def synthetic_frame(width, height, faces, face_size, rng):
+    """BGR frame with faces evenly spaced across it, blurred like a camera image"""
+    frame = np.full((height, width, 3), 90, dtype=np.uint8)
+    for i in range(faces):
+        draw_face(frame, int(width * (i + 0.5) / faces), height // 2, face_size, rng)
+    frame = cv2.GaussianBlur(frame, (5, 5), 0)
+    noise = rng.normal(0, 3, frame.shape)
+    return np.clip(frame + noise, 0, 255).astype(np.uint8)
+
+
+def student_faces(count, face_size, seed):
+    """One FACE_SIZE grayscale crop per synthetic student"""
+    rng = np.random.default_rng(seed)
+    side = face_size[0]
+    faces = np.empty((count, side * face_size[1]), dtype=np.uint8)
+    for i in range(count):
+        canvas = np.full((side, side, 3), int(rng.integers(60, 120)), dtype=np.uint8)
+        draw_face(canvas, side // 2, side // 2, int(side * rng.uniform(0.8, 0.95)), rng)
+        faces[i] = cv2.cvtColor(cv2.GaussianBlur(canvas, (3, 3), 0), cv2.COLOR_BGR2GRAY).ravel()
+    return faces
+
+
+def jitter(faces, rng, noise=6.0, brightness=10.0):
+    """Templates of the same students as they would come from other photos"""
+    shifted = faces.astype(np.float32) + rng.uniform(-brightness, brightness, (len(faces), 1))
+    return np.clip(shifted + rng.normal(0, noise, faces.shape), 0, 255).astype(np.uint8)
+
+
+def build_gallery(size, face_size, seed, chunk_size=4096):
+    """FaceGallery of size templates, TEMPLATES_PER_STUDENT per student
+
+    Returns the gallery and the students' base faces, which queries are
+    jittered from.
+    """
+    students = max(1, size // TEMPLATES_PER_STUDENT)
+    faces = student_faces(students, face_size, seed)
+    rng = np.random.default_rng(seed + 1)
+    target = FaceGallery(dim=faces.shape[1], dtype='uint8', scale=255.0)
+    for start in range(0, size, chunk_size):
+        rows = np.arange(start, min(size, start + chunk_size)) % students
+        target.add_codes([f'S{row:06d}' for row in rows], jitter(faces[rows], rng))
+    return target, faces
+
+
+def percentile_summary(samples):
+    timings = np.asarray(samples) * 1000
+    return {
+        'iterations': len(timings),
+        'meanMs': round(float(timings.mean()), 3),
+        'p50Ms': round(float(np.percentile(timings, 50)), 3),
+        'p95Ms': round(float(np.percentile(timings, 95)), 3),
+        'p99Ms': round(float(np.percentile(timings, 99)), 3),
+        'throughput': round(len(timings) / (timings.sum() / 1000), 1) if timings.sum() else None
+    }
+
+
+def peak_rss_mb():
+    """High-water mark of this process's resident memory so far, None where unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(name, operation, inputs, iterations, warmup, results, **extra):
+    """Time operation over inputs (cycled) and record the summary under name"""
+    for i in range(warmup):
+        operation(inputs[i % len(inputs)])
+    samples = []
+    for i in range(iterations):
+        item = inputs[i % len(inputs)]
+        start = time.perf_counter()
+        operation(item)
+        samples.append(time.perf_counter() - start)
+    summary = percentile_summary(samples)
+    summary['peakRssMb'] = peak_rss_mb()
+    summary.update(extra)
+    results[name] = summary
+    print(f"{name:<32} p50 {summary['p50Ms']:>9.3f} ms  p95 {summary['p95Ms']:>9.3f} ms  "
+          f"p99 {summary['p99Ms']:>9.3f} ms  {summary['throughput']:>9} ops/s")
+
+
+def identify(roster, payload):
+    """identify_multiple() without the HTTP layer and the audit image"""
+    frame = app.engine.analyze(app.process_image(payload), app.GROUP_DETECTION_WIDTH)
+    return app.engine.identify(frame, roster, tolerance=0.6)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__) or '.',
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    results = {}
+
+    # Single-subject frames for the per-request stages, as the verify endpoint receives them
+    frames = [synthetic_frame(640, 480, 1, int(rng.integers(150, 220)), rng) for _ in range(8)]
+    payloads = [base64.b64encode(cv2.imencode('.jpg', frame)[1].tobytes()).decode() for frame in frames]
+    locations = [app.engine.detect_faces(frame) for frame in frames]
+    if any(len(found) != 1 for found in locations):
+        raise RuntimeError("Synthetic frames were not detected as single faces; check the face cascade")
+    located = [(frame, found[0]) for frame, found in zip(frames, locations)]
+
+    measure('process_image', app.process_image, payloads, args.iterations, args.warmup, results)
+    measure('detect_faces', app.engine.detect_faces, frames, args.iterations, args.warmup, results)
+    measure('encode_face', lambda item: encode_face(*item), located, args.iterations, args.warmup, results)
+
+    # Group photos as sent to identify-multiple
+    group_frames = [synthetic_frame(1280, 720, args.group_faces, 180, rng) for _ in range(4)]
+    group_payloads = [cv2.imencode('.jpg', frame)[1].tobytes() for frame in group_frames]
+    group_counts = [len(app.engine.detect_faces(frame, app.GROUP_DETECTION_WIDTH)) for frame in group_frames]
+    if any(count != args.group_faces for count in group_counts):
+        raise RuntimeError("Synthetic group photos were not detected face by face; check the face cascade")
+
+    for size in args.sizes:
+        build_start = time.perf_counter()
+        target, faces = build_gallery(size, app.FACE_SIZE, args.seed)
+        # Accelerated the same way the service accelerates its gallery
+        if app.ANN_ENABLED and len(target) >= app.ANN_MIN_GALLERY:
+            app.build_ann_index(target)
+        if app.wants_prefilter(target):
+            app.build_prefilter(target, None)
+        build_seconds = round(time.perf_counter() - build_start, 2)
+        gallery_info = {
+            'gallerySize': size,
+            'galleryMb': round(target.memory_bytes() / (1024 * 1024), 1),
+            'buildSeconds': build_seconds,
+            'accelerator': 'ann' if target.index is not None else 'prefilter' if target.prefilter is not None
+                           else 'none'
+        }
+
+        # Queries are new photos of enrolled students, matched like verify_face() does 1:N
+        queries = jitter(faces[rng.integers(0, len(faces), 32)], rng) / 255.0
+        measure(f'verify_match/{size}',
+                functools.partial(target.match, tolerance=0.6, top_k=5),
+                queries, args.match_iterations, args.warmup, results, **gallery_info)
+        measure(f'verify_match_exact/{size}',
+                functools.partial(target.match, tolerance=0.6, top_k=5, exact=True),
+                queries, args.match_iterations, args.warmup, results, **gallery_info)
+
+        measure(f'identify_multiple/{size}', functools.partial(identify, target), group_payloads,
+                args.iterations, args.warmup, results, faces=args.group_faces, **gallery_info)
+        # Release this size's gallery before the next one is built
+        target = faces = queries = None
+
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Print p50/p95 changes against a baseline; returns the names that regressed"""
+    regressed = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} ({baseline.get('createdAt')}):")
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            print(f"{name:<32} new")
+            continue
+        changes = []
+        for key in ('p50Ms', 'p95Ms'):
+            change = (current[key] - previous[key]) / previous[key] if previous[key] else 0.0
+            changes.append(change)
+        line = (f"{name:<32} p50 {previous['p50Ms']:.3f} -> {current['p50Ms']:.3f} ms ({changes[0]:+.1%})  "
+                f"p95 {previous['p95Ms']:.3f} -> {current['p95Ms']:.3f} ms ({changes[1]:+.1%})")
+        if changes[0] > max_regression:
+            line += '  REGRESSION'
+            regressed.append(name)
+        print(line)
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the face recognition pipeline')
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=[100, 1000, 10000, 100000], help='Comma-separated gallery sizes (templates)')
+    parser.add_argument('--iterations', type=int, default=50, help='Timed runs per image stage')
+    parser.add_argument('--match-iterations', type=int, default=200, help='Timed runs per gallery match')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--group-faces', type=int, default=4, help='Faces per identify-multiple photo')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Where to save the JSON results (default benchmarks/<commit>.json)')
+    parser.add_argument('--compare', help='Baseline JSON to compare the results with')
+    parser.add_argument('--max-regression', type=float, default=0.15,
+                        help='Relative p50 slowdown that fails --compare (default 0.15)')
+    args = parser.parse_args()
+
+    # The service is imported against an empty data directory so benchmarks
+    # never read or write the real gallery; the face cascade still comes from MODEL_PATH
+    os.environ['DATA_PATH'] = tempfile.mkdtemp(prefix='face-benchmark-')
+    import app
+
+    commit = git_commit()
+    report = {
+        'createdAt': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__
+        },
+        'config': {
+            'sizes': args.sizes,
+            'iterations': args.iterations,
+            'matchIterations': args.match_iterations,
+            'warmup': args.warmup,
+            'groupFaces': args.group_faces,
+            'seed': args.seed,
+            'annEnabled': app.ANN_ENABLED,
+            'annMinGallery': app.ANN_MIN_GALLERY,
+            'prefilterEnabled': app.PREFILTER_ENABLED,
+            'prefilterMinGallery': app.PREFILTER_MIN_GALLERY
+        },
+        'results': run(args)
+    }
+
+    output = args.output or os.path.join('benchmarks', f"{commit or datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(report['results'], json.load(f), args.max_regression)
+        if regressed:
+            print(f"{len(regressed)} benchmarks regressed by more than {args.max_regression:.0%}")
+            sys.exit(1)
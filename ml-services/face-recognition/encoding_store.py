@@ -0,0 +1,506 @@
+import contextlib
+import json
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class EncodingStore:
+    """Append-only binary store for face templates
+
+    The store directory holds three files:
+
+    - meta.json: dimension, dtype, quantisation scale and the current
+      generation, replaced atomically on compaction
+    - templates.<generation>.bin: fixed-size template rows, memory-mapped
+      read-only for matching
+    - registrations.<generation>.log: one JSON line per operation, either
+      {"op": "add", "row": ..., "studentId": ...} or
+      {"op": "drop", "studentId": ...}; "archived": true on an add marks a
+      row whose original already sits in a cold archive store. A bulk
+      import commits {"op": "add_many", "row": ..., "studentIds": [...]},
+      the rows from "row" on, as a single line
+
+    A registration writes its row to the end of the template file and then
+    appends one log line, so it costs O(1) regardless of gallery size. The
+    log line is the commit point: rows without a log entry (a crash between
+    the two writes) are truncated on the next open. Dropped rows stay in the
+    template file until compact() rewrites the live rows into a new
+    generation.
+
+    Encodings are stored as round(encoding * scale) in the configured dtype.
+    encode_face() produces pixel / 255 values, so uint8 with a scale of 255
+    stores them exactly in a quarter of the float32 size.
+
+    Several processes (e.g. WSGI workers) can share one store. Writers
+    serialise on an OS file lock (write.lock) and bump a commit counter in
+    state.bin, which every process keeps memory-mapped next to its
+    generation number. has_changes() compares that counter with what the
+    process has replayed, a single memory read, and refresh() replays the
+    log lines other processes appended or reopens the store after another
+    process compacted it.
+    """
+
+    def __init__(self, directory, dim, dtype='uint8', scale=255.0):
+        self.directory = directory
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, 'write.lock'), 'a+')
+
+        with self._locked():
+            meta_path = os.path.join(directory, 'meta.json')
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    self.meta = json.load(f)
+            else:
+                self.meta = {'version': 1, 'dim': int(dim), 'dtype': np.dtype(dtype).name,
+                             'scale': float(scale), 'generation': 0}
+                self._write_meta()
+
+            # [generation, commits], shared by every process using the store
+            state_path = os.path.join(directory, 'state.bin')
+            if not os.path.exists(state_path):
+                np.array([self.meta['generation'], 0], dtype=np.int64).tofile(state_path)
+            self._state = np.memmap(state_path, dtype=np.int64, mode='r+', shape=(2,))
+
+            self.dim = self.meta['dim']
+            self.dtype = np.dtype(self.meta['dtype'])
+            self.scale = self.meta['scale']
+            self.row_bytes = self.dim * self.dtype.itemsize
+
+            self._open_generation()
+            self._reloaded = False
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Exclusive access across threads and processes (re-entrant within a thread)"""
+        with self._lock:
+            if self._lock_depth == 0:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self._lock_file.seek(0)
+                    msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    if fcntl is not None:
+                        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+                    else:
+                        self._lock_file.seek(0)
+                        msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    # Paths
+
+    def _template_path(self, generation=None):
+        generation = self.meta['generation'] if generation is None else generation
+        return os.path.join(self.directory, f'templates.{generation}.bin')
+
+    def _log_path(self, generation=None):
+        generation = self.meta['generation'] if generation is None else generation
+        return os.path.join(self.directory, f'registrations.{generation}.log')
+
+    def _write_meta(self):
+        meta_path = os.path.join(self.directory, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(meta_path + '.tmp', meta_path)
+
+    # Loading
+
+    def _open_generation(self):
+        """Replay the log and map the template file of the current generation (caller holds the lock)"""
+        self._row_students = []   # row -> student id, None once dropped
+        self._student_rows = {}   # student id -> [row, ...]
+        self._archived_rows = set()
+        self.dead_rows = 0
+        self._log_offset = 0
+        self._pending = []
+        self._commits = int(self._state[1])
+
+        log_path = self._log_path()
+        with open(log_path, 'ab'):
+            pass
+        template_path = self._template_path()
+        with open(template_path, 'ab') as f:
+            stored_rows = f.tell() // self.row_bytes
+        self._replay_log(max_rows=stored_rows)
+
+        # Drop a torn final line, log lines whose rows never reached the
+        # template file and any template rows written after the last
+        # committed log line (an interrupted append)
+        with open(log_path, 'ab') as f:
+            if f.tell() > self._log_offset:
+                print(f"Dropping {f.tell() - self._log_offset} uncommitted bytes from {log_path}")
+                f.truncate(self._log_offset)
+        with open(template_path, 'ab') as f:
+            committed = len(self._row_students) * self.row_bytes
+            if f.tell() > committed:
+                f.truncate(committed)
+
+        self._templates_file = open(template_path, 'ab')
+        self._log_file = open(log_path, 'ab')
+        self._mapped = None
+
+        # Rows may have been renumbered, so whoever consumes refresh()
+        # reloads everything instead of replaying records
+        self._pending = []
+        self._reloaded = True
+
+    def _replay_log(self, max_rows=None):
+        """Apply complete log lines past the replayed offset
+
+        With max_rows, replay stops at the first record adding rows beyond
+        that many, as if it had never been written.
+        """
+        with open(self._log_path(), 'rb') as f:
+            f.seek(self._log_offset)
+            data = f.read()
+
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn line from an interrupted append; later lines can't be trusted
+                break
+            if max_rows is not None and record['op'] in ('add', 'add_many'):
+                if record['row'] + len(record.get('studentIds', [None])) > max_rows:
+                    break
+            self._apply(record)
+            self._log_offset += len(line) + 1
+
+    def _catch_up(self):
+        """Pick up commits made by other processes (caller holds the lock)"""
+        commits = int(self._state[1])
+        if int(self._state[0]) != self.meta['generation']:
+            with open(os.path.join(self.directory, 'meta.json'), 'r') as f:
+                self.meta = json.load(f)
+            self._templates_file.close()
+            self._log_file.close()
+            self._open_generation()
+        elif commits != self._commits:
+            self._replay_log()
+        self._commits = commits
+
+    def has_changes(self):
+        """True if any process committed since this one last refreshed"""
+        return int(self._state[1]) != self._commits or bool(self._pending) or self._reloaded
+
+    def refresh(self):
+        """Records committed since the last refresh, by this or any other process
+
+        Returns the list of applied {"op": ..., "studentId": ..., "row": ...}
+        records in commit order, or None if the store was compacted meanwhile
+        and every row may have moved (callers reload everything).
+        """
+        with self._locked():
+            self._catch_up()
+            if self._reloaded:
+                self._reloaded = False
+                self._pending = []
+                return None
+            records, self._pending = self._pending, []
+            return records
+
+    def _apply(self, record):
+        if record['op'] == 'add_many':
+            # Consumers of refresh() see the usual one record per row
+            for offset, student_id in enumerate(record['studentIds']):
+                self._apply({'op': 'add', 'row': record['row'] + offset, 'studentId': student_id,
+                             'timestamp': record['timestamp']})
+            return
+
+        if record['op'] == 'projection':
+            # No rows change; consumers of refresh() reload the projection
+            self._pending.append(record)
+            return
+
+        student_id = record['studentId']
+        if record['op'] == 'add':
+            row = record['row']
+            if row != len(self._row_students):
+                raise RuntimeError(f"Registration log is out of order at row {row}")
+            self._row_students.append(student_id)
+            self._student_rows.setdefault(student_id, []).append(row)
+            if record.get('archived'):
+                self._archived_rows.add(row)
+        elif record['op'] == 'drop':
+            for row in self._student_rows.pop(student_id, []):
+                self._row_students[row] = None
+                self._archived_rows.discard(row)
+                self.dead_rows += 1
+        self._pending.append(record)
+
+    # Reading
+
+    def __len__(self):
+        return len(self._row_students) - self.dead_rows
+
+    @property
+    def total_rows(self):
+        return len(self._row_students)
+
+    def students(self):
+        return list(self._student_rows.keys())
+
+    def count(self, student_id):
+        """Number of live templates registered for a student"""
+        return len(self._student_rows.get(student_id, []))
+
+    def templates(self):
+        """Read-only memory map of every row in the template file, live or dropped"""
+        rows = self.total_rows
+        if self._mapped is None or self._mapped.shape[0] != rows:
+            if rows == 0:
+                self._mapped = np.empty((0, self.dim), dtype=self.dtype)
+            else:
+                self._mapped = np.memmap(self._template_path(), dtype=self.dtype, mode='r',
+                                         shape=(rows, self.dim))
+        return self._mapped
+
+    def row_students(self):
+        """Student id of every row in the template file, None for dropped rows"""
+        return list(self._row_students)
+
+    def live_rows(self):
+        """Row numbers and student ids of every live template, in row order"""
+        rows = [row for row, student_id in enumerate(self._row_students) if student_id is not None]
+        return np.array(rows, dtype=np.int64), [self._row_students[row] for row in rows]
+
+    def decode(self, codes):
+        """Convert stored rows back to float32 encodings"""
+        return np.asarray(codes, dtype=np.float32) / np.float32(self.scale)
+
+    def quantize(self, encodings):
+        """Convert encodings (one per row) to stored rows"""
+        codes = np.rint(np.asarray(encodings, dtype=np.float64).reshape(-1, self.dim) * self.scale)
+        if np.issubdtype(self.dtype, np.integer):
+            info = np.iinfo(self.dtype)
+            codes = np.clip(codes, info.min, info.max)
+        return codes.astype(self.dtype)
+
+    # Writing
+
+    def _log(self, record):
+        # Binary, so the offset counts exactly the bytes _replay_log() reads back
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        self._log_offset += self._log_file.write(line)
+        self._log_file.flush()
+        # Publish the commit to other processes
+        self._state[1] += 1
+        self._commits += 1
+
+    def append(self, student_id, encoding):
+        """Persist one template for a student and return its row number"""
+        encoding = np.asarray(encoding).ravel()
+        if encoding.shape[0] != self.dim:
+            raise ValueError(f"Encoding has {encoding.shape[0]} dimensions, store expects {self.dim}")
+        codes = self.quantize(encoding)
+
+        with self._locked():
+            self._catch_up()
+            row = self.total_rows
+            # The row must be durable before the log line that commits it
+            self._templates_file.write(codes.tobytes())
+            self._templates_file.flush()
+            os.fsync(self._templates_file.fileno())
+            record = {'op': 'add', 'row': row, 'studentId': student_id,
+                      'timestamp': datetime.now().isoformat()}
+            self._log(record)
+            self._apply(record)
+        return row
+
+    def append_codes(self, student_ids, codes):
+        """Persist a block of already quantised templates in one transaction
+
+        All rows are written first and committed by a single log line, so
+        after a crash either every row of the block is registered or none
+        is. Returns the first row number.
+        """
+        codes = np.asarray(codes, dtype=self.dtype).reshape(-1, self.dim)
+        if len(codes) != len(student_ids):
+            raise ValueError(f"Got {len(codes)} templates for {len(student_ids)} student ids")
+        if len(codes) == 0:
+            return self.total_rows
+
+        with self._locked():
+            self._catch_up()
+            row = self.total_rows
+            for start in range(0, len(codes), 1024):
+                self._templates_file.write(np.ascontiguousarray(codes[start:start + 1024]).tobytes())
+            self._templates_file.flush()
+            os.fsync(self._templates_file.fileno())
+            record = {'op': 'add_many', 'row': row, 'studentIds': list(student_ids),
+                      'timestamp': datetime.now().isoformat()}
+            self._log(record)
+            self._apply(record)
+        return row
+
+    def drop_student(self, student_id):
+        """Remove every template of a student (reclaimed by the next compaction)"""
+        with self._locked():
+            self._catch_up()
+            if student_id not in self._student_rows:
+                return 0
+            dropped = len(self._student_rows[student_id])
+            record = {'op': 'drop', 'studentId': student_id,
+                      'timestamp': datetime.now().isoformat()}
+            self._log(record)
+            self._apply(record)
+        return dropped
+
+    def note_projection(self, version):
+        """Record that the matching projection changed, so every process reloads it"""
+        with self._locked():
+            self._catch_up()
+            record = {'op': 'projection', 'version': version, 'timestamp': datetime.now().isoformat()}
+            self._log(record)
+            self._apply(record)
+
+    def needs_compaction(self, min_dead_rows=64, max_dead_ratio=0.25):
+        return self.dead_rows >= min_dead_rows and self.dead_rows > self.total_rows * max_dead_ratio
+
+    def compact(self, keep=None, archive=None):
+        """Rewrite only the live rows into a fresh generation
+
+        keep optionally maps student ids to the set of their rows to carry
+        over; the student's other rows are left behind. With an archive
+        store, every row of those students whose original is not archived
+        yet is appended to it first, so nothing is lost if the compaction
+        is interrupted (at worst a rerun archives a row twice).
+        """
+        with self._locked():
+            self._catch_up()
+            rows, student_ids = self.live_rows()
+            templates = self.templates()
+            generation = self.meta['generation'] + 1
+
+            archived = set(self._archived_rows)
+            if keep:
+                if archive is not None:
+                    for student_id in keep:
+                        for row in self._student_rows.get(student_id, []):
+                            if row not in archived:
+                                archive.append(student_id, self.decode(templates[row]))
+                                archived.add(row)
+                carried = [i for i, (row, student_id) in enumerate(zip(rows, student_ids))
+                           if student_id not in keep or row in keep[student_id]]
+                rows = rows[carried]
+                student_ids = [student_ids[i] for i in carried]
+
+            with open(self._template_path(generation), 'wb') as f:
+                # Copy in chunks so compaction never holds the whole gallery in memory
+                for start in range(0, len(rows), 1024):
+                    f.write(np.ascontiguousarray(templates[rows[start:start + 1024]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self._log_path(generation), 'wb') as f:
+                timestamp = datetime.now().isoformat()
+                for new_row, (row, student_id) in enumerate(zip(rows, student_ids)):
+                    record = {'op': 'add', 'row': new_row, 'studentId': student_id, 'timestamp': timestamp}
+                    if row in archived:
+                        record['archived'] = True
+                    f.write(json.dumps(record).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            old_generation = self.meta['generation']
+            self._templates_file.close()
+            self._log_file.close()
+            self._mapped = None
+
+            # Switching meta.json to the new generation is the atomic commit;
+            # the state counter tells other processes to reopen
+            self.meta['generation'] = generation
+            self._write_meta()
+            self._state[0] = generation
+            self._state[1] += 1
+            self._open_generation()
+
+            for path in (self._template_path(old_generation), self._log_path(old_generation)):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Error removing compacted file {path}: {e}")
+
+    def consolidate(self, select, max_per_student, archive=None, student_ids=None):
+        """Reduce every student with more than max_per_student templates to that many
+
+        select(encodings, k) returns the indices of the templates to keep.
+        The selection and the rewrite run under the store lock, so
+        registrations made meanwhile are not lost; the originals of reduced
+        students go to the archive store first (see compact). Returns a
+        summary dict.
+        """
+        if max_per_student < 1:
+            raise ValueError("max_per_student must be at least 1")
+
+        with self._locked():
+            self._catch_up()
+            templates = self.templates()
+            before = len(self)
+
+            keep = {}
+            for student_id in (self.students() if student_ids is None else student_ids):
+                rows = self._student_rows.get(student_id, [])
+                if len(rows) > max_per_student:
+                    chosen = select(self.decode(templates[rows]), max_per_student)
+                    keep[student_id] = {rows[i] for i in chosen}
+
+            if keep:
+                self.compact(keep=keep, archive=archive)
+
+            return {
+                'students': len(keep),
+                'templatesBefore': before,
+                'templatesAfter': len(self),
+                'generation': self.meta['generation']
+            }
+
+    def maybe_compact(self):
+        if self.needs_compaction():
+            self.compact()
+
+    def import_json(self, json_path):
+        """Import a legacy face_encodings.json file and rename it out of the way
+
+        Runs under the store lock, so when several workers start at once only
+        the first one imports. Every template is committed in one
+        append_codes() transaction, so an interrupted import leaves the
+        JSON file in place and registers nothing.
+        """
+        with self._locked():
+            if not os.path.exists(json_path):
+                return 0
+            with open(json_path, 'r') as f:
+                encodings_by_student = json.load(f)
+
+            student_ids, rows = [], []
+            for student_id, encodings in encodings_by_student.items():
+                for encoding in encodings:
+                    encoding = np.asarray(encoding).ravel()
+                    if encoding.shape[0] != self.dim:
+                        raise ValueError(f"Encoding has {encoding.shape[0]} dimensions, store expects {self.dim}")
+                    student_ids.append(student_id)
+                    rows.append(encoding)
+
+            if rows:
+                self.append_codes(student_ids, self.quantize(np.stack(rows)))
+            os.replace(json_path, json_path + '.migrated')
+            return len(rows)
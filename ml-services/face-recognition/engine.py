@@ -0,0 +1,213 @@
+import os
+import sys
+import urllib.request
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.detection import detect_scaled
+from common.model_registry import ModelRegistry
+from quality import QualityGate
+
+# Size of the grayscale crop produced by encode_face()
+FACE_SIZE = (100, 100)
+
+FACE_CASCADE_URL = ("https://raw.githubusercontent.com/opencv/opencv/master/data/haarcascades/"
+                    "haarcascade_frontalface_default.xml")
+
+
+def ensure_face_cascade(model_path):
+    """Return the path of the face cascade model, downloading it if missing"""
+    face_cascade_path = os.path.join(model_path, 'haarcascade_frontalface_default.xml')
+
+    # If the model doesn't exist, download it from opencv's github
+    if not os.path.exists(face_cascade_path):
+        print("Downloading face cascade model...")
+        os.makedirs(os.path.dirname(face_cascade_path), exist_ok=True)
+        urllib.request.urlretrieve(FACE_CASCADE_URL, face_cascade_path)
+
+    return face_cascade_path
+
+
+def face_crop(image, face_location):
+    """Grayscale FACE_SIZE crop of one face"""
+    # Extract face from the image
+    top, right, bottom, left = face_location
+    face_image = image[top:bottom, left:right]
+
+    # Resize to a standard size
+    face_image = cv2.resize(face_image, FACE_SIZE)
+
+    # Convert to grayscale
+    return cv2.cvtColor(face_image, cv2.COLOR_BGR2GRAY)
+
+
+def encode_face(image, face_location):
+    """Create a simplified face encoding using OpenCV"""
+    # Flatten the image as a simple "encoding"
+    # Note: This is a very simplified approach and not as robust as face_recognition's encodings
+    return face_crop(image, face_location).flatten() / 255.0  # Normalize
+
+
+def compare_faces(known_encoding, face_encoding, tolerance=0.6):
+    """Compare faces using a simple Euclidean distance"""
+    # Calculate Euclidean distance
+    distance = np.linalg.norm(np.array(known_encoding) - np.array(face_encoding))
+
+    # Lower distance = more similar
+    # Convert to a similar scale as face_recognition (where lower tolerance = stricter)
+    # A typical tolerance might be 0.6
+    match = distance < (1 - tolerance) * 100
+
+    return [match]
+
+
+def draw_matches(image, matches):
+    """Copy of an image with a labelled box around every matched face"""
+    image_with_boxes = image.copy()
+    for match in matches:
+        top, right, bottom, left = match['location']
+        # Draw rectangle around face
+        cv2.rectangle(image_with_boxes, (left, top), (right, bottom), (0, 255, 0), 2)
+        # Add student ID
+        cv2.putText(image_with_boxes, match['studentId'], (left, top - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    return image_with_boxes
+
+
+class FaceEngine:
+    """Detection, encoding and identification pipeline without a web framework
+
+    Used by the HTTP service, the bulk importer and offline batch jobs. The
+    face cascade is loaded once and concurrent callers borrow instances
+    from a small pool, so one engine can serve every request thread; worker
+    processes each build their own engine.
+    """
+
+    def __init__(self, cascade_path, detection_width=640, min_face=24, max_face=0, quality_gate=None):
+        self.detection_width = detection_width
+        self.min_face = min_face
+        self.max_face = max_face
+        self.quality_gate = quality_gate or QualityGate()
+        self.models = ModelRegistry()
+        self.models.register('face_cascade', cv2.CascadeClassifier, cascade_path)
+
+    def cascade(self):
+        """Context manager lending the caller a face cascade from the pool"""
+        return self.models.checkout('face_cascade')
+
+    def detect_faces(self, image, detection_width=None):
+        """Detect faces in an image using OpenCV instead of face_recognition
+
+        Detection runs on a copy downscaled to detection_width (the engine's
+        by default); the returned locations are in full-resolution
+        coordinates, so encode_face() still crops from the original frame.
+        """
+        # Convert to grayscale for face detection
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        return self.detect_faces_gray(gray, detection_width)
+
+    def detect_faces_gray(self, gray, detection_width=None):
+        """detect_faces() for a frame that is already grayscale"""
+        with self.cascade() as cascade:
+            faces = detect_scaled(cascade, gray, detection_width or self.detection_width,
+                                  min_size=self.min_face, max_size=self.max_face)
+
+        # Convert to face_recognition format (top, right, bottom, left)
+        return [(y, x + w, y + h, x) for (x, y, w, h) in faces]
+
+    def analyze(self, image, detection_width=None):
+        """Memoised FrameAnalysis of one image"""
+        return FrameAnalysis(self, image, detection_width)
+
+    def identify(self, frame, gallery, tolerance=0.6):
+        """Identify every face of a group photo (a FrameAnalysis) against a gallery
+
+        Faces that fail the quality gate are reported instead of matched.
+        The others are encoded and resolved against every student in one
+        distance matrix with a one-to-one assignment (no student matched
+        twice). Returns (matches, rejected) lists.
+        """
+        face_locations = frame.face_locations
+        usable, rejected = [], []
+        for i, quality in enumerate(frame.quality()):
+            if quality['passed']:
+                usable.append(i)
+            else:
+                rejected.append({'faceIndex': i, 'location': face_locations[i],
+                                 'reasons': quality['reasons'], 'quality': quality['metrics']})
+
+        assignments = gallery.assign([frame.encoding(i) for i in usable], tolerance=tolerance)
+
+        matches = []
+        for i, assigned in zip(usable, assignments):
+            if assigned:
+                matches.append({
+                    'studentId': assigned['studentId'],
+                    'confidence': assigned['score'],
+                    'faceIndex': i,
+                    'location': face_locations[i]
+                })
+        return matches, rejected
+
+
+class FrameAnalysis:
+    """Lazily computed, memoised analysis of one frame
+
+    Callers chain liveness, quality and matching checks on the same
+    frame; each stage (grayscale, face boxes, crops, encodings) is computed
+    the first time a check asks for it and reused afterwards, so no stage
+    runs twice per frame. Instances are per request and not thread-safe.
+    """
+
+    def __init__(self, engine, image, detection_width=None):
+        self.engine = engine
+        self.image = image
+        self.detection_width = detection_width or engine.detection_width
+        self._gray = None
+        self._face_locations = None
+        self._crops = {}
+        self._encodings = {}
+        self._quality = {}
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def face_locations(self):
+        """Face boxes as (top, right, bottom, left) in full-resolution coordinates"""
+        if self._face_locations is None:
+            self._face_locations = self.engine.detect_faces_gray(self.gray, self.detection_width)
+        return self._face_locations
+
+    @property
+    def face_count(self):
+        return len(self.face_locations)
+
+    def crop(self, i=0):
+        """Grayscale FACE_SIZE crop of face i"""
+        if i not in self._crops:
+            self._crops[i] = face_crop(self.image, self.face_locations[i])
+        return self._crops[i]
+
+    def encoding(self, i=0):
+        """encode_face() encoding of face i"""
+        if i not in self._encodings:
+            self._encodings[i] = self.crop(i).flatten() / 255.0
+        return self._encodings[i]
+
+    def encodings(self):
+        return [self.encoding(i) for i in range(self.face_count)]
+
+    def quality(self, check_centering=False):
+        """Quality gate assessment of every face, scored together in one pass"""
+        if check_centering not in self._quality:
+            crops = [self.crop(i) for i in range(self.face_count)]
+            self._quality[check_centering] = self.engine.quality_gate.assess(
+                crops, self.face_locations, self.image.shape, check_centering)
+        return self._quality[check_centering]
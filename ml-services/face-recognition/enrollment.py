@@ -0,0 +1,201 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+from engine import FACE_SIZE, FaceEngine, ensure_face_cascade
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Reason codes of rejected files
+REJECT_MESSAGES = {
+    'bad_name': 'File name is not <studentId>_*.jpg',
+    'too_large': 'Image file too large',
+    'unreadable': 'Image could not be decoded',
+    'no_face': 'No face detected',
+    'multiple_faces': 'Multiple faces detected'
+}
+
+
+def student_id_from_name(name):
+    """Student id of a <studentId>_*.jpg file name, or None"""
+    stem, extension = os.path.splitext(os.path.basename(name))
+    if extension.lower() not in IMAGE_EXTENSIONS or '_' not in stem:
+        return None
+    return stem.split('_', 1)[0] or None
+
+
+def is_archive(path):
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+def iter_enrollment_files(source, max_image_bytes):
+    """Yield (name, path, data) for every file of a directory, zip or tar archive
+
+    Directory files are read by the workers (data is None); archive members
+    are read here and handed over as bytes, None when larger than
+    max_image_bytes.
+    """
+    if os.path.isdir(source):
+        for root, _, files in sorted(os.walk(source)):
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, source), path, None
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for member in archive.infolist():
+                if not member.is_dir():
+                    data = archive.read(member) if member.file_size <= max_image_bytes else None
+                    yield member.filename, None, data
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, 'r:*') as archive:
+            for member in archive:
+                if member.isfile():
+                    data = archive.extractfile(member).read() if member.size <= max_image_bytes else None
+                    yield member.name, None, data
+    else:
+        raise ValueError(f"{source} is not a directory, zip or tar archive")
+
+
+# FaceEngine of each worker process, set by init_worker
+_worker = {}
+
+
+def init_worker(cascade_path, detection_width, min_face, max_face):
+    # One OpenCV thread per process; the pool already uses every core
+    cv2.setNumThreads(1)
+    _worker['engine'] = FaceEngine(cascade_path, detection_width=detection_width,
+                                   min_face=min_face, max_face=max_face)
+
+
+def encode_enrollment_image(name, path, data, max_image_bytes):
+    """Detect and encode the single face of one image (runs in a worker process)
+
+    Returns (name, crop, reason): the FACE_SIZE grayscale crop as uint8
+    (the encoding is crop / 255) or None with a reject reason.
+    """
+    if path is not None:
+        if os.path.getsize(path) > max_image_bytes:
+            return name, None, 'too_large'
+        with open(path, 'rb') as f:
+            data = f.read()
+    elif data is None:
+        return name, None, 'too_large'
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if data else None
+    if image is None:
+        return name, None, 'unreadable'
+
+    frame = _worker['engine'].analyze(image)
+    if frame.face_count == 0:
+        return name, None, 'no_face'
+    elif frame.face_count > 1:
+        return name, None, 'multiple_faces'
+    return name, frame.crop(0), None
+
+
+def import_enrollment(source, store, cascade_path, detection_width=640,
+                      min_face=24, max_face=0, workers=None, max_image_bytes=16 * 1024 * 1024,
+                      dry_run=False):
+    """Register every <studentId>_*.jpg image of a directory or archive
+
+    Images are decoded, detected and encoded on a pool of worker processes
+    (at most a few per worker in flight, so archives are never held in
+    memory at once). Files without exactly one face are rejected. All
+    accepted templates are committed to the store in one transaction at
+    the end, or not at all with dry_run. Returns a summary dict with a
+    per-file list of rejects.
+    """
+    start_time = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    accepted, rejected = {}, []
+    files = 0
+
+    def collect(future):
+        name, crop, reason = future.result()
+        if reason:
+            rejected.append({'file': name, 'reason': reason, 'message': REJECT_MESSAGES[reason]})
+        else:
+            accepted[name] = store.quantize(crop.ravel() / 255.0)[0]
+
+    # Workers are spawned rather than forked, so a caller's threads and the
+    # locks they hold are never copied into a worker
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(cascade_path, detection_width, min_face, max_face)) as pool:
+        pending = set()
+        for name, path, data in iter_enrollment_files(source, max_image_bytes):
+            files += 1
+            if student_id_from_name(name) is None:
+                rejected.append({'file': name, 'reason': 'bad_name', 'message': REJECT_MESSAGES['bad_name']})
+                continue
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            pending.add(pool.submit(encode_enrollment_image, name, path, data, max_image_bytes))
+        for future in wait(pending).done:
+            collect(future)
+
+    # Rows are committed in file name order whatever order the workers finished in
+    names = sorted(accepted)
+    student_ids = [student_id_from_name(name) for name in names]
+    if names and not dry_run:
+        store.append_codes(student_ids, np.stack([accepted[name] for name in names]))
+
+    return {
+        'files': files,
+        'enrolled': len(names),
+        'students': len(set(student_ids)),
+        'rejected': sorted(rejected, key=lambda reject: reject['file']),
+        'committed': bool(names) and not dry_run,
+        'seconds': round(time.perf_counter() - start_time, 2)
+    }
+
+
+if __name__ == '__main__':
+    from encoding_store import EncodingStore
+
+    DATA_PATH = os.environ.get('DATA_PATH', 'data')
+    MODEL_PATH = os.environ.get('MODEL_PATH', 'models')
+
+    parser = argparse.ArgumentParser(description='Bulk-register <studentId>_*.jpg face images')
+    parser.add_argument('source', help='Directory, zip or tar archive of images')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('IMPORT_WORKERS', 0)) or None,
+                        help='Worker processes (default: one per CPU)')
+    parser.add_argument('--dry-run', action='store_true', help='Report without registering anything')
+    parser.add_argument('--rejects', help='Write the rejected files to this JSON file')
+    parser.add_argument('--summary', help='Write the import summary to this JSON file')
+    parser.add_argument('--max-image-bytes', type=int, default=16 * 1024 * 1024,
+                        help='Reject images larger than this')
+    args = parser.parse_args()
+
+    store = EncodingStore(os.path.join(DATA_PATH, 'gallery'), dim=FACE_SIZE[0] * FACE_SIZE[1])
+    summary = import_enrollment(
+        args.source, store, ensure_face_cascade(MODEL_PATH),
+        detection_width=int(os.environ.get('DETECTION_WIDTH', 640)),
+        min_face=int(os.environ.get('DETECTION_MIN_FACE', 24)),
+        max_face=int(os.environ.get('DETECTION_MAX_FACE', 0)),
+        workers=args.workers, max_image_bytes=args.max_image_bytes, dry_run=args.dry_run
+    )
+
+    for reject in summary['rejected']:
+        print(f"Rejected {reject['file']}: {reject['message']}")
+    if args.rejects:
+        with open(args.rejects, 'w') as f:
+            json.dump(summary['rejected'], f, indent=2)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f)
+    action = 'Would register' if args.dry_run else 'Registered'
+    print(f"{action} {summary['enrolled']} of {summary['files']} images for {summary['students']} students "
+          f"in {summary['seconds']}s ({len(summary['rejected'])} rejected)")
+    if summary['committed']:
+        print("Running services pick up the new templates on their next request")
@@ -0,0 +1,527 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+
+def distance_threshold(tolerance=0.6):
+    """Distance below which two encodings are a match (same scale as compare_faces)"""
+    return (1 - tolerance) * 100
+
+
+def distance_to_score(distance):
+    """Convert a distance to a 0-1 confidence score"""
+    return float(max(0.0, min(1.0, 1 - (distance / 100))))
+
+
+# One published version of the gallery. codes, norms and labels may be
+# longer than count (spare capacity); rows below count never change once
+# published, and student_rows maps label -> tuple of rows.
+GalleryState = namedtuple('GalleryState', ['codes', 'norms', 'labels', 'count', 'student_rows', 'dead_rows'])
+
+
+class FaceGallery:
+    """Registered face templates packed into one contiguous quantised matrix
+
+    Row i of the matrix belongs to students[labels[i]]. Templates are kept
+    as integer codes, code = round(encoding * scale):
+
+    - uint8 with scale 255 for raw encode_face() output, which is pixel / 255,
+      so the codes are the original pixels and storage is exact
+    - int8 with a projection-specific scale for mean-centred projected
+      encodings
+
+    Squared norms of every template are precomputed so a query is matched
+    against the whole gallery with integer matrix-vector products:
+
+        |t - q|^2 = |t|^2 + |q|^2 - 2 t.q
+
+    The integer squared distance is compared against (threshold * scale)^2
+    and only rescaled to a float distance for reporting, so match decisions
+    are identical to compare_faces() on the unquantised encodings.
+
+    space names the encoding space of the templates ('raw' for encode_face()
+    output, or a projection version) and queries from another space are
+    rejected.
+
+    Rows are also indexed per student, so a claimed-identity check only
+    touches that student's templates. An approximate index (ann_index) or a
+    signature prefilter (prefilter) can narrow 1:N searches to candidate
+    rows, which are then ranked with exact distances.
+
+    The code matrix can instead be adopted from a read-only memory map of
+    the template file (map_codes()), so worker processes share one copy
+    through the page cache. Dropped rows keep their place with label -1 and
+    are never returned.
+
+    The gallery is safe to share between threads. Every read works on the
+    GalleryState that was current when it started and never takes a lock.
+    Writers are serialised by a lock. They fill rows past the published
+    count (or copy an array they must change in place, such as the labels on
+    a drop) and then publish a new state with a single reference swap, so a
+    registration never blocks or tears concurrent matches.
+    """
+
+    # Rows converted to int32 per step of the distance kernel; small enough
+    # that the widened block stays in cache
+    CHUNK_ROWS = 64
+
+    def __init__(self, dim=None, space='raw', dtype='uint8', scale=255.0):
+        self.dim = dim
+        self.space = space
+        self.dtype = np.dtype(dtype)
+        self.scale = float(scale)
+        self._state = GalleryState(
+            codes=np.empty((0, dim or 0), dtype=self.dtype),
+            norms=np.empty(0, dtype=np.int64),
+            labels=np.empty(0, dtype=np.int32),
+            count=0,
+            student_rows={},
+            dead_rows=0
+        )
+        # Append-only, so a label in any published state always resolves
+        self.students = []
+        self._student_labels = {}
+        self._mapped = False
+        self._write_lock = threading.Lock()
+        self.index = None
+        self.prefilter = None
+
+    @classmethod
+    def from_dict(cls, encodings_by_student, **kwargs):
+        """Build a gallery from the {studentId: [encoding, ...]} layout"""
+        gallery = cls(**kwargs)
+        for student_id, encodings in encodings_by_student.items():
+            for encoding in encodings:
+                gallery.add(student_id, encoding)
+        return gallery
+
+    def __len__(self):
+        return self._state.count
+
+    def snapshot(self):
+        """The current published state; stays consistent while writers continue"""
+        return self._state
+
+    @property
+    def codes(self):
+        state = self._state
+        return state.codes[:state.count]
+
+    @property
+    def norms(self):
+        state = self._state
+        return state.norms[:state.count]
+
+    @property
+    def labels(self):
+        state = self._state
+        return state.labels[:state.count]
+
+    def student_id(self, row):
+        return self.students[self._state.labels[row]]
+
+    @property
+    def mapped(self):
+        return self._mapped
+
+    def memory_bytes(self):
+        """Private bytes held by the template matrix, norms and labels
+
+        A mapped template matrix lives in the shared page cache and is not
+        counted.
+        """
+        state = self._state
+        codes_bytes = 0 if self._mapped else state.codes.nbytes
+        return int(codes_bytes + state.norms.nbytes + state.labels.nbytes)
+
+    def quantize(self, encodings):
+        """Integer codes for one encoding or a block of encodings"""
+        codes = np.rint(np.asarray(encodings, dtype=np.float32) * np.float32(self.scale))
+        info = np.iinfo(self.dtype)
+        return np.clip(codes, info.min, info.max).astype(self.dtype)
+
+    # Writing (callers hold _write_lock)
+
+    def _reserve(self, state, rows):
+        """Buffers with room for rows, grown geometrically so add() is amortised O(1)
+
+        Growing copies into new arrays, so readers of the old state keep
+        valid (shorter) arrays.
+        """
+        codes, norms, labels = state.codes, state.norms, state.labels
+        capacity = norms.shape[0]
+        if rows <= capacity:
+            return codes, norms, labels
+        new_capacity = max(rows, capacity * 2, 16)
+        if not self._mapped:
+            codes = np.empty((new_capacity, self.dim), dtype=self.dtype)
+            codes[:state.count] = state.codes[:state.count]
+        norms = np.empty(new_capacity, dtype=np.int64)
+        norms[:state.count] = state.norms[:state.count]
+        labels = np.empty(new_capacity, dtype=np.int32)
+        labels[:state.count] = state.labels[:state.count]
+        return codes, norms, labels
+
+    def add(self, student_id, encoding):
+        """Append one template for a student"""
+        self.add_many([student_id], np.asarray(encoding).reshape(1, -1))
+
+    def add_many(self, student_ids, encodings):
+        """Append a block of float encodings, one row per entry in student_ids"""
+        if len(student_ids) == 0:
+            return
+        self.add_codes(student_ids, self.quantize(encodings))
+
+    def add_codes(self, student_ids, codes):
+        """Append a block of templates already quantised with this gallery's scale"""
+        if len(student_ids) == 0:
+            return
+        with self._write_lock:
+            if self._mapped:
+                raise ValueError("Gallery codes are mapped from a template file; append there and call map_codes()")
+            codes = np.asarray(codes, dtype=self.dtype)
+            state = self._state
+            if self.dim is None:
+                self.dim = codes.shape[1]
+                state = state._replace(codes=np.empty((0, self.dim), dtype=self.dtype))
+            if codes.shape != (len(student_ids), self.dim):
+                raise ValueError(f"Expected {len(student_ids)} x {self.dim} encodings, got {codes.shape}")
+
+            start, end = state.count, state.count + len(student_ids)
+            buffer, norms, labels = self._reserve(state, end)
+            buffer[start:end] = codes
+            self._append_rows(state, buffer, norms, labels, student_ids, codes)
+
+    def map_codes(self, codes, student_ids):
+        """Adopt codes as the template matrix without copying it
+
+        codes is typically a read-only memory map of the template file; its
+        first len(self) rows must be the rows already in the gallery, and
+        student_ids names the rows after them (None for a dropped row).
+        """
+        with self._write_lock:
+            state = self._state
+            if codes.dtype != self.dtype:
+                raise ValueError(f"Expected {self.dtype} codes, got {codes.dtype}")
+            if state.count and not self._mapped:
+                raise ValueError("Cannot map codes under a gallery that already holds its own rows")
+            if self.dim is None:
+                self.dim = codes.shape[1]
+            start, end = state.count, state.count + len(student_ids)
+            if codes.ndim != 2 or codes.shape[1] != self.dim or codes.shape[0] < end:
+                raise ValueError(f"Expected at least {end} x {self.dim} codes, got {codes.shape}")
+
+            self._mapped = True
+            _, norms, labels = self._reserve(state, end)
+            self._append_rows(state, codes, norms, labels, student_ids, codes[start:end])
+
+    def _append_rows(self, state, codes, norms, labels, student_ids, new_codes):
+        """Fill norms and labels for rows written past state.count, then publish them"""
+        start, end = state.count, state.count + len(student_ids)
+        norms[start:end] = self._squared_norms(new_codes)
+        new_labels = [-1 if student_id is None else self._label_for(student_id) for student_id in student_ids]
+        labels[start:end] = new_labels
+
+        student_rows = dict(state.student_rows)
+        added = {}
+        dead_rows = state.dead_rows
+        for row, label in enumerate(new_labels, start):
+            if label < 0:
+                dead_rows += 1
+            else:
+                added.setdefault(label, []).append(row)
+        for label, rows in added.items():
+            student_rows[label] = student_rows.get(label, ()) + tuple(rows)
+
+        # The index may propose rows before the state that covers them is
+        # published; readers discard rows past their own count
+        if self.index is not None:
+            self.index.add_many(new_codes)
+        if self.prefilter is not None:
+            self.prefilter.add_many(new_codes)
+        self._state = GalleryState(codes, norms, labels, end, student_rows, dead_rows)
+
+    def drop_student(self, student_id):
+        """Stop matching every template of a student; returns the number of rows dropped"""
+        with self._write_lock:
+            state = self._state
+            label = self._student_labels.get(student_id)
+            rows = state.student_rows.get(label, ())
+            if not rows:
+                return 0
+
+            # Copy on write: readers may still be ranking with the old labels
+            labels = state.labels.copy()
+            labels[list(rows)] = -1
+            student_rows = dict(state.student_rows)
+            del student_rows[label]
+            self._state = state._replace(labels=labels, student_rows=student_rows,
+                                         dead_rows=state.dead_rows + len(rows))
+            return len(rows)
+
+    def _label_for(self, student_id):
+        label = self._student_labels.get(student_id)
+        if label is None:
+            label = len(self.students)
+            self.students.append(student_id)
+            self._student_labels[student_id] = label
+        return label
+
+    def student_rows(self, student_id, state=None):
+        """Rows holding a student's templates, or None if the student has none"""
+        state = state or self._state
+        rows = state.student_rows.get(self._student_labels.get(student_id), ())
+        if not rows:
+            return None
+        return np.asarray(rows, dtype=np.int64)
+
+    def _squared_norms(self, codes):
+        norms = np.empty(len(codes), dtype=np.int64)
+        for start in range(0, len(codes), self.CHUNK_ROWS):
+            block = codes[start:start + self.CHUNK_ROWS].astype(np.int32)
+            norms[start:start + self.CHUNK_ROWS] = np.einsum('ij,ij->i', block, block, dtype=np.int64)
+        return norms
+
+    def build_index(self, index):
+        """Train an approximate index on the current templates and use it for matching"""
+        with self._write_lock:
+            state = self._state
+            if state.count:
+                index.train(state.codes[:state.count])
+            self.index = index
+
+    def build_prefilter(self, prefilter):
+        """Compute signatures of the current templates and prune matches with them"""
+        with self._write_lock:
+            state = self._state
+            prefilter.train(state.codes[:state.count])
+            self.prefilter = prefilter
+
+    # Reading (lock-free, each call works on one state)
+
+    def squared_code_distances(self, query_codes, rows=None, state=None):
+        """Exact integer squared distances from query codes to every template (or the given rows)
+
+        A uint8 dot product is at most 255^2 * dim, so int32 accumulation is
+        exact up to 33,000 dimensions.
+        """
+        state = state or self._state
+        query = np.asarray(query_codes, dtype=np.int32).ravel()
+        if rows is None:
+            codes, norms = state.codes[:state.count], state.norms[:state.count]
+        else:
+            codes, norms = state.codes[rows], state.norms[rows]
+
+        dots = np.empty(len(codes), dtype=np.int64)
+        for start in range(0, len(codes), self.CHUNK_ROWS):
+            dots[start:start + self.CHUNK_ROWS] = codes[start:start + self.CHUNK_ROWS].astype(np.int32) @ query
+        return norms + int(np.dot(query, query)) - 2 * dots
+
+    def distances(self, encoding, rows=None):
+        """Euclidean distance from one float encoding to every template (or the given rows)"""
+        squared = self.squared_code_distances(self.quantize(np.asarray(encoding).ravel()), rows)
+        return np.sqrt(squared) / self.scale
+
+    def squared_code_distances_many(self, query_codes, rows=None, state=None):
+        """Integer squared distance matrix (queries x templates) in one pass over the gallery"""
+        state = state or self._state
+        queries = np.asarray(query_codes, dtype=np.int32)
+        if rows is None:
+            codes, norms = state.codes[:state.count], state.norms[:state.count]
+        else:
+            codes, norms = state.codes[rows], state.norms[rows]
+
+        dots = np.empty((len(queries), len(codes)), dtype=np.int64)
+        for start in range(0, len(codes), self.CHUNK_ROWS):
+            dots[:, start:start + self.CHUNK_ROWS] = queries @ codes[start:start + self.CHUNK_ROWS].astype(np.int32).T
+        query_norms = np.einsum('ij,ij->i', queries, queries, dtype=np.int64)
+        return norms[None, :] + query_norms[:, None] - 2 * dots
+
+    def _check_space(self, space):
+        if space != self.space:
+            raise ValueError(f"Query encoding is in space '{space}' but the gallery is in '{self.space}'")
+
+    def _rank(self, squared, labels, tolerance, top_k, dead_rows=0):
+        """Best match, match count and top-k students from one row of squared distances"""
+        threshold_squared = (distance_threshold(tolerance) * self.scale) ** 2
+        matched = squared < threshold_squared
+
+        # Closest template per student, in ascending order of distance
+        order = np.argsort(squared, kind='stable')
+        if dead_rows:
+            order = order[labels[order] >= 0]
+            if len(order) == 0:
+                return {'best': None, 'matchCount': 0, 'candidates': [], 'searched': len(squared)}
+        _, first = np.unique(labels[order], return_index=True)
+        # The best match is always reported, whatever top_k the caller asked for
+        best = order[np.sort(first)][:max(1, int(top_k))]
+
+        candidates = []
+        for i in best:
+            distance = float(np.sqrt(squared[i]) / self.scale)
+            candidates.append({
+                'studentId': self.students[labels[i]],
+                'distance': round(distance, 4),
+                'score': round(distance_to_score(distance), 4),
+                'match': bool(matched[i])
+            })
+
+        match_count = 0
+        if candidates[0]['match']:
+            match_count = int(np.count_nonzero((labels == labels[best[0]]) & matched))
+
+        return {
+            'best': candidates[0] if candidates[0]['match'] else None,
+            'matchCount': match_count,
+            'candidates': candidates,
+            'searched': len(squared)
+        }
+
+    def _index_rows(self, query_codes, exact, state):
+        """Candidate rows proposed by the approximate index or the signature prefilter
+
+        None means a full scan. The index takes precedence; the prefilter
+        serves galleries too small to be worth an index.
+        """
+        if exact:
+            return None
+        index = self.index
+        if index is not None and index.trained:
+            rows = np.unique(np.concatenate([index.candidates(codes) for codes in query_codes]))
+        elif self.prefilter is not None and self.prefilter.trained:
+            rows = np.unique(np.concatenate([self.prefilter.candidates(codes, state.count)
+                                             for codes in query_codes]))
+        else:
+            return None
+        # Rows appended after this state was published
+        rows = rows[rows < state.count]
+        return rows if len(rows) else None
+
+    def match(self, encoding, tolerance=0.6, top_k=5, exact=False, space='raw'):
+        """Find the best matching student and the top-k candidate students
+
+        When an approximate index is trained, only the rows it proposes are
+        re-ranked with exact distances; pass exact=True to scan everything.
+        Returns None when the gallery is empty, otherwise a dict with the best
+        candidate (or None if nothing is within tolerance), the number of its
+        templates that matched, and the top-k students ordered by distance.
+        """
+        self._check_space(space)
+        state = self._state
+        if state.count == 0:
+            return None
+
+        query_codes = self.quantize(np.asarray(encoding).ravel())
+        rows = self._index_rows([query_codes], exact, state)
+        squared = self.squared_code_distances(query_codes, rows, state)
+        labels = state.labels[:state.count] if rows is None else state.labels[rows]
+        result = self._rank(squared, labels, tolerance, top_k, state.dead_rows)
+        if rows is not None:
+            self._audit(query_codes[None, :], [result], tolerance, state)
+        return result
+
+    def verify(self, student_id, encoding, tolerance=0.6, space='raw'):
+        """1:1 match against the claimed student's templates only
+
+        Cost depends on that student's template count, not the gallery size.
+        Returns None when the student has no templates, otherwise the same
+        dict as match() with the student as the only candidate.
+        """
+        self._check_space(space)
+        state = self._state
+        rows = self.student_rows(student_id, state)
+        if rows is None:
+            return None
+
+        query_codes = self.quantize(np.asarray(encoding).ravel())
+        squared = self.squared_code_distances(query_codes, rows, state)
+        return self._rank(squared, state.labels[rows], tolerance, 1)
+
+    def match_many(self, encodings, tolerance=0.6, top_k=5, exact=False, space='raw'):
+        """match() for a block of encodings with a single distance-matrix computation
+
+        With an approximate index the union of every query's candidate rows
+        is scored at once.
+        """
+        self._check_space(space)
+        state = self._state
+        if state.count == 0 or len(encodings) == 0:
+            return [None] * len(encodings)
+
+        query_codes = self.quantize(np.asarray(encodings).reshape(len(encodings), -1))
+        rows = self._index_rows(query_codes, exact, state)
+        squared = self.squared_code_distances_many(query_codes, rows, state)
+        labels = state.labels[:state.count] if rows is None else state.labels[rows]
+        results = [self._rank(row, labels, tolerance, top_k, state.dead_rows) for row in squared]
+        if rows is not None:
+            self._audit(query_codes, results, tolerance, state)
+        return results
+
+    def _audit(self, query_codes, results, tolerance, state):
+        """Occasionally repeat a pruned search exhaustively and record whether the best match agrees"""
+        prefilter = self.prefilter
+        if prefilter is None or (self.index is not None and self.index.trained) or not prefilter.should_audit():
+            return
+        squared = self.squared_code_distances_many(query_codes, state=state)
+        labels = state.labels[:state.count]
+        for row, result in zip(squared, results):
+            exhaustive = self._rank(row, labels, tolerance, 1, state.dead_rows)
+            pruned_best = result['best']['studentId'] if result['best'] else None
+            exhaustive_best = exhaustive['best']['studentId'] if exhaustive['best'] else None
+            prefilter.record_audit(pruned_best == exhaustive_best)
+
+    def student_distance_matrix(self, encodings, space='raw', state=None):
+        """Distance from every encoding to every student's closest template (faces x students)"""
+        self._check_space(space)
+        state = state or self._state
+        query_codes = self.quantize(np.asarray(encodings).reshape(len(encodings), -1))
+        squared = self.squared_code_distances_many(query_codes, state=state)
+
+        # Reduce template columns to one column per student
+        labels = state.labels[:state.count]
+        order = np.argsort(labels, kind='stable')
+        sorted_labels = labels[order]
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        per_student = np.minimum.reduceat(squared[:, order], starts, axis=1)
+        student_labels = sorted_labels[starts]
+        if len(student_labels) and student_labels[0] < 0:
+            # Dropped rows sort first as label -1
+            per_student, student_labels = per_student[:, 1:], student_labels[1:]
+        return np.sqrt(per_student) / self.scale, student_labels
+
+    def assign(self, encodings, tolerance=0.6, space='raw'):
+        """One-to-one assignment of faces to students
+
+        Every (face, student) pair within tolerance is taken greedily in
+        order of increasing distance, skipping faces and students that are
+        already assigned, so no student is matched to two faces. Returns one
+        entry per encoding: None, or the assigned student with its distance
+        and score.
+        """
+        assignments = [None] * len(encodings)
+        state = self._state
+        if state.count == 0 or len(encodings) == 0:
+            return assignments
+
+        distances, student_labels = self.student_distance_matrix(encodings, space=space, state=state)
+        faces, columns = np.nonzero(distances < distance_threshold(tolerance))
+        pair_distances = distances[faces, columns]
+
+        used_faces = set()
+        used_students = set()
+        for k in np.argsort(pair_distances, kind='stable'):
+            face, column = int(faces[k]), int(columns[k])
+            if face in used_faces or column in used_students:
+                continue
+            used_faces.add(face)
+            used_students.add(column)
+            distance = float(pair_distances[k])
+            assignments[face] = {
+                'studentId': self.students[student_labels[column]],
+                'distance': round(distance, 4),
+                'score': round(distance_to_score(distance), 4)
+            }
+            if len(used_faces) == len(encodings):
+                break
+        return assignments
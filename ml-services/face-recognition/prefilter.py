@@ -0,0 +1,145 @@
+import math
+import random
+import threading
+
+import numpy as np
+
+from ann_index import squared_distances
+
+
+def thumbnail_signature(image_side=100, signature_side=20):
+    """Signature of raw face crops: the crop box-averaged down to a small thumbnail
+
+    Every signature_side x signature_side cell is the mean of a block of
+    pixels, multiplied by the block's side length, so the Euclidean distance
+    between two signatures never exceeds the distance between the full
+    crops (Cauchy-Schwarz on each block). image_side must be a multiple of
+    signature_side.
+    """
+    if image_side % signature_side:
+        raise ValueError(f"Crop side {image_side} is not a multiple of signature side {signature_side}")
+    block = image_side // signature_side
+
+    def signature(codes):
+        blocks = np.asarray(codes, dtype=np.float32).reshape(-1, signature_side, block, signature_side, block)
+        return blocks.mean(axis=(2, 4)).reshape(len(blocks), -1) * np.float32(block)
+
+    signature.dim = signature_side * signature_side
+    return signature
+
+
+def prefix_signature(dims=16):
+    """Signature of projected encodings: their first (highest-variance) components
+
+    Dropping coordinates can only shrink a Euclidean distance, so this is a
+    lower bound as well.
+    """
+    def signature(codes):
+        return np.asarray(codes, dtype=np.float32).reshape(len(codes), -1)[:, :dims]
+
+    signature.dim = dims
+    return signature
+
+
+class SignaturePrefilter:
+    """Coarse-to-fine candidate selection for gallery matching
+
+    A small signature (see thumbnail_signature / prefix_signature) is kept
+    next to every template. A query is compared against all signatures
+    first, and only the closest rows go on to full-resolution distances:
+    max(min_candidates, ratio * gallery size) of them. Signature distances
+    are a lower bound of the full distance, so the true best match is pruned
+    only when more than that many templates look closer in the thumbnail
+    than it is in full.
+
+    audit_rate of the queries are also searched exhaustively and the best
+    students compared, giving a running agreement rate to tune the knobs
+    against. Rows must be added in gallery order.
+    """
+
+    def __init__(self, signature, min_candidates=256, ratio=0.02, audit_rate=0.02):
+        self.signature = signature
+        self.min_candidates = min_candidates
+        self.ratio = ratio
+        self.audit_rate = audit_rate
+        self._signatures = np.empty((0, signature.dim), dtype=np.float32)
+        self._norms = np.empty(0, dtype=np.float32)
+        self._count = 0
+        self.trained = False
+
+        self._lock = threading.Lock()
+        self._stats = {'queries': 0, 'scanned': 0, 'candidates': 0, 'audited': 0, 'agreed': 0}
+
+    def __len__(self):
+        return self._count
+
+    def train(self, codes):
+        """Compute the signatures of every existing row"""
+        self._count = 0
+        self.add_many(codes)
+        self.trained = True
+
+    def add_many(self, codes, chunk_size=1024):
+        if len(codes) == 0:
+            return
+        end = self._count + len(codes)
+        signatures, norms = self._signatures, self._norms
+        if end > len(signatures):
+            # Grow into new arrays so concurrent readers keep valid ones
+            capacity = max(end, len(signatures) * 2, 16)
+            signatures = np.empty((capacity, self.signature.dim), dtype=np.float32)
+            signatures[:self._count] = self._signatures[:self._count]
+            norms = np.empty(capacity, dtype=np.float32)
+            norms[:self._count] = self._norms[:self._count]
+        for start in range(0, len(codes), chunk_size):
+            block = self.signature(codes[start:start + chunk_size])
+            rows = slice(self._count + start, self._count + start + len(block))
+            signatures[rows] = block
+            norms[rows] = np.einsum('ij,ij->i', block, block)
+        self._signatures, self._norms, self._count = signatures, norms, end
+
+    def candidates(self, query_codes, count=None):
+        """Rows whose signatures are closest to the query's, in ascending row order
+
+        The candidate set is unordered by distance; callers merge it across
+        query templates and score the rows exactly.
+        """
+        count = min(self._count, count or self._count)
+        signatures, norms = self._signatures[:count], self._norms[:count]
+        keep = max(self.min_candidates, int(math.ceil(self.ratio * count)))
+
+        squared = squared_distances(signatures, norms, self.signature(np.asarray(query_codes)[None, :]))[0]
+        if keep < count:
+            rows = np.argpartition(squared, keep)[:keep]
+        else:
+            rows = np.arange(count)
+
+        with self._lock:
+            self._stats['queries'] += 1
+            self._stats['scanned'] += count
+            self._stats['candidates'] += len(rows)
+        return np.sort(rows)
+
+    def should_audit(self):
+        return self.audit_rate > 0 and random.random() < self.audit_rate
+
+    def record_audit(self, agreed):
+        with self._lock:
+            self._stats['audited'] += 1
+            self._stats['agreed'] += int(agreed)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        scanned = stats['scanned']
+        return {
+            'trained': self.trained,
+            'size': self._count,
+            'signatureDimensions': self.signature.dim,
+            'minCandidates': self.min_candidates,
+            'ratio': self.ratio,
+            'queries': stats['queries'],
+            'pruneRatio': round(1 - stats['candidates'] / scanned, 4) if scanned else 0.0,
+            'audited': stats['audited'],
+            'agreement': round(stats['agreed'] / stats['audited'], 4) if stats['audited'] else None
+        }
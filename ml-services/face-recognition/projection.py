@@ -0,0 +1,178 @@
+import argparse
+import glob
+import hashlib
+import os
+import re
+
+import numpy as np
+
+
+class FaceProjection:
+    """Eigenface (PCA) projection from raw 100x100 crops to a few hundred dimensions
+
+    The components are orthonormal, so distances in the projected space are
+    a close lower bound of the raw-space distances and the compare_faces()
+    tolerance keeps its meaning. Every projection carries a version derived
+    from its parameters; galleries record the version their templates were
+    projected with so encodings from different projections are never
+    compared.
+
+    code_scale maps projected coordinates onto int8 codes for the quantised
+    gallery. It is chosen at fit time so the training coordinates use the
+    full int8 range; the fallback of 127 / 100 covers any coordinate, since
+    none can exceed the largest possible raw distance.
+    """
+
+    def __init__(self, mean, components, code_scale=127 / 100):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.code_scale = float(code_scale)
+        digest = hashlib.sha1(self.mean.tobytes() + self.components.tobytes()).hexdigest()
+        self.version = f'pca{self.dim}-{digest[:12]}'
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    @property
+    def input_dim(self):
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(cls, encodings, dim=128):
+        """Fit the top principal components of a set of raw encodings"""
+        encodings = np.asarray(encodings, dtype=np.float32)
+        if len(encodings) < dim:
+            raise ValueError(f"Need at least {dim} faces to fit {dim} components, got {len(encodings)}")
+
+        mean = encodings.mean(axis=0)
+        centred = encodings - mean
+        # Economy SVD: rows of vt are the principal axes ordered by variance
+        _, _, vt = np.linalg.svd(centred, full_matrices=False)
+        components = vt[:dim]
+
+        # Leave headroom for faces slightly outside the training range
+        largest = float(np.abs(centred @ components.T).max()) * 1.25
+        return cls(mean, components, code_scale=127 / largest if largest > 0 else 127 / 100)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if 'code_scale' in data:
+                return cls(data['mean'], data['components'], float(data['code_scale']))
+            return cls(data['mean'], data['components'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, mean=self.mean, components=self.components, code_scale=self.code_scale)
+        os.replace(tmp_path, path)
+
+    def project(self, encodings):
+        """Project one encoding or a block of encodings"""
+        encodings = np.asarray(encodings, dtype=np.float32)
+        return (encodings - self.mean) @ self.components.T
+
+    def project_store(self, store, cache_dir, chunk_size=2048):
+        """Projected copy of every row in an EncodingStore, cached on disk
+
+        The cache is keyed by projection version and store generation. New
+        rows appended since the cache was written are projected and added,
+        so a restart only pays for registrations it has not seen yet, and
+        switching to a new projection re-projects the whole gallery once.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, f"{self.version}-g{store.meta['generation']}.npy")
+        total = store.total_rows
+
+        cached = np.empty((0, self.dim), dtype=np.float32)
+        if os.path.exists(cache_path):
+            cached = np.load(cache_path, mmap_mode='r')
+            if cached.shape[0] == total:
+                return cached
+            if cached.shape[0] > total or cached.shape[1] != self.dim:
+                cached = np.empty((0, self.dim), dtype=np.float32)
+
+        templates = store.templates()
+        projected = np.empty((total, self.dim), dtype=np.float32)
+        done = len(cached)
+        projected[:done] = cached
+        # Release the old mapping before its file is replaced
+        del cached
+        for start in range(done, total, chunk_size):
+            projected[start:start + chunk_size] = self.project(store.decode(templates[start:start + chunk_size]))
+
+        # Write under a per-process name so concurrent workers never share a temporary file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, projected)
+        os.replace(tmp_path, cache_path)
+        self._remove_stale_caches(cache_dir, store.meta['generation'])
+        return projected
+
+    def _remove_stale_caches(self, cache_dir, generation):
+        """Delete caches of older store generations or of other projections
+
+        Other workers' temporary files are left alone, and a cache that
+        cannot be removed (still mapped by another process on Windows) is
+        retried by the next sweep.
+        """
+        for path in glob.glob(os.path.join(cache_dir, '*.npy')):
+            name = os.path.basename(path)
+            match = re.match(r'^(.+)-g(\d+)\.npy$', name)
+            if match is None or name.endswith('.tmp.npy'):
+                continue
+            version, cache_generation = match.group(1), int(match.group(2))
+            if cache_generation < generation or (cache_generation == generation and version != self.version):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Could not remove stale projection cache {name}: {e}")
+
+
+def load_face_crops(faces_dir, model_path):
+    """Detect and encode the single face in every registered image"""
+    from engine import FaceEngine, encode_face, ensure_face_cascade
+    import cv2
+
+    engine = FaceEngine(ensure_face_cascade(model_path))
+    encodings = []
+    for path in sorted(glob.glob(os.path.join(faces_dir, '*.jpg'))):
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        face_locations = engine.detect_faces(image)
+        if len(face_locations) == 1:
+            encodings.append(encode_face(image, face_locations[0]))
+    return np.array(encodings, dtype=np.float32)
+
+
+def load_gallery_crops(gallery_dir):
+    """Read the raw crops already stored in the binary gallery"""
+    from encoding_store import EncodingStore
+
+    store = EncodingStore(gallery_dir, dim=100 * 100)
+    rows, _ = store.live_rows()
+    return store.decode(store.templates()[rows])
+
+
+if __name__ == '__main__':
+    DATA_PATH = os.environ.get('DATA_PATH', 'data')
+    MODEL_PATH = os.environ.get('MODEL_PATH', 'models')
+
+    parser = argparse.ArgumentParser(description='Fit the eigenface projection used for face encodings')
+    parser.add_argument('--dim', type=int, default=128, help='Projected dimensions (typically 64-256)')
+    parser.add_argument('--source', choices=['faces', 'gallery'], default='faces',
+                        help='Fit on images in DATA_PATH/faces or on crops in the binary gallery')
+    parser.add_argument('--output', default=os.path.join(MODEL_PATH, 'face_projection.npz'))
+    args = parser.parse_args()
+
+    if args.source == 'faces':
+        crops = load_face_crops(os.path.join(DATA_PATH, 'faces'), MODEL_PATH)
+    else:
+        crops = load_gallery_crops(os.path.join(DATA_PATH, 'gallery'))
+
+    print(f"Fitting {args.dim}-dimensional projection on {len(crops)} faces...")
+    projection = FaceProjection.fit(crops, dim=args.dim)
+    projection.save(args.output)
+    print(f"Saved projection {projection.version} to {args.output}")
+    print("Restart the face recognition service (or POST /api/face/projection/reload) to re-project the gallery")
@@ -0,0 +1,65 @@
+import argparse
+import os
+
+import numpy as np
+
+
+def select_medoids(encodings, k, iterations=10):
+    """Indices of at most k medoids that represent a set of encodings
+
+    Starts from the overall medoid and adds the encoding furthest from the
+    chosen ones (farthest-first), then alternates assigning every encoding
+    to its nearest medoid and moving each medoid to the member closest to
+    the rest of its cluster. Medoids are real templates, so prototypes stay
+    exactly what was registered.
+    """
+    encodings = np.asarray(encodings, dtype=np.float32)
+    n = len(encodings)
+    if n <= k:
+        return list(range(n))
+
+    # Pairwise Euclidean distances via the |a|^2 + |b|^2 - 2ab expansion
+    norms = np.einsum('ij,ij->i', encodings, encodings)
+    distances = np.sqrt(np.maximum(norms[:, None] + norms[None, :] - 2 * encodings @ encodings.T, 0))
+
+    medoids = [int(np.argmin(distances.sum(axis=1)))]
+    while len(medoids) < k:
+        nearest = distances[:, medoids].min(axis=1)
+        if nearest.max() == 0:
+            break  # the rest duplicate a chosen medoid
+        medoids.append(int(np.argmax(nearest)))
+
+    for _ in range(iterations):
+        assignment = np.argmin(distances[:, medoids], axis=1)
+        updated = []
+        for cluster in range(len(medoids)):
+            members = np.flatnonzero(assignment == cluster)
+            if len(members) == 0:
+                updated.append(medoids[cluster])
+                continue
+            within = distances[np.ix_(members, members)].sum(axis=1)
+            updated.append(int(members[np.argmin(within)]))
+        if updated == medoids:
+            break
+        medoids = updated
+    return sorted(set(medoids))
+
+
+if __name__ == '__main__':
+    from encoding_store import EncodingStore
+
+    DATA_PATH = os.environ.get('DATA_PATH', 'data')
+
+    parser = argparse.ArgumentParser(description="Reduce each student's face templates to a few prototypes")
+    parser.add_argument('--max-prototypes', type=int, default=int(os.environ.get('GALLERY_MAX_PROTOTYPES', 5)))
+    parser.add_argument('--student', action='append', dest='students', help='Only these students (repeatable)')
+    args = parser.parse_args()
+
+    gallery_dir = os.path.join(DATA_PATH, 'gallery')
+    store = EncodingStore(gallery_dir, dim=100 * 100)
+    archive = EncodingStore(os.path.join(gallery_dir, 'archive'), dim=store.dim,
+                            dtype=store.dtype, scale=store.scale)
+    summary = store.consolidate(select_medoids, args.max_prototypes, archive, args.students)
+    print(f"Reduced {summary['students']} students: {summary['templatesBefore']} -> "
+          f"{summary['templatesAfter']} templates (generation {summary['generation']})")
+    print("Running services pick up the new generation on their next request")
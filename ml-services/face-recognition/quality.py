@@ -0,0 +1,92 @@
+import threading
+
+import numpy as np
+
+# Reason codes reported to clients for faces that fail the gate
+REASON_MESSAGES = {
+    'too_small': 'too small',
+    'blurry': 'blurry',
+    'off_center': 'not centred',
+    'pose': 'not frontal'
+}
+
+
+class QualityGate:
+    """Cheap checks that reject faces which cannot match before encoding
+
+    All faces of a frame are scored at once from their FACE_SIZE grayscale
+    crops and boxes:
+    - size: box width in pixels (small faces are upscaled into mush)
+    - blur: variance of the Laplacian of the crop
+    - pose: mean left/right asymmetry of the crop, 0 for a mirror-symmetric
+      (frontal) face
+    - centring: distance of the box centre from the image centre relative
+      to the image size, the same measure /api/face/analyze uses; only
+      checked for single-subject frames
+    """
+
+    def __init__(self, min_face=40, min_sharpness=25.0, max_asymmetry=0.3, max_offset=0.35, enabled=True):
+        self.min_face = min_face
+        self.min_sharpness = min_sharpness
+        self.max_asymmetry = max_asymmetry
+        self.max_offset = max_offset
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {'assessed': 0, 'rejected': 0, **{reason: 0 for reason in REASON_MESSAGES}}
+
+    def assess(self, crops, boxes, image_shape, check_centering=False):
+        """One {'passed', 'reasons', 'metrics'} dict per face"""
+        if len(boxes) == 0:
+            return []
+
+        c = np.asarray(crops, dtype=np.float32)
+        b = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        top, right, bottom, left = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+        height, width = image_shape[:2]
+
+        widths = right - left
+        laplacian = (c[:, :-2, 1:-1] + c[:, 2:, 1:-1] + c[:, 1:-1, :-2] + c[:, 1:-1, 2:]
+                     - 4 * c[:, 1:-1, 1:-1])
+        sharpness = laplacian.var(axis=(1, 2))
+        asymmetry = np.abs(c - c[:, :, ::-1]).mean(axis=(1, 2)) / 255.0
+        offset = np.sqrt((((left + right) / 2 - width / 2) / width) ** 2 +
+                         (((top + bottom) / 2 - height / 2) / height) ** 2)
+
+        failed = {
+            'too_small': widths < self.min_face,
+            'blurry': sharpness < self.min_sharpness,
+            'pose': asymmetry > self.max_asymmetry,
+            'off_center': (offset > self.max_offset) if check_centering else np.zeros(len(b), dtype=bool)
+        }
+
+        results = []
+        for i in range(len(b)):
+            reasons = [reason for reason, mask in failed.items() if mask[i]] if self.enabled else []
+            self._record(reasons)
+            results.append({
+                'passed': not reasons,
+                'reasons': reasons,
+                'metrics': {
+                    'size': int(widths[i]),
+                    'sharpness': round(float(sharpness[i]), 1),
+                    'asymmetry': round(float(asymmetry[i]), 3),
+                    'offset': round(float(offset[i]), 3)
+                }
+            })
+        return results
+
+    def _record(self, reasons):
+        with self._lock:
+            self._stats['assessed'] += 1
+            if reasons:
+                self._stats['rejected'] += 1
+            for reason in reasons:
+                self._stats[reason] += 1
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.enabled, **self._stats}
+
+
+def rejection_message(reasons):
+    return f"Face quality too low ({', '.join(REASON_MESSAGES[reason] for reason in reasons)})"
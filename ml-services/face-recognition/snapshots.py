@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+from gallery import FaceGallery
+
+
+def parse_encoding_items(items):
+    """Group [{studentId, encoding}, ...] request items into {studentId: [encoding, ...]}
+
+    Encodings may be sent as arrays or as JSON-encoded strings.
+    """
+    encodings_by_student = {}
+    for item in items or []:
+        student_id = item.get('studentId')
+        encoding = item.get('encoding')
+        if not student_id or encoding is None:
+            continue
+
+        if isinstance(encoding, str):
+            try:
+                encoding = json.loads(encoding)
+            except ValueError:
+                continue
+
+        encodings_by_student.setdefault(student_id, []).append(encoding)
+    return encodings_by_student
+
+
+class GallerySnapshot:
+    """Immutable, content-addressed gallery for one roster (e.g. a class section)
+
+    The version is a hash over the per-student digests of the quantised
+    templates, so two uploads of the same roster get the same version. A
+    delta re-hashes only the students it touches and shares the others'
+    code arrays, but older versions stay addressable, so its matching
+    gallery is a fresh copy of every student's codes.
+    """
+
+    def __init__(self, name, codes_by_student, digests=None):
+        self.name = name
+        self.codes_by_student = codes_by_student
+        # Digests of unchanged students are carried over by with_delta()
+        known = digests or {}
+        self.digests = {
+            student_id: known.get(student_id) or hashlib.sha1(codes.tobytes()).hexdigest()
+            for student_id, codes in codes_by_student.items()
+        }
+        self.version = self._version(self.digests)
+        self.gallery = FaceGallery()
+        for student_id, codes in codes_by_student.items():
+            self.gallery.add_codes([student_id] * len(codes), codes)
+
+    @staticmethod
+    def _version(digests):
+        content = '\n'.join(f'{student_id}:{digests[student_id]}' for student_id in sorted(digests))
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def quantize(encodings):
+        """uint8 codes for raw encode_face() encodings, rejecting anything else"""
+        encodings = np.asarray(encodings, dtype=np.float32)
+        if encodings.ndim != 2 or encodings.size == 0:
+            raise ValueError("Each student needs a list of equally sized encodings")
+        if encodings.min() < 0 or encodings.max() > 1:
+            raise ValueError("Encodings must be encode_face() output with values in [0, 1]")
+        return FaceGallery().quantize(encodings)
+
+    @classmethod
+    def from_encodings(cls, name, encodings_by_student):
+        return cls(name, {
+            student_id: cls.quantize(encodings)
+            for student_id, encodings in encodings_by_student.items()
+        })
+
+    def with_delta(self, added_by_student, removed_students):
+        """New snapshot with students replaced/added and others removed"""
+        codes_by_student = dict(self.codes_by_student)
+        digests = dict(self.digests)
+        for student_id in removed_students:
+            codes_by_student.pop(student_id, None)
+        for student_id, encodings in added_by_student.items():
+            codes_by_student[student_id] = self.quantize(encodings)
+            digests.pop(student_id, None)
+        return GallerySnapshot(self.name, codes_by_student, digests)
+
+    def summary(self):
+        return {
+            'snapshotId': self.name,
+            'version': self.version,
+            'students': len(self.codes_by_student),
+            'templates': len(self.gallery)
+        }
+
+
+class SnapshotRegistry:
+    """Named gallery snapshots kept in memory and persisted under a directory
+
+    The last keep_versions versions of every snapshot stay addressable so
+    requests that raced a roster update still resolve. Several service
+    workers may share the directory: before a snapshot is used its file is
+    stat()ed and re-read if another worker replaced or deleted it since this
+    one last loaded or saved it.
+    """
+
+    NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,128}$')
+
+    def __init__(self, directory, keep_versions=3):
+        self.directory = directory
+        self.keep_versions = keep_versions
+        self._lock = threading.Lock()
+        self._versions = {}  # name -> [snapshot, ...], newest last
+        self._file_keys = {}  # name -> (mtime, size, inode) of the file last loaded or saved
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.npz')
+
+    @staticmethod
+    def _file_key(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _read(self, name):
+        with np.load(self._path(name)) as data:
+            students = data['students'].tolist()
+            codes = data['codes']
+            labels = data['labels']
+        codes_by_student = {student_id: codes[labels == i] for i, student_id in enumerate(students)}
+        return GallerySnapshot(name, codes_by_student)
+
+    def _load(self):
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.npz'):
+                continue
+            name = filename[:-len('.npz')]
+            try:
+                key = self._file_key(self._path(name))
+                self._versions[name] = [self._read(name)]
+                self._file_keys[name] = key
+            except Exception as e:
+                print(f"Error loading gallery snapshot {filename}: {e}")
+
+    def _sync(self, name):
+        """Pick up another worker's update or deletion of a snapshot (caller holds the lock)"""
+        if not self.valid_name(name):
+            return
+        key = self._file_key(self._path(name))
+        if key == self._file_keys.get(name):
+            return
+        if key is None:
+            self._versions.pop(name, None)
+            self._file_keys.pop(name, None)
+            return
+        try:
+            snapshot = self._read(name)
+        except Exception as e:
+            # Keep serving the versions already in memory
+            print(f"Error reloading gallery snapshot {name}: {e}")
+            return
+        self._file_keys[name] = key
+        versions = self._versions.setdefault(name, [])
+        if not versions or versions[-1].version != snapshot.version:
+            versions.append(snapshot)
+            del versions[:-self.keep_versions]
+
+    def _save(self, snapshot):
+        students = list(snapshot.codes_by_student.keys())
+        dim = snapshot.gallery.dim or 0
+        codes = [snapshot.codes_by_student[student_id] for student_id in students]
+        labels = [np.full(len(block), i, dtype=np.int32) for i, block in enumerate(codes)]
+        tmp_path = self._path(snapshot.name) + '.tmp.npz'
+        np.savez(tmp_path,
+                 students=np.array(students, dtype=str),
+                 codes=np.concatenate(codes) if codes else np.empty((0, dim), dtype=np.uint8),
+                 labels=np.concatenate(labels) if labels else np.empty(0, dtype=np.int32))
+        os.replace(tmp_path, self._path(snapshot.name))
+        self._file_keys[snapshot.name] = self._file_key(self._path(snapshot.name))
+
+    def valid_name(self, name):
+        return bool(name) and bool(self.NAME_PATTERN.match(name))
+
+    def _publish(self, snapshot):
+        """Make snapshot the current version of its name (caller holds the lock)"""
+        versions = self._versions.setdefault(snapshot.name, [])
+        if not versions or versions[-1].version != snapshot.version:
+            versions.append(snapshot)
+            del versions[:-self.keep_versions]
+            self._save(snapshot)
+        return snapshot
+
+    def put(self, name, encodings_by_student):
+        """Create or fully replace a snapshot"""
+        snapshot = GallerySnapshot.from_encodings(name, encodings_by_student)
+        with self._lock:
+            self._sync(name)
+            return self._publish(snapshot)
+
+    def apply_delta(self, name, base_version, added_by_student, removed_students):
+        """Derive a new version from the current one; None if base_version is stale"""
+        with self._lock:
+            self._sync(name)
+            versions = self._versions.get(name)
+            if not versions or base_version != versions[-1].version:
+                return None
+            return self._publish(versions[-1].with_delta(added_by_student, removed_students))
+
+    def get(self, name, version=None):
+        """Current snapshot, or a specific retained version; None if unknown"""
+        with self._lock:
+            self._sync(name)
+            versions = self._versions.get(name, [])
+            if not versions:
+                return None
+            if version is None:
+                return versions[-1]
+            for snapshot in versions:
+                if snapshot.version == version:
+                    return snapshot
+            return None
+
+    def delete(self, name):
+        with self._lock:
+            self._sync(name)
+            self._file_keys.pop(name, None)
+            if self._versions.pop(name, None) is None:
+                return False
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+            return True
@@ -0,0 +1,220 @@
+import collections
+import itertools
+import threading
+import time
+
+import numpy as np
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """Intersection over union of every pair of (top, right, bottom, left) boxes"""
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 1] - a[:, 3]) * (a[:, 2] - a[:, 0])
+    area_b = (b[:, 1] - b[:, 3]) * (b[:, 2] - b[:, 0])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+class Track:
+    """One face followed across the frames of a session"""
+
+    def __init__(self, track_id, box, frame_index):
+        self.track_id = track_id
+        self.box = tuple(int(v) for v in box)
+        self.first_frame = frame_index
+        self.last_seen = frame_index
+        self.misses = 0
+        self.student_id = None
+        self.score = None
+        self.distance = None
+        self.certain = False
+        self.matched_frame = None
+        self.quality_issues = []  # quality gate reasons when matching was deferred
+
+    def to_dict(self):
+        return {
+            'trackId': self.track_id,
+            'location': list(self.box),
+            'studentId': self.student_id,
+            'score': self.score,
+            'distance': self.distance,
+            'certain': self.certain,
+            'qualityIssues': self.quality_issues,
+            'age': self.last_seen - self.first_frame + 1
+        }
+
+
+class SessionTracker:
+    """IoU tracker for the faces in one live session's frame stream
+
+    A full-frame detection runs every detect_interval frames, or sooner
+    when there are no tracks or one was lost. On the frames in between the
+    caller only re-detects inside a window around each track. Boxes are
+    associated with tracks greedily by IoU, so a track keeps its identity
+    from frame to frame. A track is re-matched against the gallery only
+    when it is new, when its match was uncertain, or when its identity is
+    older than reverify_interval frames.
+
+    The caller holds lock while it processes a frame.
+    """
+
+    def __init__(self, detect_interval=10, iou_threshold=0.3, max_misses=2, reverify_interval=30, margin=5.0):
+        self.detect_interval = detect_interval
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.reverify_interval = reverify_interval
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.frame_index = -1
+        self.tracks = []
+        self._lost = False
+        self._ids = itertools.count(1)
+        self.last_used = time.monotonic()
+        self.stats = {'frames': 0, 'fullDetections': 0, 'matches': 0}
+
+    def begin_frame(self):
+        """Advance to the next frame; True if it needs a full-frame detection"""
+        self.frame_index += 1
+        self.last_used = time.monotonic()
+        self.stats['frames'] += 1
+        full = self._lost or not self.tracks or self.frame_index % self.detect_interval == 0
+        if full:
+            self.stats['fullDetections'] += 1
+        self._lost = False
+        return full
+
+    def associate(self, boxes):
+        """Match full-frame detections to tracks; unmatched boxes start new tracks"""
+        matched_tracks = set()
+        matched_boxes = set()
+        if self.tracks and boxes:
+            overlaps = iou_matrix([track.box for track in self.tracks], boxes)
+            pairs = np.argwhere(overlaps >= self.iou_threshold)
+            for t, b in sorted(pairs.tolist(), key=lambda pair: -overlaps[pair[0], pair[1]]):
+                if t in matched_tracks or b in matched_boxes:
+                    continue
+                matched_tracks.add(t)
+                matched_boxes.add(b)
+                self._seen(self.tracks[t], boxes[b])
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                self._missed(track)
+        for b, box in enumerate(boxes):
+            if b not in matched_boxes:
+                self.tracks.append(Track(next(self._ids), box, self.frame_index))
+        self._prune()
+
+    def update(self, track, box):
+        """Result of re-detecting one track in its window (box is None if not found)"""
+        if box is None:
+            self._missed(track)
+        else:
+            self._seen(track, box)
+
+    def finish_frame(self):
+        self._prune()
+
+    def _seen(self, track, box):
+        track.box = tuple(int(v) for v in box)
+        track.last_seen = self.frame_index
+        track.misses = 0
+
+    def _missed(self, track):
+        track.misses += 1
+        # Look at the whole frame again on the next frame
+        self._lost = True
+
+    def _prune(self):
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+    def visible(self):
+        """Tracks seen in the current frame"""
+        return [track for track in self.tracks if track.last_seen == self.frame_index]
+
+    def needs_match(self, track):
+        if track.student_id is None or not track.certain:
+            return True
+        return self.frame_index - track.matched_frame >= self.reverify_interval
+
+    def record_match(self, track, result):
+        """Store a gallery match() result on a track"""
+        self.stats['matches'] += 1
+        track.matched_frame = self.frame_index
+        best = result['best'] if result else None
+        if best is None:
+            track.student_id, track.score, track.distance, track.certain = None, None, None, False
+            return
+
+        # Certain when the runner-up student is clearly further away
+        candidates = result['candidates']
+        runner_up = candidates[1]['distance'] if len(candidates) > 1 else None
+        track.student_id = best['studentId']
+        track.score = best['score']
+        track.distance = best['distance']
+        track.certain = runner_up is None or runner_up - best['distance'] >= self.margin
+
+
+class TrackerRegistry:
+    """Per-session trackers, evicted after ttl seconds idle or when over capacity
+
+    Trackers live in this process only. With leases (a SessionLeases shared
+    by every worker process) a session belongs to the worker that first
+    tracked it, and the others get None from get() instead of a fresh
+    tracker that would restart every track.
+    """
+
+    def __init__(self, ttl=300, max_sessions=256, leases=None, **tracker_options):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.leases = leases
+        self.tracker_options = tracker_options
+        self._lock = threading.Lock()
+        self._trackers = collections.OrderedDict()
+
+    def owns(self, session_id):
+        """False if another worker process holds the session"""
+        return self.leases is None or self.leases.claim(session_id)
+
+    def get(self, session_id):
+        """The session's tracker, created on first use; None if another worker holds it"""
+        if not self.owns(session_id):
+            return None
+        with self._lock:
+            self._expire()
+            tracker = self._trackers.pop(session_id, None)
+            if tracker is None:
+                tracker = SessionTracker(**self.tracker_options)
+            self._trackers[session_id] = tracker
+            while len(self._trackers) > self.max_sessions:
+                self._evict(self._trackers.popitem(last=False)[0])
+            return tracker
+
+    def delete(self, session_id):
+        with self._lock:
+            found = self._trackers.pop(session_id, None) is not None
+        self._evict(session_id)
+        return found
+
+    def _evict(self, session_id):
+        if self.leases is not None:
+            self.leases.release(session_id)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._trackers:
+            session_id, tracker = next(iter(self._trackers.items()))
+            if tracker.last_used >= cutoff:
+                break
+            del self._trackers[session_id]
+            self._evict(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._trackers), 'capacity': self.max_sessions}
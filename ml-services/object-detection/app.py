@@ -3,13 +3,24 @@ from flask_cors import CORS
 import os
 import numpy as np
 import cv2
-import base64
 import json
+import sys
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.image_input import decode_image, read_image_request
+from common.image_writer import ImageWriter
+from common.model_registry import ModelRegistry
+from common.result_cache import ResultCache, dhash
+from common.session_leases import SessionLeases
+from common.streaming import StreamHub, add_stream_routes
+
 app = Flask(__name__)
 CORS(app)
 
+# Request bodies larger than this are rejected with 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+
 # Configuration
 MODEL_PATH = os.environ.get('MODEL_PATH', 'models')
 DATA_PATH = os.environ.get('DATA_PATH', 'data')
@@ -19,8 +30,26 @@ os.makedirs(MODEL_PATH, exist_ok=True)
 os.makedirs(DATA_PATH, exist_ok=True)
 os.makedirs(os.path.join(DATA_PATH, 'detections'), exist_ok=True)
 
+# Detections of near-identical frames of a session are reused for RESULT_CACHE_TTL
+# seconds; RESULT_CACHE_DISTANCE is the dHash bit tolerance, size 0 disables it
+result_cache = ResultCache(
+    ttl=float(os.environ.get('RESULT_CACHE_TTL', 10)),
+    max_entries=int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+    max_distance=int(os.environ.get('RESULT_CACHE_DISTANCE', 4))
+)
+
+# Audit images are encoded and written by a background writer, off the request thread
+image_writer = ImageWriter(
+    max_queue=int(os.environ.get('AUDIT_QUEUE_SIZE', 64)),
+    policy=os.environ.get('AUDIT_DROP_POLICY', 'drop_oldest')
+)
+
 print("Initializing object detection models...")
 
+# Request and stream threads borrow YOLO networks from a pool of at most
+# YOLO_INSTANCES copies (each holds its own ~240 MB of weights)
+models = ModelRegistry(max_instances=int(os.environ.get('YOLO_INSTANCES', 1)))
+
 # Download YOLO model files if they don't exist
 def ensure_yolo_models():
     """Download YOLO model files if they don't exist"""
@@ -59,6 +88,15 @@ def ensure_yolo_models():
     
     return config_path, weights_path, classes_path
 
+def build_yolo_net(config_path, weights_path):
+    """One YOLO network instance (not safe to share between concurrent callers)"""
+    net = cv2.dnn.readNetFromDarknet(config_path, weights_path)
+    
+    # Set backend and target (CPU in this case)
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return net
+
 def load_yolo():
     """Load YOLO model using OpenCV DNN"""
     try:
@@ -70,11 +108,7 @@ def load_yolo():
             classes = [line.strip() for line in f.readlines()]
         
         # Load YOLO model
-        net = cv2.dnn.readNetFromDarknet(config_path, weights_path)
-        
-        # Set backend and target (CPU in this case)
-        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
-        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        net = models.register('yolo', build_yolo_net, config_path, weights_path)
         
         # Get the output layer names
         layer_names = net.getLayerNames()
@@ -97,17 +131,8 @@ except Exception as e:
     use_yolo = False
 
 def process_image(image_data):
-    """Process base64 image data to cv2 format"""
-    if 'data:image/' in image_data:
-        # Split the base64 string in data and type
-        image_data = image_data.split(',')[1]
-    
-    # Decode base64 image
-    image_bytes = base64.b64decode(image_data)
-    np_array = np.frombuffer(image_bytes, np.uint8)
-    image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-    
-    return image
+    """Process base64 image data or raw encoded image bytes to cv2 format"""
+    return decode_image(image_data)
 
 def detect_objects_yolo(image, target_classes=None):
     """Detect objects in the image using YOLO"""
@@ -122,10 +147,11 @@ def detect_objects_yolo(image, target_classes=None):
     
     # Preprocess image for YOLO
     blob = cv2.dnn.blobFromImage(image, 0.00392, (416, 416), (0, 0, 0), True, crop=False)
-    yolo_net.setInput(blob)
-    
-    # Get detections
-    outs = yolo_net.forward(yolo_output_layers)
+    with models.checkout('yolo') as net:
+        net.setInput(blob)
+        
+        # Get detections
+        outs = net.forward(yolo_output_layers)
     
     # Process detections
     class_ids = []
@@ -171,6 +197,20 @@ def detect_objects_yolo(image, target_classes=None):
     
     return detections
 
+def detect_cached(namespace, detector, image, session_id, frame_hash=None):
+    """Run a detector, reusing its detections for a near-identical frame of the session
+
+    Returns (detections, cached).
+    """
+    if frame_hash is None:
+        frame_hash = dhash(image)
+    detections = result_cache.get(namespace, session_id, frame_hash)
+    if detections is not None:
+        return detections, True
+    detections = detector(image)
+    result_cache.put(namespace, session_id, frame_hash, detections)
+    return detections, False
+
 def detect_id_cards(image):
     """Detect ID cards in the image"""
     # First try YOLO detection
@@ -242,21 +282,21 @@ def detect_phones(image):
 @app.route('/api/object-detection/idcard', methods=['POST'])
 def detect_id_card():
     """Detect ID cards in the image"""
-    if not request.json or 'image' not in request.json:
+    fields, image_data = read_image_request(request)
+    if image_data is None:
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
     
-    image_data = request.json['image']
-    session_id = request.json.get('sessionId', 'unknown')
+    session_id = fields.get('sessionId', 'unknown')
     
     try:
         # Process the image
         image = process_image(image_data)
         
         # Detect ID cards
-        detections = detect_id_cards(image)
+        detections, cached = detect_cached('idcard', detect_id_cards, image, session_id)
         
         # Save the detection image for reference (with bounding boxes)
-        if detections:
+        if detections and not cached:
             for det in detections:
                 x1, y1, x2, y2 = det['bbox']
                 cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
@@ -265,7 +305,7 @@ def detect_id_card():
             
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
             image_filename = f"idcard_{session_id}_{timestamp}.jpg"
-            cv2.imwrite(os.path.join(DATA_PATH, 'detections', image_filename), image)
+            image_writer.submit(os.path.join(DATA_PATH, 'detections', image_filename), image)
         
         # Determine if ID card is visible
         id_card_visible = len(detections) > 0
@@ -286,21 +326,21 @@ def detect_id_card():
 @app.route('/api/object-detection/phone', methods=['POST'])
 def detect_phone():
     """Detect phones in the image"""
-    if not request.json or 'image' not in request.json:
+    fields, image_data = read_image_request(request)
+    if image_data is None:
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
     
-    image_data = request.json['image']
-    session_id = request.json.get('sessionId', 'unknown')
+    session_id = fields.get('sessionId', 'unknown')
     
     try:
         # Process the image
         image = process_image(image_data)
         
         # Detect phones
-        detections = detect_phones(image)
+        detections, cached = detect_cached('phone', detect_phones, image, session_id)
         
         # Save the detection image for reference (with bounding boxes)
-        if detections:
+        if detections and not cached:
             for det in detections:
                 x1, y1, x2, y2 = det['bbox']
                 cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), 2)
@@ -309,7 +349,7 @@ def detect_phone():
             
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
             image_filename = f"phone_{session_id}_{timestamp}.jpg"
-            cv2.imwrite(os.path.join(DATA_PATH, 'detections', image_filename), image)
+            image_writer.submit(os.path.join(DATA_PATH, 'detections', image_filename), image)
         
         # Determine if phone is in use
         phone_detected = len(detections) > 0
@@ -327,10 +367,51 @@ def detect_phone():
         print(f"Error detecting phone: {e}")
         return jsonify({'success': False, 'message': f'Error processing image: {str(e)}'}), 500
 
+def process_stream_frame(session_id, frame):
+    """Run both detectors on a streamed frame; no audit image is written per frame"""
+    image = process_image(frame)
+    if image is None:
+        return {'success': False, 'message': 'Invalid image data'}
+
+    frame_hash = dhash(image)
+    id_cards, _ = detect_cached('idcard', detect_id_cards, image, session_id, frame_hash)
+    phones, _ = detect_cached('phone', detect_phones, image, session_id, frame_hash)
+    return {
+        'success': True,
+        'message': 'Object detection completed',
+        'idCardVisible': len(id_cards) > 0,
+        'idCardConfidence': max([det['confidence'] for det in id_cards]) if id_cards else 0,
+        'phoneDetected': len(phones) > 0,
+        'phoneConfidence': max([det['confidence'] for det in phones]) if phones else 0,
+        'detections': id_cards + phones
+    }
+
+# Continuous frame ingestion for live monitoring (see common/streaming.py).
+# Worker processes of a multi-process server share stream ownership through
+# lease files, so a session's requests must all reach the same worker
+stream_idle_timeout = float(os.environ.get('STREAM_IDLE_TIMEOUT', 60))
+stream_hub = StreamHub(
+    process_stream_frame,
+    max_fps=float(os.environ.get('STREAM_MAX_FPS', 5)),
+    max_frame_age=float(os.environ.get('STREAM_MAX_FRAME_AGE', 2)),
+    idle_timeout=stream_idle_timeout,
+    max_sessions=int(os.environ.get('MAX_STREAM_SESSIONS', 64)),
+    leases=SessionLeases(os.path.join(DATA_PATH, 'sessions', 'object-detection-stream'), 2 * stream_idle_timeout)
+)
+add_stream_routes(app, '/api/object-detection/stream', stream_hub, app.config['MAX_CONTENT_LENGTH'])
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({
+        'success': False,
+        'message': f"Request body exceeds {app.config['MAX_CONTENT_LENGTH']} bytes"
+    }), 413
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'ok'}), 200
+    return jsonify({'status': 'ok', 'models': models.stats(), 'imageWriter': image_writer.stats(),
+                    'streams': stream_hub.stats(), 'resultCache': result_cache.stats()}), 200
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5002, debug=False)
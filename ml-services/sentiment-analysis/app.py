@@ -3,38 +3,65 @@ from flask_cors import CORS
 import os
 import numpy as np
 import cv2
-import base64
 import json
+import sys
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.detection import detect_scaled
+from common.image_input import decode_image, read_image_request
+from common.image_writer import ImageWriter
+from common.model_registry import ModelRegistry
+from common.result_cache import ResultCache, dhash
+from common.session_leases import SessionLeases
+from common.streaming import StreamHub, add_stream_routes
+
 app = Flask(__name__)
 CORS(app)
 
+# Request bodies larger than this are rejected with 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+
 # Configuration
 MODEL_PATH = os.environ.get('MODEL_PATH', 'models')
 DATA_PATH = os.environ.get('DATA_PATH', 'data')
 
+# Faces are detected at a bounded working width and mapped back to full resolution
+DETECTION_WIDTH = int(os.environ.get('DETECTION_WIDTH', 640))
+DETECTION_MIN_FACE = int(os.environ.get('DETECTION_MIN_FACE', 24))
+# Largest face side at the working width; 0 means no upper bound
+DETECTION_MAX_FACE = int(os.environ.get('DETECTION_MAX_FACE', 0))
+
 # Ensure directories exist
 os.makedirs(MODEL_PATH, exist_ok=True)
 os.makedirs(DATA_PATH, exist_ok=True)
 os.makedirs(os.path.join(DATA_PATH, 'sentiment'), exist_ok=True)
 
+# Results of near-identical frames of a session are reused for RESULT_CACHE_TTL
+# seconds; RESULT_CACHE_DISTANCE is the dHash bit tolerance, size 0 disables it
+result_cache = ResultCache(
+    ttl=float(os.environ.get('RESULT_CACHE_TTL', 10)),
+    max_entries=int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+    max_distance=int(os.environ.get('RESULT_CACHE_DISTANCE', 4))
+)
+
+# Audit images are encoded and written by a background writer, off the request thread
+image_writer = ImageWriter(
+    max_queue=int(os.environ.get('AUDIT_QUEUE_SIZE', 64)),
+    policy=os.environ.get('AUDIT_DROP_POLICY', 'drop_oldest')
+)
+
 # Load models (in a real system, load actual trained models)
 # For this example, we'll simulate model predictions
 print("Initializing sentiment analysis models...")
 
+# Load detectors once at startup; request threads borrow pooled instances
+models = ModelRegistry()
+models.register('face_cascade', cv2.CascadeClassifier, cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
 def process_image(image_data):
-    """Process base64 image data to cv2 format"""
-    if 'data:image/' in image_data:
-        # Split the base64 string in data and type
-        image_data = image_data.split(',')[1]
-    
-    # Decode base64 image
-    image_bytes = base64.b64decode(image_data)
-    np_array = np.frombuffer(image_bytes, np.uint8)
-    image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-    
-    return image
+    """Process base64 image data or raw encoded image bytes to cv2 format"""
+    return decode_image(image_data)
 
 def detect_faces(image):
     """Detect faces in the image"""
@@ -42,8 +69,9 @@ def detect_faces(image):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     
     # Use OpenCV's built-in face detector
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+    with models.checkout('face_cascade') as face_cascade:
+        faces = detect_scaled(face_cascade, gray, DETECTION_WIDTH, min_size=DETECTION_MIN_FACE,
+                              max_size=DETECTION_MAX_FACE)
     
     face_regions = []
     for (x, y, w, h) in faces:
@@ -87,82 +115,132 @@ def analyze_sentiment(face_image):
         'attention': round(float(attention), 2)
     }
 
-@app.route('/api/sentiment/analyze', methods=['POST'])
-def analyze():
-    """Analyze sentiment in the image"""
-    if not request.json or 'image' not in request.json:
-        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+def analyze_frame(image, session_id=None, audit_filename=None):
+    """Analyze every face in a decoded image; returns (result, status code)
+
+    A near-identical frame of the same session reuses the cached result
+    (and writes no audit image). Otherwise the annotated image is saved
+    under audit_filename when one is given.
+    """
+    frame_hash = dhash(image)
+    cached = result_cache.get('sentiment', session_id, frame_hash)
+    if cached is not None:
+        return cached
+
+    result = analyze_faces(image, audit_filename)
+    result_cache.put('sentiment', session_id, frame_hash, result)
+    return result
+
+def analyze_faces(image, audit_filename=None):
+    """Run detection and sentiment analysis on every face in the image"""
+    # Detect faces
+    face_regions = detect_faces(image)
     
-    image_data = request.json['image']
-    session_id = request.json.get('sessionId', 'unknown')
-    student_id = request.json.get('studentId', 'unknown')
+    if not face_regions:
+        return {
+            'success': False,
+            'message': 'No faces detected in the image'
+        }, 400
     
-    try:
-        # Process the image
-        image = process_image(image_data)
+    results = []
+    
+    # Analyze each face
+    for i, (x1, y1, x2, y2) in enumerate(face_regions):
+        # Extract face region
+        face_image = image[y1:y2, x1:x2]
+        
+        # Skip if face is too small
+        if face_image.shape[0] < 20 or face_image.shape[1] < 20:
+            continue
         
-        # Detect faces
-        face_regions = detect_faces(image)
+        # Analyze sentiment
+        sentiment = analyze_sentiment(face_image)
         
-        if not face_regions:
-            return jsonify({
-                'success': False,
-                'message': 'No faces detected in the image'
-            }), 400
+        # Add face region
+        sentiment['face_region'] = [int(x1), int(y1), int(x2), int(y2)]
+        sentiment['face_id'] = i
         
-        results = []
+        results.append(sentiment)
         
-        # Analyze each face
-        for i, (x1, y1, x2, y2) in enumerate(face_regions):
-            # Extract face region
-            face_image = image[y1:y2, x1:x2]
-            
-            # Skip if face is too small
-            if face_image.shape[0] < 20 or face_image.shape[1] < 20:
-                continue
-            
-            # Analyze sentiment
-            sentiment = analyze_sentiment(face_image)
-            
-            # Add face region
-            sentiment['face_region'] = [int(x1), int(y1), int(x2), int(y2)]
-            sentiment['face_id'] = i
-            
-            results.append(sentiment)
-            
+        if audit_filename:
             # Draw bounding box and emotion on image
             cv2.rectangle(image, (x1, y1), (x2, y2), (255, 0, 0), 2)
             cv2.putText(image, f"{sentiment['dominant_emotion']}", 
                        (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+    
+    # Save the analysis image for reference
+    if results and audit_filename:
+        image_writer.submit(os.path.join(DATA_PATH, 'sentiment', audit_filename), image)
+    
+    # Calculate average engagement and attention
+    avg_engagement = np.mean([r['engagement'] for r in results]) if results else 0
+    avg_attention = np.mean([r['attention'] for r in results]) if results else 0
+    
+    return {
+        'success': True,
+        'message': 'Sentiment analysis completed',
+        'face_count': len(results),
+        'face_analyses': results,
+        'average_engagement': round(float(avg_engagement), 2),
+        'average_attention': round(float(avg_attention), 2)
+    }, 200
+
+@app.route('/api/sentiment/analyze', methods=['POST'])
+def analyze():
+    """Analyze sentiment in the image"""
+    fields, image_data = read_image_request(request)
+    if image_data is None:
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+    
+    session_id = fields.get('sessionId', 'unknown')
+    student_id = fields.get('studentId', 'unknown')
+    
+    try:
+        # Process the image
+        image = process_image(image_data)
         
-        # Save the analysis image for reference
-        if results:
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            image_filename = f"sentiment_{student_id}_{session_id}_{timestamp}.jpg"
-            cv2.imwrite(os.path.join(DATA_PATH, 'sentiment', image_filename), image)
-        
-        # Calculate average engagement and attention
-        avg_engagement = np.mean([r['engagement'] for r in results]) if results else 0
-        avg_attention = np.mean([r['attention'] for r in results]) if results else 0
-        
-        # Return results
-        return jsonify({
-            'success': True,
-            'message': 'Sentiment analysis completed',
-            'face_count': len(results),
-            'face_analyses': results,
-            'average_engagement': round(float(avg_engagement), 2),
-            'average_attention': round(float(avg_attention), 2)
-        })
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        result, status = analyze_frame(image, session_id, f"sentiment_{student_id}_{session_id}_{timestamp}.jpg")
+        return jsonify(result), status
         
     except Exception as e:
         print(f"Error analyzing sentiment: {e}")
         return jsonify({'success': False, 'message': f'Error processing image: {str(e)}'}), 500
 
+def process_stream_frame(session_id, frame):
+    """Streamed frames are analyzed without writing an audit image per frame"""
+    image = process_image(frame)
+    if image is None:
+        return {'success': False, 'message': 'Invalid image data'}
+    result, _ = analyze_frame(image, session_id)
+    return result
+
+# Continuous frame ingestion for live monitoring (see common/streaming.py).
+# Worker processes of a multi-process server share stream ownership through
+# lease files, so a session's requests must all reach the same worker
+stream_idle_timeout = float(os.environ.get('STREAM_IDLE_TIMEOUT', 60))
+stream_hub = StreamHub(
+    process_stream_frame,
+    max_fps=float(os.environ.get('STREAM_MAX_FPS', 5)),
+    max_frame_age=float(os.environ.get('STREAM_MAX_FRAME_AGE', 2)),
+    idle_timeout=stream_idle_timeout,
+    max_sessions=int(os.environ.get('MAX_STREAM_SESSIONS', 64)),
+    leases=SessionLeases(os.path.join(DATA_PATH, 'sessions', 'sentiment-stream'), 2 * stream_idle_timeout)
+)
+add_stream_routes(app, '/api/sentiment/stream', stream_hub, app.config['MAX_CONTENT_LENGTH'])
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({
+        'success': False,
+        'message': f"Request body exceeds {app.config['MAX_CONTENT_LENGTH']} bytes"
+    }), 413
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'ok'}), 200
+    return jsonify({'status': 'ok', 'models': models.stats(), 'imageWriter': image_writer.stats(),
+                    'streams': stream_hub.stats(), 'resultCache': result_cache.stats()}), 200
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5003, debug=False)